@@ -1,48 +1,139 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
 import datetime
+import json
 import os
+import sys
+import threading
+import time
 from dotenv import load_dotenv
-from database import (
-    init_db, save_chat, get_user_chats, 
-    delete_old_chats, get_db_connection
-)
+from repository import Repository
+from chat_export import export_chunks, EXPORT_FORMATS
+from chat_cache import chat_cache
 from contextlib import contextmanager
 import functools
 from flask import jsonify, request
 from werkzeug.security import check_password_hash
 import os
-from supabase import create_client, Client
-from supabase import create_client
+from timeouts import timeout_policies, read_with_deadline, CONNECT_TIMEOUT
+from bulkheads import BulkheadRegistry, BulkheadFull
+from degradation import DegradationPolicy
+from response_cache import ResponseCache, SEMANTIC_CACHE_EMBEDDING_MODEL
+from write_behind import WriteBehindBuffer, WriteBufferFull
+import atexit
+import signal
 
 # Initialize Flask app
 app = Flask(__name__, static_folder="static", template_folder="templates")
 load_dotenv()
 
-supabase_url = os.getenv('SUPABASE_URL')
-supabase_key = os.getenv('SUPABASE_SERVICE_KEY')  # Use service key for backend
-supabase = create_client(supabase_url, supabase_key)
+# Load user credentials
+USERS = {}
+for i in range(1, 21):
+    user_num = f"{i:02d}"
+    username = f"user{user_num}"
+    USERS[username] = {
+        "password": os.getenv(f"USER{user_num}_PASSWORD"),
+        "name": os.getenv(f"USER{user_num}_NAME"),
+    }
+
+# All data access (chats on the DB_BACKEND store; users over SQL or
+# PostgREST, or from USERS above when there is no Postgres)
+repository = Repository(
+    os.getenv('SUPABASE_URL'),
+    os.getenv('SUPABASE_SERVICE_KEY'),  # Use service key for backend
+    auth_backend=os.getenv('AUTH_BACKEND', 'auto'),
+    backend=os.getenv('DB_BACKEND', 'postgres').lower(),
+    local_users=USERS
+)
+
+# Postgres-only pieces (psycopg2, LISTEN/NOTIFY, partitions) are only
+# imported when that is the backend, so DB_BACKEND=sqlite runs without them
+if repository.backend == 'postgres':
+    import database
+    from retention import RetentionWorker, RETENTION_ENABLED
 
 # Configuration
 app.secret_key = os.getenv('FLASK_SECRET_KEY')
 REDPILL_API_ENDPOINT = os.getenv('REDPILL_API_ENDPOINT')
 REDPILL_API_KEY = os.getenv('REDPILL_API_KEY')
+REDPILL_EMBEDDINGS_ENDPOINT = os.getenv(
+    'REDPILL_EMBEDDINGS_ENDPOINT',
+    (REDPILL_API_ENDPOINT or '').replace('/chat/completions', '/embeddings')
+)
+GENERATION_ERROR = "Error: Unable to generate response"
+
+# Model classes get separate worker pools so a spike in slow models
+# can't starve quick chats. Classes with a fallback can be downgraded to it
+# under load for users/chats that opt in.
+MODEL_CLASSES = {
+    'reasoning': {
+        'match': ('o1-', 'o1/', '/o1'),
+        'max_concurrent': int(os.getenv('REASONING_POOL_SIZE', 4)),
+        'max_queue': int(os.getenv('REASONING_POOL_QUEUE', 8)),
+        'fallback': os.getenv('REASONING_FALLBACK_MODEL', 'gpt-4o'),
+        'degrade_latency': float(os.getenv('REASONING_DEGRADE_LATENCY', 90)),
+    },
+    'large': {
+        'match': ('405b', '90b', '72b', '70b', 'opus', 'gpt-4-32k'),
+        'max_concurrent': int(os.getenv('LARGE_POOL_SIZE', 8)),
+        'max_queue': int(os.getenv('LARGE_POOL_QUEUE', 16)),
+        'fallback': os.getenv('LARGE_FALLBACK_MODEL', 'gpt-4o-mini'),
+        'degrade_latency': float(os.getenv('LARGE_DEGRADE_LATENCY', 30)),
+    },
+    'standard': {
+        'max_concurrent': int(os.getenv('STANDARD_POOL_SIZE', 16)),
+        'max_queue': int(os.getenv('STANDARD_POOL_QUEUE', 32)),
+    },
+}
+bulkheads = BulkheadRegistry(MODEL_CLASSES, default_class='standard')
+degradation = DegradationPolicy(bulkheads, timeout_policies)
+
+response_cache = ResponseCache(embed=lambda text: ChatApp().embed(text))
+
+# Chat saves are coalesced per chat and written in the background. Each
+# accepted save is fsynced to the journal before /save_chat returns, so
+# queued saves survive a crash. Every process locks its own journal file
+# (write_behind.journal, .1, .2, ...); if none can be opened saves are
+# written synchronously instead. WRITE_BEHIND_JOURNAL='' keeps the queue in
+# memory only (lost on a crash). Saves that keep failing, or fail with an
+# integrity/data error, are dead-lettered (see /metrics) instead of retried
+# forever.
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+WRITE_BEHIND_JOURNAL = os.getenv('WRITE_BEHIND_JOURNAL', 'write_behind.journal')
+chat_saves = None
+if WRITE_BEHIND_ENABLED:
+    try:
+        chat_saves = WriteBehindBuffer(
+            lambda key, chat_data: repository.save_chat(key[0], key[1], chat_data),
+            window=float(os.getenv('WRITE_BEHIND_WINDOW', 0.5)),
+            max_pending=int(os.getenv('WRITE_BEHIND_MAX_PENDING', 1000)),
+            submit_timeout=float(os.getenv('WRITE_BEHIND_SUBMIT_TIMEOUT', 5)),
+            journal_path=WRITE_BEHIND_JOURNAL or None,
+            max_attempts=int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', 5)),
+            permanent_errors=repository.permanent_errors
+        )
+    except OSError as e:
+        print(f"Write-behind journal unavailable, saving synchronously: {e}")
+
+if chat_saves:
+    atexit.register(chat_saves.close)
+    # Turn SIGTERM into a normal exit so the atexit flush runs
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 # Initialize database
+retention = None
 try:
-    init_db()
+    repository.init_db()
+    if repository.backend == 'postgres':
+        database.start_invalidation_listener()
+        # Partition upkeep, retention and per-user chat limits run off the
+        # request path
+        if RETENTION_ENABLED:
+            retention = RetentionWorker().start()
 except Exception as e:
     print(f"Database initialization error: {e}")
 
-# Load user credentials
-USERS = {}
-for i in range(1, 21):
-    user_num = f"{i:02d}"
-    username = f"user{user_num}"
-    USERS[username] = {
-        "password": os.getenv(f"USER{user_num}_PASSWORD"),
-        "name": os.getenv(f"USER{user_num}_NAME"),
-    }
-
 def login_required(f):
     @functools.wraps(f)
     def decorated_function(*args, **kwargs):
@@ -59,7 +150,7 @@ class ChatApp:
         return (username in USERS and 
                 USERS[username]["password"] == password)
 
-    def generate_response(self, model, messages):
+    def generate_response(self, model, messages, temperature=0.7):
         import requests
         
         headers = {
@@ -70,25 +161,53 @@ class ChatApp:
         data = {
             "model": model,
             "messages": messages,
-            "temperature": 0.7,
+            "temperature": temperature,
             "max_tokens": 1000,
             "n": 1,
             "stream": False
         }
 
+        budget = timeout_policies.budget(model)
+        start = time.monotonic()
+        first_byte = None
         try:
+            # Connect and first-byte budgets are enforced by requests; the
+            # total budget is enforced while the body is read.
             response = requests.post(
                 REDPILL_API_ENDPOINT,
                 headers=headers,
                 json=data,
-                timeout=30
+                timeout=(budget.connect, budget.first_byte),
+                stream=True
             )
+            first_byte = time.monotonic() - start
             response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
-
+            body = read_with_deadline(response, start + budget.total)
+            timeout_policies.record(model, first_byte, time.monotonic() - start)
+            return json.loads(body)["choices"][0]["message"]["content"]
+
+        except requests.Timeout as e:
+            timeout_policies.record_timeout(model, time.monotonic() - start, first_byte)
+            print(f"API request timed out for {model} ({budget}): {e}")
+            return GENERATION_ERROR
         except requests.RequestException as e:
             print(f"API request error: {e}")
-            return f"Error: Unable to generate response"
+            return GENERATION_ERROR
+
+    def embed(self, text):
+        import requests
+
+        response = requests.post(
+            REDPILL_EMBEDDINGS_ENDPOINT,
+            headers={
+                "Authorization": f"Bearer {REDPILL_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json={"model": SEMANTIC_CACHE_EMBEDDING_MODEL, "input": text},
+            timeout=(CONNECT_TIMEOUT, 10)
+        )
+        response.raise_for_status()
+        return response.json()["data"][0]["embedding"]
 
     def get_available_models(self):
         return ['o1-preview', 'o1-preview-2024-09-12', 'o1-mini', 'o1-mini-2024-09-12', 'gpt-4o-mini', 'gpt-4o-mini-2024-07-18', 'gpt-4o', 'gpt-4o-2024-08-06', 'gpt-4o-2024-05-13', 'gpt-4', 'gpt-4-1106-preview', 'gpt-4-turbo', 'gpt-4-turbo-2024-04-09', 'gpt-3.5-turbo', 'gpt-3.5-turbo-0125', 'gpt-3.5-turbo-instruct', 'llama-2-7b-chat-fp16', 'llama-3.1-8b-instruct', 'llama-3-8b-instruct', 'llama-3-8b-instruct-awq', 'mistral-7b-instruct-v0.1', 'mistral-7b-instruct-v0.2', 'qwen1.5-0.5b-chat', 'qwen1.5-7b-chat-awq', 'qwen1.5-1.8b-chat', 'qwen1.5-14b-chat-awq', 'gemma-2b-it-lora', 'gemma-7b-it-lora', 'gemma-7b-it', 'claude-3-5-sonnet-20241022', 'claude-3-5-sonnet-20240620', 'claude-3-opus-20240229', 'claude-3-haiku-20240307', 'claude-3-sonnet-20240229', 'text-embedding-3-small', 'text-embedding-3-large', 'text-embedding-ada-002', 'mistralai/ministral-8b', 'mistralai/ministral-3b', 'qwen/qwen-2.5-7b-instruct', 'nvidia/llama-3.1-nemotron-70b-instruct', 'x-ai/grok-2', 'inflection/inflection-3-productivity', 'inflection/inflection-3-pi', 'google/gemini-flash-1.5-8b', 'liquid/lfm-40b', 'liquid/lfm-40b:free', 'thedrummer/rocinante-12b', 'eva-unit-01/eva-qwen-2.5-14b', 'anthracite-org/magnum-v2-72b', 'meta-llama/llama-3.2-3b-instruct:free', 'meta-llama/llama-3.2-3b-instruct', 'meta-llama/llama-3.2-1b-instruct:free', 'meta-llama/llama-3.2-1b-instruct', 'meta-llama/llama-3.2-90b-vision-instruct', 'meta-llama/llama-3.2-11b-vision-instruct:free', 'meta-llama/llama-3.2-11b-vision-instruct', 'perplexity/llama-3.1-sonar-small-128k-chat', 'qwen/qwen-2.5-72b-instruct', 'qwen/qwen-2-vl-72b-instruct', 'neversleep/llama-3.1-lumimaid-8b', 'openai/o1-mini-2024-09-12', 'openai/o1-mini', 'openai/o1-preview-2024-09-12', 'openai/o1-preview', 'mistralai/pixtral-12b', 'cohere/command-r-plus-08-2024', 'cohere/command-r-08-2024', 'meta-llama/llama-3.1-70b-instruct:free', 'anthropic/claude-2', 'qwen/qwen-2-vl-7b-instruct', 'google/gemini-flash-1.5-8b-exp', 'sao10k/l3.1-euryale-70b', 'google/gemini-flash-1.5-exp', 'ai21/jamba-1-5-large', 'ai21/jamba-1-5-mini', 'microsoft/phi-3.5-mini-128k-instruct', 'nousresearch/hermes-3-llama-3.1-70b', 'nousresearch/hermes-3-llama-3.1-405b:free', 'nousresearch/hermes-3-llama-3.1-405b', 'nousresearch/hermes-3-llama-3.1-405b:extended', 'perplexity/llama-3.1-sonar-huge-128k-online', 'openai/chatgpt-4o-latest', 'sao10k/l3-lunaris-8b', 'aetherwiing/mn-starcannon-12b', 'openai/gpt-4o-2024-08-06', 'meta-llama/llama-3.1-405b', 'nothingiisreal/mn-celeste-12b', 'google/gemini-pro-1.5-exp', 'perplexity/llama-3.1-sonar-large-128k-online', 'perplexity/llama-3.1-sonar-large-128k-chat', 'perplexity/llama-3.1-sonar-small-128k-online', 'meta-llama/llama-3.1-70b-instruct', 'meta-llama/llama-3.1-8b-instruct:free', 'meta-llama/llama-3.1-405b-instruct:free', 'meta-llama/llama-3.1-405b-instruct', 'mistralai/codestral-mamba', 'mistralai/mistral-nemo', 'openai/gpt-4o-mini-2024-07-18', 'openai/gpt-4o-mini', 'qwen/qwen-2-7b-instruct:free', 'qwen/qwen-2-7b-instruct', 'mistralai/mistral-tiny', 'google/gemma-2-27b-it', 'alpindale/magnum-72b', 'nousresearch/hermes-2-theta-llama-3-8b', 'google/gemma-2-9b-it:free', 'google/gemma-2-9b-it', 'ai21/jamba-instruct', 'sao10k/l3-euryale-70b', 'cognitivecomputations/dolphin-mixtral-8x22b', 'meta-llama/llama-3-70b-instruct', 'qwen/qwen-2-72b-instruct', 'nousresearch/hermes-2-pro-llama-3-8b', 'mistralai/mistral-7b-instruct-v0.3', 'mistralai/mistral-7b-instruct:free', 'mistralai/mistral-7b-instruct', 'mistralai/mistral-7b-instruct:nitro', 'microsoft/phi-3-mini-128k-instruct:free', 'microsoft/phi-3-mini-128k-instruct', 'microsoft/phi-3-medium-128k-instruct:free', 'microsoft/phi-3-medium-128k-instruct', 'neversleep/llama-3-lumimaid-70b', 'google/gemini-flash-1.5', 'openai/gpt-4-0314', 'deepseek/deepseek-chat', 'perplexity/llama-3-sonar-large-32k-online', 'perplexity/llama-3-sonar-large-32k-chat', 'perplexity/llama-3-sonar-small-32k-chat', 'meta-llama/llama-guard-2-8b', 'openai/gpt-4o-2024-05-13', 'openai/gpt-4o', 'openai/gpt-4o:extended', 'qwen/qwen-72b-chat', 'qwen/qwen-110b-chat', 'neversleep/llama-3-lumimaid-8b', 'neversleep/llama-3-lumimaid-8b:extended', 'sao10k/fimbulvetr-11b-v2', 'meta-llama/llama-3-70b-instruct:nitro', 'meta-llama/llama-3-8b-instruct:free', 'meta-llama/llama-3-8b-instruct:nitro', 'meta-llama/llama-3-8b-instruct:extended', 'mistralai/mixtral-8x22b-instruct', 'microsoft/wizardlm-2-7b', 'microsoft/wizardlm-2-8x22b', 'google/gemini-pro-1.5', 'openai/gpt-4-turbo', 'cohere/command-r-plus', 'cohere/command-r-plus-04-2024', 'databricks/dbrx-instruct', 'sophosympatheia/midnight-rose-70b', 'cohere/command-r', 'cohere/command', 'anthropic/claude-3-haiku', 'anthropic/claude-3-haiku:beta', 'anthropic/claude-3-sonnet:beta', 'anthropic/claude-3-opus', 'anthropic/claude-3-opus:beta', 'cohere/command-r-03-2024', 'mistralai/mistral-large', 'openai/gpt-4-turbo-preview', 'openai/gpt-3.5-turbo-0613', 'nousresearch/nous-hermes-2-mixtral-8x7b-dpo', 'mistralai/mistral-medium', 'mistralai/mistral-small', 'cognitivecomputations/dolphin-mixtral-8x7b', 'google/gemini-pro', 'google/gemini-pro-vision', 'mistralai/mixtral-8x7b-instruct', 'mistralai/mixtral-8x7b-instruct:nitro', 'mistralai/mixtral-8x7b', 'gryphe/mythomist-7b:free', 'gryphe/mythomist-7b', 'openchat/openchat-7b:free', 'openchat/openchat-7b', 'neversleep/noromaid-20b', 'anthropic/claude-instant-1.1', 'anthropic/claude-2.1', 'anthropic/claude-2.1:beta', 'anthropic/claude-2:beta', 'teknium/openhermes-2.5-mistral-7b', 'openai/gpt-4-vision-preview', 'lizpreciatior/lzlv-70b-fp16-hf', 'alpindale/goliath-120b', 'undi95/toppy-m-7b:free', 'undi95/toppy-m-7b', 'undi95/toppy-m-7b:nitro', 'openrouter/auto', 'openai/gpt-4-1106-preview', 'openai/gpt-3.5-turbo-1106', 'google/palm-2-codechat-bison-32k', 'google/palm-2-chat-bison-32k', 'jondurbin/airoboros-l2-70b', 'xwin-lm/xwin-lm-70b', 'openai/gpt-3.5-turbo-instruct', 'pygmalionai/mythalion-13b', 'openai/gpt-4-32k-0314', 'openai/gpt-4-32k', 'openai/gpt-3.5-turbo-16k', 'nousresearch/nous-hermes-llama2-13b', 'huggingfaceh4/zephyr-7b-beta:free', 'mancer/weaver', 'anthropic/claude-instant-1.0', 'anthropic/claude-1.2', 'anthropic/claude-1', 'anthropic/claude-instant-1', 'anthropic/claude-instant-1:beta', 'anthropic/claude-2.0', 'anthropic/claude-2.0:beta', 'undi95/remm-slerp-l2-13b', 'undi95/remm-slerp-l2-13b:extended', 'google/palm-2-codechat-bison', 'google/palm-2-chat-bison', 'gryphe/mythomax-l2-13b:free', 'gryphe/mythomax-l2-13b', 'gryphe/mythomax-l2-13b:nitro', 'gryphe/mythomax-l2-13b:extended', 'meta-llama/llama-2-13b-chat', 'openai/gpt-4', 'openai/gpt-3.5-turbo-0125', 'openai/gpt-3.5-turbo', 'anthropic/claude-3.5-sonnet:beta', 'openai/gpt-4-turbo-2024-04-09', 'meta-llama/llama-2-7b-chat-fp16', 'meta-llama/llama-3.1-8b-instruct', 'meta-llama/llama-3-8b-instruct', 'meta-llama/llama-3-8b-instruct-awq', 'mistralai/mistral-7b-instruct-v0.1', 'mistralai/mistral-7b-instruct-v0.2', 'qwen/qwen1.5-0.5b-chat', 'qwen/qwen1.5-7b-chat-awq', 'qwen/qwen1.5-1.8b-chat', 'qwen/qwen1.5-14b-chat-awq', 'google/gemma-2b-it-lora', 'anthropic/claude-3-5-sonnet', 'google/gemma-7b-it-lora', 'google/gemma-7b-it', 'anthropic/claude-3-5-sonnet-20240620', 'anthropic/claude-3-sonnet']  
@@ -118,30 +237,20 @@ def login():
             }), 400
 
         # First get the user
-        user_response = supabase.table('auth.users') \
-            .select("*") \
-            .eq('username', username) \
-            .execute()
+        user = repository.get_user(username)
 
-        if len(user_response.data) == 0:
+        if user is None:
             return jsonify({
                 'success': False,
                 'message': 'User not found'
             }), 404
 
-        user = user_response.data[0]
-
         # Verify password using the function
-        verify_response = supabase.rpc(
-            'verify_password',
-            {
-                'input_password': password,
-                'hashed_password': user['password']
-            }
-        ).execute()
-
-        if verify_response:
-            # Password is correct
+        if repository.verify_password(password, user['password']):
+            # Password is correct; preload their sidebar and latest chat
+            threading.Thread(
+                target=repository.warm_chat_cache, args=(user['username'],), daemon=True
+            ).start()
             return jsonify({
                 'success': True,
                 'user': {
@@ -168,15 +277,135 @@ def logout():
     session.clear()
     return jsonify({'success': True})
 
+def complete(model, messages, allow_downgrade=False, temperature=0.7, use_cache=False):
+    """Run a completion through the response cache, degradation routing and
+    the model's bulkhead.
+
+    Returns ``(response, model_used, downgraded, cache_hit)`` where
+    ``cache_hit`` is None, 'exact' or 'semantic'.
+    """
+    chat_app = ChatApp()
+    cacheable = response_cache.eligible(messages, temperature, use_cache)
+    vector = None
+    if cacheable:
+        # Sampled re-answers share the model's bulkhead and are dropped
+        # (BulkheadFull) rather than queued when it is saturated
+        def verify():
+            fresh = bulkheads.for_model(model).submit(
+                chat_app.generate_response, model, messages, temperature
+            ).result()
+            return None if fresh == GENERATION_ERROR else fresh
+
+        cached, cache_hit, vector = response_cache.get(
+            model, messages, verify=verify, username=session.get('username')
+        )
+        if cached is not None:
+            return cached, model, False, cache_hit
+
+    requested_model = model
+    model, downgraded = degradation.route(
+        model,
+        username=session.get('username'),
+        allow_downgrade=allow_downgrade
+    )
+    future = bulkheads.for_model(model).submit(
+        chat_app.generate_response, model, messages, temperature
+    )
+    response = future.result()
+    if cacheable and not downgraded and response != GENERATION_ERROR:
+        response_cache.put(requested_model, messages, response, vector,
+                           username=session.get('username'))
+    return response, model, downgraded, None
+
 @app.route('/send_message', methods=['POST'])
 @login_required
 def send_message():
     try:
         data = request.get_json()
-        chat_app = ChatApp()
-        response = chat_app.generate_response(data['model'], data['messages'])
-        return jsonify({'response': response})
+        response, model, downgraded, cache_hit = complete(
+            data['model'], data['messages'],
+            allow_downgrade=data.get('allowDowngrade', False),
+            temperature=float(data.get('temperature', 0.7)),
+            use_cache=data.get('cache', False)
+        )
+        return jsonify({
+            'response': response,
+            'model': model,
+            'downgraded': downgraded,
+            'cached': cache_hit
+        })
+    except BulkheadFull as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/conversation', methods=['POST'])
+@login_required
+def conversation():
+    """Send one new message; history is loaded and saved server-side"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+
+        username = session['username']
+        chat_id = data.get('chat_id')
+        new_message = data.get('new_message')
+        if not chat_id or not new_message:
+            return jsonify({'error': 'Missing chat ID or message'}), 400
+
+        if chat_saves:
+            # Apply any buffered metadata save before reading and appending
+            chat_saves.flush((username, chat_id))
+        chat = repository.get_chat(username, chat_id) or {}
+        model = data.get('model') or chat.get('model')
+        if not model:
+            return jsonify({'error': 'No model selected'}), 400
+
+        # Continue a branch instead of the main line if one is given;
+        # check it exists before spending a completion on it
+        branch_id = data.get('branch_id')
+        messages = chat.get('messages', [])
+        if branch_id:
+            messages = repository.get_branch_history(username, chat_id, branch_id)
+            if messages is None:
+                return jsonify({'error': 'Branch not found'}), 404
+
+        user_message = {'role': 'user', 'content': new_message}
+        history = [
+            {'role': message['role'], 'content': message['content']}
+            for message in messages
+        ] + [user_message]
+        allow_downgrade = data.get('allowDowngrade', chat.get('allowDowngrade', False))
+        response, used_model, downgraded, cache_hit = complete(
+            model, history,
+            allow_downgrade=allow_downgrade,
+            temperature=float(data.get('temperature', 0.7)),
+            use_cache=data.get('cache', False)
+        )
+
+        reply = {'role': 'assistant', 'content': response}
+        if downgraded:
+            reply['model'] = used_model
+            reply['downgraded'] = True
+        if branch_id:
+            repository.append_branch_messages(username, chat_id, branch_id, [user_message, reply])
+        else:
+            chat = repository.append_messages(username, chat_id, [user_message, reply], model=model)
+
+        return jsonify({
+            'response': response,
+            'model': used_model,
+            'downgraded': downgraded,
+            'cached': cache_hit,
+            'title': chat.get('title')
+        })
+    except BulkheadFull as e:
+        return jsonify({'error': str(e)}), 503
+    except repository.BranchError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
+        print(f"Error in conversation: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/save_chat', methods=['POST'])
@@ -197,27 +426,216 @@ def save_chat_route():
         if not chat_id or not chat_data:
             return jsonify({'error': 'Missing chat ID or data'}), 400
 
-        save_chat(username, chat_id, chat_data)
+        if chat_saves:
+            chat_saves.submit((username, chat_id), chat_data)
+        else:
+            repository.save_chat(username, chat_id, chat_data)
         return jsonify({'success': True})
+    except WriteBufferFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         print(f"Error in save_chat: {str(e)}")  # Add logging
         return jsonify({'error': str(e)}), 500
 
+def _flush_saves(key=None, prefix=None):
+    """Write buffered saves before a read; a failing save is logged (and
+    retried or dead-lettered by the buffer) and the read serves what is
+    stored rather than failing"""
+    if not chat_saves:
+        return
+    try:
+        chat_saves.flush(key, prefix=prefix)
+    except Exception as e:
+        print(f"Error flushing buffered saves before read: {e}")
+
+def _limit_arg(default, maximum):
+    """The ``limit`` query parameter clamped to 1..maximum; ValueError if
+    it isn't an integer"""
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        raise ValueError("limit must be an integer") from None
+    return max(1, min(limit, maximum))
+
 @app.route('/get_chats', methods=['GET'])
 @login_required
 def get_chats():
     try:
         username = session['username']
-        chats = get_user_chats(username)
+        _flush_saves(prefix=(username,))
+        chats = repository.get_user_chats(username)
         return jsonify({'chats': chats})
     except Exception as e:
         print(f"Error in get_chats: {str(e)}")  # Add logging
         return jsonify({'error': str(e)}), 500
 
+@app.route('/chats', methods=['GET'])
+@login_required
+def list_chats():
+    try:
+        username = session['username']
+        limit = _limit_arg(50, 200)
+        _flush_saves(prefix=(username,))
+        page = repository.get_chat_summaries(username, limit=limit, cursor=request.args.get('cursor'))
+        return jsonify(page)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error in list_chats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/chats/<chat_id>', methods=['GET'])
+@login_required
+def get_chat_route(chat_id):
+    """A chat with its latest messages; older ones come from /messages"""
+    try:
+        limit = _limit_arg(50, 200)
+        _flush_saves((session['username'], chat_id))
+        chat = repository.get_chat_window(session['username'], chat_id, limit=limit)
+        if chat is None:
+            return jsonify({'error': 'Chat not found'}), 404
+        return jsonify({'chat': chat})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error in get_chat: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/chats/<chat_id>/messages', methods=['GET'])
+@login_required
+def get_chat_messages(chat_id):
+    try:
+        limit = _limit_arg(50, 200)
+        before = request.args.get('before', type=int)
+        chat = repository.get_chat_window(session['username'], chat_id, limit=limit, before=before)
+        if chat is None:
+            return jsonify({'error': 'Chat not found'}), 404
+        return jsonify({'messages': chat['messages'], 'before': chat['before']})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error in get_chat_messages: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/chats/<chat_id>/branches', methods=['GET'])
+@login_required
+def list_chat_branches(chat_id):
+    try:
+        branches = repository.list_branches(session['username'], chat_id)
+        if branches is None:
+            return jsonify({'error': 'Chat not found'}), 404
+        return jsonify({'branches': branches})
+    except Exception as e:
+        print(f"Error in list_chat_branches: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/chats/<chat_id>/branches', methods=['POST'])
+@login_required
+def fork_chat_route(chat_id):
+    """Fork at message ``at_seq`` (to edit it or regenerate a reply)"""
+    try:
+        data = request.get_json() or {}
+        if 'at_seq' not in data:
+            return jsonify({'error': 'at_seq is required'}), 400
+        try:
+            at_seq = int(data['at_seq'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'at_seq must be an integer'}), 400
+        username = session['username']
+        if chat_saves:
+            chat_saves.flush((username, chat_id))
+        branch = repository.fork_chat(
+            username, chat_id, at_seq,
+            parent_branch_id=data.get('parent_branch_id'), title=data.get('title')
+        )
+        return jsonify({'branch': branch}), 201
+    except repository.BranchError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error in fork_chat: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/chats/<chat_id>/branches/<branch_id>', methods=['GET'])
+@login_required
+def get_branch_route(chat_id, branch_id):
+    """A branch's linear history, inherited messages included"""
+    try:
+        messages = repository.get_branch_history(session['username'], chat_id, branch_id)
+        if messages is None:
+            return jsonify({'error': 'Chat or branch not found'}), 404
+        return jsonify({'messages': messages})
+    except Exception as e:
+        print(f"Error in get_branch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/search', methods=['GET'])
+@login_required
+def search():
+    """Ranked message matches with highlighted snippets; the first page
+    also lists chats whose title contains the query"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'q is required'}), 400
+        username = session['username']
+        limit = _limit_arg(20, 100)
+        cursor = request.args.get('cursor')
+        page = repository.search_messages(username, query, limit=limit, cursor=cursor)
+        if not cursor:
+            page['chats'] = repository.search_chat_titles(username, query)
+        return jsonify(page)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error in search: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/export', methods=['GET'])
+@login_required
+def export():
+    """Stream the user's chats, one JSON object per line.
+
+    ``format`` is 'ndjson' (default) or 'jsonl.gz'; ``after`` resumes after
+    the chat id on the last complete line of an interrupted export.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    username = session['username']
+    chats = repository.export_chats(username, after=request.args.get('after'))
+    filename = f"chats-{username}.{'jsonl.gz' if export_format == 'jsonl.gz' else 'ndjson'}"
+    return Response(
+        stream_with_context(export_chunks(chats, compress=export_format == 'jsonl.gz')),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 @app.route('/health')
 def health_check():
     return jsonify({"status": "ok"})
 
+@app.route('/metrics')
+@login_required
+def metrics():
+    stats = {
+        'bulkheads': bulkheads.stats(),
+        'chat_cache': chat_cache.stats(),
+        'chat_saves': chat_saves.stats() if chat_saves else None,
+        'db_pool': repository.db.pool_stats(),
+        'repository': repository.stats(),
+        'degradation': degradation.stats(),
+        'response_cache': response_cache.stats(),
+        'retention': retention.stats() if retention else None,
+        'timeouts': timeout_policies.stats(),
+    }
+    if repository.backend == 'postgres':
+        stats.update({
+            'cache_invalidation': database.invalidation_stats(),
+            'prepared_statements': database.prepared_statement_stats(),
+            'replica': database.replica_stats(),
+        })
+    return jsonify(stats)
+
 @app.route('/delete_chat', methods=['POST'])
 @login_required
 def delete_chat():
@@ -229,28 +647,9 @@ def delete_chat():
         if not chat_id:
             return jsonify({'error': 'No chat ID provided'}), 400
 
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                # Delete messages
-                cur.execute(
-                    '''
-                    DELETE FROM messages 
-                    WHERE chat_id = %s AND chat_id IN (
-                        SELECT chat_id FROM chats WHERE username = %s
-                    )
-                    ''',
-                    (chat_id, username)
-                )
-
-                # Delete chat
-                cur.execute(
-                    '''
-                    DELETE FROM chats 
-                    WHERE chat_id = %s AND username = %s
-                    ''',
-                    (chat_id, username)
-                )
-                conn.commit()
+        if chat_saves:
+            chat_saves.discard((username, chat_id))
+        repository.delete_user_chat(username, chat_id)
 
         return jsonify({'success': True})
 
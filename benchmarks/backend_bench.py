@@ -0,0 +1,196 @@
+"""Compare the Postgres and SQLite backends on the app's query mix.
+
+    python benchmarks/backend_bench.py [--backends sqlite,postgres]
+        [--users 5] [--chats 20] [--messages 20] [--operations 2000]
+        [--threads 1] [--sqlite-path bench.db]
+
+Seeds the same synthetic history into each backend, then runs a weighted
+mix of what requests do (sidebar page, open a chat, send a message,
+search, ...) through the backend's public functions, so each number is
+what the repository layer would see. The chat cache is off so reads reach
+the store. SQLite uses a fresh temporary file unless --sqlite-path is
+given; Postgres uses DATABASE_URL and is skipped if that isn't set. The
+seeded chats are deleted afterwards.
+"""
+import argparse
+import importlib
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    # Only needed to pick up DATABASE_URL from .env for the Postgres run
+    load_dotenv = None
+
+WORDS = (
+    "the model returns a stack trace when parsing large config files with nested "
+    "arrays so we retry the request with a smaller context window and log the error "
+    "python database index query latency cache invalidation replica partition"
+).split()
+
+# (operation, weight): roughly the request mix of the chat UI
+MIX = [
+    ('get_chat_summaries', 30),
+    ('get_chat_window', 30),
+    ('append_messages', 20),
+    ('get_chat', 8),
+    ('search_messages', 7),
+    ('get_user_chats', 3),
+    ('save_chat', 2),
+]
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+
+def seed(db, users, chats, messages, rng):
+    """Create the synthetic history; returns {username: [chat ids]}"""
+    history = {}
+    for user in range(users):
+        username = f"bench-{uuid.uuid4().hex[:8]}-{user}"
+        history[username] = []
+        for _ in range(chats):
+            chat_id = uuid.uuid4().hex
+            db.save_chat(username, chat_id, {
+                'title': sentence(rng, 4),
+                'model': 'gpt-4o-mini',
+                'messages': [
+                    {'role': 'user' if i % 2 == 0 else 'assistant',
+                     'content': sentence(rng, rng.randint(5, 300))}
+                    for i in range(messages)
+                ],
+            })
+            history[username].append(chat_id)
+    return history
+
+
+def operation(db, name, history, rng):
+    username = rng.choice(list(history))
+    chat_id = rng.choice(history[username])
+    if name == 'get_chat_summaries':
+        return lambda: db.get_chat_summaries(username)
+    if name == 'get_chat_window':
+        return lambda: db.get_chat_window(username, chat_id)
+    if name == 'append_messages':
+        reply = [
+            {'role': 'user', 'content': sentence(rng, 20)},
+            {'role': 'assistant', 'content': sentence(rng, 150)},
+        ]
+        return lambda: db.append_messages(username, chat_id, reply, model='gpt-4o-mini')
+    if name == 'get_chat':
+        return lambda: db.get_chat(username, chat_id)
+    if name == 'search_messages':
+        query = ' '.join(rng.sample(WORDS, 2))
+        return lambda: db.search_messages(username, query)
+    if name == 'get_user_chats':
+        return lambda: db.get_user_chats(username)
+    new_chat = uuid.uuid4().hex
+    history[username].append(new_chat)
+    return lambda: db.save_chat(username, new_chat, {
+        'title': sentence(rng, 4),
+        'messages': [{'role': 'user', 'content': sentence(rng, 30)}],
+    })
+
+
+def run(db, history, operations, threads, rng):
+    names = [name for name, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    planned = [
+        (name, operation(db, name, history, rng))
+        for name in rng.choices(names, weights=weights, k=operations)
+    ]
+    samples = defaultdict(list)
+    lock = threading.Lock()
+
+    def timed(item):
+        name, call = item
+        start = time.perf_counter()
+        call()
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            samples[name].append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(timed, planned))
+    return samples, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backends', default='sqlite,postgres')
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--chats', type=int, default=20, help='chats per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per chat')
+    parser.add_argument('--operations', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--sqlite-path', help='SQLite file (default: a temporary one)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if load_dotenv:
+        load_dotenv()
+    os.environ['CHAT_CACHE_ENABLED'] = 'false'
+    scratch = None
+    if not args.sqlite_path:
+        scratch = tempfile.TemporaryDirectory()
+        args.sqlite_path = os.path.join(scratch.name, 'bench.db')
+    os.environ['SQLITE_PATH'] = args.sqlite_path
+
+    results = {}
+    for backend in args.backends.split(','):
+        if backend == 'postgres' and not os.getenv('DATABASE_URL'):
+            print("Skipping postgres: DATABASE_URL is not set\n")
+            continue
+        db = importlib.import_module({'postgres': 'database', 'sqlite': 'database_sqlite'}[backend])
+        db.init_db()
+        rng = random.Random(args.seed)
+        print(f"{backend}: seeding {args.users * args.chats} chats "
+              f"of {args.messages} messages...")
+        history = seed(db, args.users, args.chats, args.messages, rng)
+        try:
+            samples, elapsed = run(db, history, args.operations, args.threads, rng)
+        finally:
+            for username, chat_ids in history.items():
+                for chat_id in chat_ids:
+                    db.delete_user_chat(username, chat_id)
+        results[backend] = samples
+        print(f"{backend}: {args.operations} operations on {args.threads} thread(s) in "
+              f"{elapsed:.2f}s ({args.operations / elapsed:.0f} ops/s)\n")
+
+    print("milliseconds per call")
+    print(f"{'operation':<22}" + ''.join(
+        f"{backend + ' p50':>16}{backend + ' p99':>16}" for backend in results
+    ))
+    for name, _ in MIX:
+        row = f"{name:<22}"
+        for samples in results.values():
+            values = samples.get(name)
+            if values:
+                row += f"{statistics.median(values):>16.2f}{percentile(values, 0.99):>16.2f}"
+            else:
+                row += f"{'-':>16}{'-':>16}"
+        print(row)
+    if scratch:
+        scratch.cleanup()
+
+
+if __name__ == '__main__':
+    main()
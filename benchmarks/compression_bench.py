@@ -0,0 +1,127 @@
+"""Compare message storage size and decode cost across encodings.
+
+    python benchmarks/compression_bench.py [--input chats.jsonl] [--database]
+
+Reads message bodies from an NDJSON chat export (one chat per line with a
+``messages`` list) or generates a code-heavy synthetic corpus. With
+--database, TEXT and JSONB sizes come from Postgres' pg_column_size so
+they include TOAST's own pglz compression.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import COMPRESSION_THRESHOLD, MessageCodecs, train_dictionary, zstandard
+
+
+def load_corpus(path):
+    with open(path) as f:
+        for line in f:
+            chat = json.loads(line)
+            for message in chat.get('messages', []):
+                yield message['content']
+
+
+def synthetic_corpus(count=2000, seed=7):
+    rng = random.Random(seed)
+    names = ['user', 'chat', 'message', 'result', 'response', 'config', 'value']
+    bodies = []
+    for _ in range(count):
+        lines = ["Here is an updated version of the function:", "", "```python"]
+        for _ in range(rng.randint(5, 120)):
+            name = rng.choice(names)
+            lines.append(f"    {name}_{rng.randint(0, 50)} = get_{rng.choice(names)}({name}, timeout={rng.randint(1, 60)})")
+        lines += ["```", "", "This avoids re-reading the whole chat on every request."]
+        bodies.append("\n".join(lines))
+    return bodies
+
+
+def time_decode(decode, encoded):
+    start = time.perf_counter()
+    for item in encoded:
+        decode(item)
+    return (time.perf_counter() - start) / len(encoded) * 1e6
+
+
+def database_sizes(bodies):
+    import psycopg2
+    from database import get_database_url
+
+    conn = psycopg2.connect(get_database_url())
+    try:
+        with conn.cursor() as cur:
+            text = jsonb = 0
+            for body in bodies:
+                cur.execute(
+                    "SELECT pg_column_size(%s::text), pg_column_size(to_jsonb(%s::text))",
+                    (body, body)
+                )
+                text_size, jsonb_size = cur.fetchone()
+                text += text_size
+                jsonb += jsonb_size
+            return text, jsonb
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input', help='NDJSON chat export to use as the corpus')
+    parser.add_argument('--database', action='store_true',
+                        help='measure TEXT/JSONB sizes with pg_column_size')
+    args = parser.parse_args()
+
+    bodies = list(load_corpus(args.input)) if args.input else synthetic_corpus()
+    large = [body for body in bodies if len(body.encode()) >= COMPRESSION_THRESHOLD]
+    if not large:
+        print("No messages above the compression threshold")
+        return
+    # Train on half the corpus and measure on the other half
+    random.Random(1).shuffle(large)
+    training, sample = large[:len(large) // 2], large[len(large) // 2:]
+    raw = [body.encode() for body in sample]
+    raw_total = sum(len(item) for item in raw)
+
+    results = []
+    if args.database:
+        text_size, jsonb_size = database_sizes(sample)
+        results.append(('TEXT (pg_column_size)', text_size, None))
+        results.append(('JSONB (pg_column_size)', jsonb_size, None))
+    else:
+        results.append(('TEXT (uncompressed)', raw_total, None))
+        jsonb = [json.dumps(body).encode() for body in sample]
+        results.append(('JSON string (uncompressed)', sum(len(item) for item in jsonb), None))
+
+    encoded = [zlib.compress(item, 6) for item in raw]
+    results.append(('zlib-6', sum(map(len, encoded)), time_decode(zlib.decompress, encoded)))
+
+    if zstandard is not None:
+        codecs = MessageCodecs(threshold=0)
+        encoded = [codecs.encode(body) for body in sample]
+        results.append(('zstd', sum(len(item[1]) for item in encoded),
+                        time_decode(lambda item: codecs.decode(*item), encoded)))
+
+        codecs.add_dictionary(1, train_dictionary(training), active=True)
+        encoded = [codecs.encode(body) for body in sample]
+        results.append(('zstd + trained dictionary', sum(len(item[1]) for item in encoded),
+                        time_decode(lambda item: codecs.decode(*item), encoded)))
+    else:
+        print("zstandard not installed; skipping zstd codecs")
+
+    print(f"{len(sample)} messages >= {COMPRESSION_THRESHOLD} bytes, "
+          f"median {statistics.median(map(len, raw))} bytes\n")
+    print(f"{'encoding':<28}{'bytes':>12}{'ratio':>8}{'decode us/msg':>16}")
+    for name, size, decode_us in results:
+        decode = f"{decode_us:.1f}" if decode_us is not None else '-'
+        print(f"{name:<28}{size:>12}{raw_total / size:>8.2f}{decode:>16}")
+
+
+if __name__ == '__main__':
+    main()
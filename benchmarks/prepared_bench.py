@@ -0,0 +1,88 @@
+"""Compare hot chat queries run as plain statements and as prepared ones.
+
+    python benchmarks/prepared_bench.py --user user01 [--iterations 2000]
+
+Runs the read queries the app issues on every request against the real
+schema, on one direct connection, so the difference is the parse/plan
+work PREPARE saves (plus the shorter EXECUTE text on the wire). Point
+DATABASE_URL at Postgres directly, not at a transaction-mode pooler.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+from dotenv import load_dotenv
+
+import queries
+from prepared import PreparedStatements
+
+
+def time_calls(run, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples), statistics.quantiles(samples, n=100)[98]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--user', required=True, help='username whose chats to read')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    load_dotenv()
+    from database import get_database_url
+
+    conn = psycopg2.connect(get_database_url())
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT chat_id FROM chats WHERE username = %s ORDER BY updated_at DESC LIMIT 1",
+        (args.user,)
+    )
+    row = cur.fetchone()
+    if row is None:
+        sys.exit(f"{args.user} has no chats")
+    chat_id = row[0]
+
+    cases = [
+        ('select user chats', queries.SELECT_USER_CHATS, {'username': args.user}),
+        ('select chat', queries.SELECT_CHAT, {'chat_id': chat_id, 'username': args.user}),
+        ('select messages', queries.SELECT_CHAT_MESSAGES, {'chat_ids': [chat_id]}),
+    ]
+    prepared = PreparedStatements({
+        f"bench_{index}": query for index, (_, query, _) in enumerate(cases)
+    })
+
+    print(f"{args.iterations} calls each, microseconds per call\n")
+    print(f"{'query':<20}{'plain p50':>12}{'prepared p50':>14}{'plain p99':>12}{'prepared p99':>14}{'saving':>9}")
+    for name, query, params in cases:
+        def plain():
+            cur.execute(query, params)
+            cur.fetchall()
+
+        def execute():
+            prepared.execute(cur, query, params)
+            cur.fetchall()
+
+        # Warm up both paths (and PREPARE) before measuring
+        for _ in range(50):
+            plain()
+            execute()
+        plain_p50, plain_p99 = time_calls(plain, args.iterations)
+        prepared_p50, prepared_p99 = time_calls(execute, args.iterations)
+        saving = (plain_p50 - prepared_p50) / plain_p50 * 100
+        print(f"{name:<20}{plain_p50:>12.1f}{prepared_p50:>14.1f}"
+              f"{plain_p99:>12.1f}{prepared_p99:>14.1f}{saving:>8.1f}%")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
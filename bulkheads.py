@@ -0,0 +1,96 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BulkheadFull(Exception):
+    """Raised when a bulkhead's workers and queue are both saturated"""
+
+
+class Bulkhead:
+    """A bounded worker pool with its own queue for one class of models"""
+
+    def __init__(self, name, max_concurrent, max_queue):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrent,
+            thread_name_prefix=f"bulkhead-{name}"
+        )
+        self._slots = threading.BoundedSemaphore(max_concurrent + max_queue)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn in this bulkhead, raising BulkheadFull instead of waiting"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise BulkheadFull(f"{self.name} pool is saturated")
+
+        with self._lock:
+            self.queued += 1
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                self._slots.release()
+
+        try:
+            return self._executor.submit(run)
+        except Exception:
+            with self._lock:
+                self.queued -= 1
+            self._slots.release()
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'queued': self.queued,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'occupancy': round(self.active / self.max_concurrent, 2),
+            }
+
+
+class BulkheadRegistry:
+    """Routes each model to the bulkhead of its configured model class.
+
+    ``model_classes`` maps a class name to a dict with ``match`` (substrings
+    of model ids), ``max_concurrent`` and ``max_queue``. Models matching no
+    class go to ``default_class``.
+    """
+
+    def __init__(self, model_classes, default_class):
+        self.model_classes = model_classes
+        self.default_class = default_class
+        self.bulkheads = {
+            name: Bulkhead(name, config['max_concurrent'], config['max_queue'])
+            for name, config in model_classes.items()
+        }
+
+    def classify(self, model):
+        for name, config in self.model_classes.items():
+            if any(marker in model for marker in config.get('match', ())):
+                return name
+        return self.default_class
+
+    def for_model(self, model):
+        return self.bulkheads[self.classify(model)]
+
+    def stats(self):
+        return {name: bulkhead.stats() for name, bulkhead in self.bulkheads.items()}
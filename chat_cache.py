@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+CHAT_CACHE_ENABLED = os.getenv('CHAT_CACHE_ENABLED', 'true').lower() == 'true'
+CHAT_CACHE_MAX_BYTES = int(os.getenv('CHAT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+def _estimate_size(value):
+    return len(json.dumps(value, default=str))
+
+
+class ChatCache:
+    """Size-bounded LRU of chat reads, indexed per user for invalidation.
+
+    Entries are keyed by ``(username, chat_id, kind, *args)``; ``chat_id`` is
+    None for reads that span the user's chats (listings), which every write
+    by that user invalidates. Cached values are shared, so callers must
+    not mutate them.
+
+    While ``validate`` is set (no invalidation listener connected, so writes
+    on other instances may go unnoticed) every hit is checked against the
+    user's write version from ``validator(username)`` and entries cached
+    without a version are treated as misses.
+    """
+
+    def __init__(self, max_bytes=CHAT_CACHE_MAX_BYTES, enabled=CHAT_CACHE_ENABLED):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._bytes = 0
+        self.validate = True
+        self.validator = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, loader):
+        """Return the cached value for key, loading (and caching) it on a miss"""
+        if not self.enabled:
+            return loader()
+        version = None
+        if self.validate and self.validator:
+            version = self.validator(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (version is None or entry[2] == version):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation(key[0])
+
+        value = loader()
+        if value is not None:
+            self._store(key, value, generation, version)
+        return value
+
+    def _generation(self, username):
+        return self._by_user.get(username, (0, None))[0]
+
+    def _store(self, key, value, generation, version=None):
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # A write invalidated this user while we were loading; the value
+            # may be stale, so don't cache it
+            if self._generation(key[0]) != generation:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size, version)
+            self._bytes += size
+            generation, keys = self._by_user.setdefault(key[0], (generation, set()))
+            keys.add(key)
+            while self._bytes > self.max_bytes:
+                old_key, (_, old_size, _) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self._by_user.get(old_key[0], (0, set()))[1].discard(old_key)
+                self.evictions += 1
+
+    def _invalidate(self, username, match):
+        with self._lock:
+            generation, keys = self._by_user.get(username, (0, set()))
+            for key in [key for key in keys if match(key)]:
+                keys.discard(key)
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+            self._by_user[username] = (generation + 1, keys)
+            self.invalidations += 1
+
+    def invalidate_chat(self, username, chat_id):
+        """Drop one chat's entries and the user's listings"""
+        self._invalidate(username, lambda key: key[1] in (None, chat_id))
+
+    def invalidate_user(self, username):
+        self._invalidate(username, lambda key: True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user = {
+                username: (generation + 1, set())
+                for username, (generation, _) in self._by_user.items()
+            }
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'validating': self.validate,
+                'entries': len(self._entries),
+                'users': sum(1 for _, keys in self._by_user.values() if keys),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+chat_cache = ChatCache()
@@ -0,0 +1,62 @@
+import json
+import zlib
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'jsonl.gz': 'application/gzip',
+}
+
+# Lines are buffered into chunks of about this size before being sent
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def export_chunks(chats, compress=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """Encode chats as one JSON object per line, yielding byte chunks.
+
+    With ``compress`` the output is a gzip stream. Only whole lines are
+    ever emitted uncompressed, so a truncated NDJSON export can be resumed
+    after the id on its last complete line.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    size = 0
+    for chat in chats:
+        line = json.dumps(chat, separators=(',', ':')).encode('utf-8') + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            data = b''.join(buffer)
+            buffer, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = b''.join(buffer)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def last_exported_id(path):
+    """The chat id on the last complete line of an NDJSON export, after
+    dropping any partial trailing line; None if there is none"""
+    with open(path, 'rb+') as f:
+        f.seek(0, 2)
+        end = f.tell()
+        position = end
+        last_line = b''
+        # Read backwards until we have the last complete line
+        while position > 0:
+            step = min(64 * 1024, position)
+            position -= step
+            f.seek(position)
+            last_line = f.read(step) + last_line
+            if last_line.count(b'\n') >= 2 or (position == 0 and b'\n' in last_line):
+                break
+        complete = last_line[:last_line.rfind(b'\n') + 1]
+        if not complete:
+            f.truncate(position)
+            return None
+        f.truncate(position + len(complete))
+        lines = complete.rstrip(b'\n').rsplit(b'\n', 1)
+        return json.loads(lines[-1])['id']
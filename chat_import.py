@@ -0,0 +1,159 @@
+import gzip
+import json
+from datetime import datetime, timezone
+
+MESSAGE_ROLES = ('user', 'assistant', 'system')
+MAX_CHAT_ID_LENGTH = 200
+
+_decoder = json.JSONDecoder()
+
+
+class InvalidChat(ValueError):
+    """A chat in an import file that can't be loaded"""
+
+
+def iter_json_array(f, chunk_size=1024 * 1024):
+    """Yield the elements of a top-level JSON array without loading the
+    whole document"""
+    buffer = f.read(chunk_size)
+    position = buffer.find('[')
+    if position < 0:
+        raise ValueError("expected a JSON array")
+    position += 1
+    while True:
+        # Skip separators between elements
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                break
+            more = f.read(chunk_size)
+            if not more:
+                raise ValueError("unterminated JSON array")
+            buffer, position = more, 0
+        if buffer[position] == ']':
+            return
+        try:
+            value, end = _decoder.raw_decode(buffer, position)
+        except ValueError:
+            more = f.read(chunk_size)
+            if not more:
+                raise
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        yield value
+        position = end
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_export(path):
+    """Yield raw chat objects from an NDJSON/JSONL(.gz) file (one chat per
+    line, as written by export) or a JSON array (e.g. ChatGPT's
+    conversations.json)"""
+    with _open(path) as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == '[':
+            yield from iter_json_array(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+    return datetime.fromisoformat(value)
+
+
+def _chatgpt_messages(conversation):
+    """Linearise a ChatGPT conversation tree along its current branch"""
+    mapping = conversation.get('mapping') or {}
+    node_id = conversation.get('current_node')
+    path = []
+    while node_id:
+        node = mapping.get(node_id)
+        if node is None:
+            raise InvalidChat(f"missing node {node_id}")
+        path.append(node)
+        node_id = node.get('parent')
+
+    messages = []
+    for node in reversed(path):
+        message = node.get('message')
+        if not message:
+            continue
+        role = (message.get('author') or {}).get('role')
+        content = message.get('content') or {}
+        if role not in ('user', 'assistant') or content.get('content_type') != 'text':
+            continue
+        text = '\n'.join(part for part in content.get('parts') or [] if isinstance(part, str))
+        if text.strip():
+            messages.append({
+                'role': role,
+                'content': text,
+                'timestamp': _timestamp(message.get('create_time')),
+            })
+    return messages
+
+
+def normalize_chat(raw):
+    """Convert a ChatGPT conversation or an exported chat to the import
+    shape, raising InvalidChat if it can't be loaded"""
+    if not isinstance(raw, dict):
+        raise InvalidChat("chat is not an object")
+    try:
+        if 'mapping' in raw:
+            conversation_id = raw.get('conversation_id') or raw.get('id')
+            chat = {
+                'id': f"chatgpt-{conversation_id}" if conversation_id else None,
+                'title': raw.get('title'),
+                'model': raw.get('default_model_slug'),
+                'created_at': _timestamp(raw.get('create_time')),
+                'updated_at': _timestamp(raw.get('update_time')),
+                'messages': _chatgpt_messages(raw),
+            }
+        else:
+            chat = {
+                'id': raw.get('id'),
+                'username': raw.get('username'),
+                'title': raw.get('title'),
+                'model': raw.get('model'),
+                'allowDowngrade': bool(raw.get('allowDowngrade')),
+                'created_at': _timestamp(raw.get('created_at')),
+                'updated_at': _timestamp(raw.get('updated_at')),
+                'messages': [
+                    dict(message, timestamp=_timestamp(message.get('timestamp')))
+                    for message in raw.get('messages') or []
+                ],
+            }
+    except (TypeError, ValueError, AttributeError) as e:
+        raise InvalidChat(str(e))
+    validate_chat(chat)
+    return chat
+
+
+def validate_chat(chat):
+    chat_id = chat.get('id')
+    if not isinstance(chat_id, str) or not chat_id or len(chat_id) > MAX_CHAT_ID_LENGTH:
+        raise InvalidChat(f"invalid chat id {chat_id!r}")
+    if chat.get('title') is not None and not isinstance(chat['title'], str):
+        raise InvalidChat(f"chat {chat_id}: title must be a string")
+    for seq, message in enumerate(chat['messages']):
+        if not isinstance(message, dict):
+            raise InvalidChat(f"chat {chat_id}: message {seq} is not an object")
+        if message.get('role') not in MESSAGE_ROLES:
+            raise InvalidChat(f"chat {chat_id}: message {seq} has role {message.get('role')!r}")
+        if not isinstance(message.get('content'), str):
+            raise InvalidChat(f"chat {chat_id}: message {seq} content must be a string")
@@ -0,0 +1,102 @@
+import os
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Message bodies at least this many bytes are stored compressed
+COMPRESSION_THRESHOLD = int(os.getenv('COMPRESSION_THRESHOLD', 1024))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 3))
+DICTIONARY_SIZE = int(os.getenv('COMPRESSION_DICTIONARY_SIZE', 112640))
+
+
+class MessageCodecs:
+    """Encodes message bodies as (content, content_z, codec) columns.
+
+    ``codec`` is NULL for plain text in ``content``, otherwise the bytes in
+    ``content_z`` are 'zlib', 'zstd' or 'zstd:<dictionary id>'. zstd is
+    optional; without the zstandard package new rows fall back to zlib.
+    """
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._dictionaries = {}
+        self.active_dictionary = None
+
+    def add_dictionary(self, dictionary_id, data, active=False):
+        if zstandard is None:
+            return
+        dictionary = zstandard.ZstdCompressionDict(data)
+        with self._lock:
+            self._dictionaries[dictionary_id] = dictionary
+            if active:
+                self.active_dictionary = dictionary_id
+
+    def has_dictionary(self, dictionary_id):
+        return dictionary_id in self._dictionaries
+
+    # zstd (de)compressor objects aren't thread-safe, so keep them per thread
+    def _compressor(self, dictionary_id):
+        compressors = self._local.__dict__.setdefault('compressors', {})
+        if dictionary_id not in compressors:
+            compressors[dictionary_id] = zstandard.ZstdCompressor(
+                level=COMPRESSION_LEVEL, dict_data=self._dictionaries.get(dictionary_id)
+            )
+        return compressors[dictionary_id]
+
+    def _decompressor(self, dictionary_id):
+        decompressors = self._local.__dict__.setdefault('decompressors', {})
+        if dictionary_id not in decompressors:
+            decompressors[dictionary_id] = zstandard.ZstdDecompressor(
+                dict_data=self._dictionaries.get(dictionary_id)
+            )
+        return decompressors[dictionary_id]
+
+    def encode(self, text):
+        """Return ``(content, content_z, codec)`` for a message body"""
+        raw = text.encode('utf-8')
+        if len(raw) < self.threshold:
+            return text, None, None
+
+        if zstandard is None:
+            compressed, codec = zlib.compress(raw, 6), 'zlib'
+        else:
+            dictionary_id = self.active_dictionary
+            compressed = self._compressor(dictionary_id).compress(raw)
+            codec = f"zstd:{dictionary_id}" if dictionary_id is not None else 'zstd'
+
+        if len(compressed) >= len(raw):
+            return text, None, None
+        return None, compressed, codec
+
+    def dictionary_id(self, codec):
+        """The dictionary a codec marker needs, or None"""
+        if codec and codec.startswith('zstd:'):
+            return int(codec.split(':', 1)[1])
+        return None
+
+    def decode(self, content, content_z, codec):
+        if codec is None:
+            return content
+        data = bytes(content_z)
+        if codec == 'zlib':
+            return zlib.decompress(data).decode('utf-8')
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {codec} messages")
+        return self._decompressor(self.dictionary_id(codec)).decompress(data).decode('utf-8')
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """Train a zstd dictionary from sample message bodies; returns bytes"""
+    if zstandard is None:
+        raise RuntimeError("zstandard is required to train a dictionary")
+    encoded = [sample.encode('utf-8') for sample in samples]
+    return zstandard.train_dictionary(size, encoded).as_bytes()
+
+
+codecs = MessageCodecs()
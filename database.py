@@ -1,24 +1,193 @@
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 from datetime import datetime
+import atexit
+import base64
+import hashlib
+import io
+import json
 import os
+import threading
+import uuid
 from contextlib import contextmanager
 from psycopg2 import sql
 import urllib.parse
 
-# Get the database URL and add SSL requirement
-DATABASE_URL = os.getenv("DATABASE_URL")
-if DATABASE_URL and "sslmode" not in DATABASE_URL:
-    DATABASE_URL += "?sslmode=require"
+import migrations
+import queries
+from chat_cache import chat_cache
+from invalidation import INSTANCE_ID, INVALIDATION_CHANNEL, InvalidationListener
+from compression import codecs, train_dictionary
+from db_pool import ConnectionPool
+from prepared import PreparedStatements
+from replica import ReplicaRouter
+from search import SEARCH_CONFIG, lexeme_pattern, search_text, snippet
+
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 1800))
+DB_POOL_IDLE_CHECK = float(os.getenv('DB_POOL_IDLE_CHECK', 30))
+# Off by default: schema changes run from 'python manage.py migrate'
+AUTO_MIGRATE = os.getenv('AUTO_MIGRATE', 'false').lower() == 'true'
+# 0 (the default) keeps every chat; otherwise users keep their most recent N
+CHAT_HISTORY_LIMIT = int(os.getenv('CHAT_HISTORY_LIMIT', 0))
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv('MESSAGE_PARTITIONS_AHEAD', 3))
+# 'auto' disables them on Supabase's transaction-mode pooler port (6543)
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'auto').lower()
+# Chats read per connection checkout by export_chats
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 100))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+# Bodies at least this many bytes are stored once in message_blobs
+DEDUP_THRESHOLD = int(os.getenv('DEDUP_THRESHOLD', 4096))
+# Unreferenced blobs are kept this many seconds after their last reference
+BLOB_GC_GRACE = float(os.getenv('BLOB_GC_GRACE', 3600))
+
+_pool = None
+_replica_pool = None
+_pool_lock = threading.Lock()
+
+# The per-request statements worth keeping planned on each connection.
+# INSERT_MESSAGES is left out: its array parameters don't coerce through
+# EXECUTE, and its cost is in the rows rather than the planning.
+prepared_statements = PreparedStatements({
+    'chat_publish_write': queries.PUBLISH_WRITE,
+    'chat_lock': queries.LOCK_CHAT,
+    'chat_save_metadata': queries.SAVE_CHAT_METADATA,
+    'chat_update_saved': queries.UPDATE_SAVED_CHAT,
+    'chat_insert_saved': queries.INSERT_SAVED_CHAT,
+    'chat_select_user_chats': queries.SELECT_USER_CHATS,
+    'chat_select_chat': queries.SELECT_CHAT,
+    'chat_select_messages': queries.SELECT_CHAT_MESSAGES,
+    'chat_delete_excess': queries.DELETE_EXCESS_CHATS,
+    'chat_delete_messages': queries.DELETE_CHAT_MESSAGES,
+    'chat_delete': queries.DELETE_CHAT,
+})
+
+def get_database_url():
+    """Read DATABASE_URL at call time (after load_dotenv) and require SSL"""
+    database_url = os.getenv("DATABASE_URL")
+    if database_url and "sslmode" not in database_url:
+        separator = "&" if "?" in database_url else "?"
+        database_url += f"{separator}sslmode=require"
+    return database_url
+
+def get_replica_url():
+    """DATABASE_REPLICA_URL (a read replica of DATABASE_URL), or None"""
+    replica_url = os.getenv("DATABASE_REPLICA_URL")
+    if replica_url and "sslmode" not in replica_url:
+        separator = "&" if "?" in replica_url else "?"
+        replica_url += f"{separator}sslmode=require"
+    return replica_url
+
+def _use_prepared_statements(database_url):
+    """Decided per pool from that pool's own URL"""
+    if DB_PREPARED_STATEMENTS != 'auto':
+        return DB_PREPARED_STATEMENTS == 'true'
+    return urllib.parse.urlparse(database_url or '').port != 6543
+
+def _prepared_statements_hook(database_url):
+    """on_connect for a pool whose connections mustn't prepare statements"""
+    return None if _use_prepared_statements(database_url) else prepared_statements.skip
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    get_database_url(),
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    idle_check=DB_POOL_IDLE_CHECK,
+                    keepalives=1,
+                    keepalives_idle=30,
+                    application_name="krishnaco-ai",
+                    on_connect=_prepared_statements_hook(get_database_url())
+                )
+                atexit.register(_pool.closeall)
+    return _pool
+
+def get_replica_pool():
+    global _replica_pool
+    if _replica_pool is None:
+        with _pool_lock:
+            if _replica_pool is None:
+                _replica_pool = ConnectionPool(
+                    get_replica_url(),
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    idle_check=DB_POOL_IDLE_CHECK,
+                    keepalives=1,
+                    keepalives_idle=30,
+                    application_name="krishnaco-ai-replica",
+                    on_connect=_prepared_statements_hook(get_replica_url())
+                )
+                atexit.register(_replica_pool.closeall)
+    return _replica_pool
+
+def pool_stats():
+    return _pool.stats() if _pool else {}
+
+def _measure_replica_lag():
+    """Seconds the replica's replay is behind; 0 once it has replayed
+    everything it received (or if it isn't in recovery at all)"""
+    pool = get_replica_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                END
+                """
+            )
+            lag = cur.fetchone()[0]
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
+    return float(lag) if lag is not None else None
+
+replica_router = ReplicaRouter(_measure_replica_lag)
+
+def replica_stats():
+    if not get_replica_url():
+        return {'configured': False}
+    return dict(
+        replica_router.stats(), configured=True,
+        pool=_replica_pool.stats() if _replica_pool else {}
+    )
+
+def prepared_statement_stats():
+    return prepared_statements.stats()
+
+def _execute(cur, query, params):
+    """Run a queries.* statement, as a prepared statement when possible"""
+    if prepared_statements.handles(cur, query):
+        prepared_statements.execute(cur, query, params)
+    else:
+        cur.execute(query, params)
 
 @contextmanager
 def get_db_connection():
+    """Check a connection out of the pool for the duration of the block"""
     try:
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-        return conn
+        pool = get_pool()
+        conn = pool.getconn()
     except Exception as e:
         print(f"Database connection error: {e}")
         raise
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
 
 @contextmanager
 def get_db_cursor(commit=False):
@@ -32,103 +201,1556 @@ def get_db_cursor(commit=False):
         finally:
             cursor.close()
 
+def _read_from_replica(username):
+    if not get_replica_url():
+        return False
+    if _listener is not None and not _listener.connected:
+        # Other instances' writes can't be seen, so neither can their
+        # users' sticky windows
+        return False
+    return replica_router.use_replica(username)
+
+@contextmanager
+def get_read_connection(username=None):
+    """A connection for read-only work on behalf of ``username`` (None for
+    reads not tied to one user): the read replica when one is configured
+    and replica_router allows it, otherwise the primary pool"""
+    if _read_from_replica(username):
+        pool = get_replica_pool()
+        try:
+            conn = pool.getconn()
+        except Exception as e:
+            print(f"Replica connection error, reading from primary: {e}")
+            replica_router.mark_failed()
+        else:
+            try:
+                yield conn
+            finally:
+                pool.putconn(conn)
+            return
+    with get_db_connection() as conn:
+        yield conn
+
+@contextmanager
+def get_read_cursor(username=None):
+    """get_db_cursor for read-only queries; see get_read_connection"""
+    with get_read_connection(username) as conn:
+        cursor = conn.cursor(cursor_factory=DictCursor)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+def get_direct_database_url():
+    """URL for session-level work (migrations, LISTEN) that a
+    transaction-mode pooler can't carry; defaults to DATABASE_URL"""
+    direct_url = os.getenv("DATABASE_DIRECT_URL")
+    if direct_url and "sslmode" not in direct_url:
+        separator = "&" if "?" in direct_url else "?"
+        direct_url += f"{separator}sslmode=require"
+    return direct_url or get_database_url()
+
 def init_db():
-    """Initialize database tables"""
-    with get_db_cursor(commit=True) as cursor:
-        # Create chats table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chats (
-                chat_id TEXT PRIMARY KEY,
-                username TEXT NOT NULL,
-                title TEXT,
-                model TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(chat_id, username)
-            )
-        ''')
-
-        # Create messages table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                chat_id TEXT NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES chats (chat_id) ON DELETE CASCADE
-            )
-        ''')
+    """Check the schema version, applying pending migrations if allowed"""
+    get_pool().fill()
+    with get_db_cursor() as cursor:
+        version = migrations.current_version(cursor)
+    if version < migrations.LATEST_VERSION:
+        if not AUTO_MIGRATE:
+            print(f"Database schema is at version {version}, expected "
+                  f"{migrations.LATEST_VERSION}; run 'python manage.py migrate'")
+            return
+        migrations.migrate(get_direct_database_url())
+    load_dictionaries()
 
-def save_chat(username, chat_id, chat_data):
-    try:
+def _publish_write(cur, username, chat_id=None):
+    """Bump the user's write version and notify other instances.
+
+    Runs inside the write's transaction, so the notification is delivered
+    only if (and when) the write commits. chat_id None means user-wide.
+    Also starts the user's sticky window on the primary for reads.
+    """
+    replica_router.note_write(username)
+    _execute(cur, queries.PUBLISH_WRITE, {
+        'username': username, 'channel': INVALIDATION_CHANNEL,
+        'chat_id': chat_id, 'origin': INSTANCE_ID,
+    })
+
+def get_user_version(username):
+    """The user's current write version (0 if they never wrote)"""
+    with get_db_cursor() as cursor:
+        cursor.execute("SELECT version FROM chat_versions WHERE username = %s", (username,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+chat_cache.validator = get_user_version
+_listener = None
+
+def start_invalidation_listener():
+    """Listen for other instances' writes; until connected (or if this is
+    never called) cache hits are validated against get_user_version.
+    With a read replica, their writers' reads also stick to the primary."""
+    global _listener
+    if _listener is None and (chat_cache.enabled or get_replica_url()):
+        _listener = InvalidationListener(
+            get_direct_database_url(), chat_cache, on_write=replica_router.note_write
+        ).start()
+    return _listener
+
+def invalidation_stats():
+    return _listener.stats() if _listener else {'connected': False}
+
+def default_title(messages):
+    """Title a chat after its first message, as the client used to"""
+    for message in messages:
+        if message.get('role') == 'user':
+            return message['content'][:30] + '...'
+    return 'New Chat'
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+def _chat_from_row(row, messages):
+    """Build the chat dict the client works with"""
+    return {
+        'id': row['chat_id'],
+        'title': row['title'] or 'New Chat',
+        'model': row['model'],
+        'allowDowngrade': row['allow_downgrade'],
+        'created_at': _isoformat(row['created_at']),
+        'updated_at': _isoformat(row['updated_at']),
+        'messages': messages,
+    }
+
+def _ensure_dictionary(cur, codec):
+    """Load the compression dictionary a codec needs if this process lacks it"""
+    dictionary_id = codecs.dictionary_id(codec)
+    if dictionary_id is None or codecs.has_dictionary(dictionary_id):
+        return
+    _execute(cur, queries.SELECT_DICTIONARY, {'id': dictionary_id})
+    codecs.add_dictionary(dictionary_id, bytes(cur.fetchone()[0]))
+
+def _message_from_row(row):
+    """Build a client message, decompressing its body if needed"""
+    content = codecs.decode(row['content'], row['content_z'], row['codec'])
+    message = {'role': row['role'], 'content': content}
+    if row['downgraded']:
+        message['model'] = row['model']
+        message['downgraded'] = True
+    return message
+
+def _blob_hash(text):
+    """SHA-256 of a body big enough to deduplicate, else None"""
+    raw = text.encode('utf-8')
+    if len(raw) < DEDUP_THRESHOLD:
+        return None
+    return hashlib.sha256(raw).digest()
+
+def _message_params(chat_id, first_seq, messages, branch_id=None):
+    """Parameters for queries.INSERT_MESSAGES, and the blobs they reference
+    as ``{hash: [body, references]}``"""
+    params = {
+        'chat_id': chat_id, 'branch_id': branch_id, 'first_seq': first_seq,
+        'roles': [], 'contents': [], 'contents_z': [], 'codecs': [],
+        'blob_hashes': [], 'models': [], 'downgraded': [], 'bodies': [],
+    }
+    blobs = {}
+    for message in messages:
+        blob_hash = _blob_hash(message['content'])
+        if blob_hash is None:
+            content, content_z, codec = codecs.encode(message['content'])
+        else:
+            content, content_z, codec = None, None, None
+            blobs.setdefault(blob_hash, [message['content'], 0])[1] += 1
+        params['roles'].append(message['role'])
+        params['contents'].append(content)
+        params['contents_z'].append(content_z)
+        params['codecs'].append(codec)
+        params['blob_hashes'].append(blob_hash)
+        params['models'].append(message.get('model'))
+        params['downgraded'].append(bool(message.get('downgraded')))
+        params['bodies'].append(search_text(message['content']))
+    return params, blobs
+
+def _reference_params(blobs):
+    """Parameters for queries.REFERENCE_BLOBS, in hash order so concurrent
+    writers lock blob rows in the same order"""
+    hashes = sorted(blobs)
+    return {'hashes': hashes, 'counts': [blobs[blob_hash][1] for blob_hash in hashes]}
+
+def _new_blob_params(blobs, missing):
+    """Parameters for queries.INSERT_BLOBS for the blobs not stored yet"""
+    params = {
+        'hashes': [], 'contents': [], 'contents_z': [], 'codecs': [],
+        'sizes': [], 'counts': [],
+    }
+    for blob_hash in sorted(missing):
+        body, count = blobs[blob_hash]
+        content, content_z, codec = codecs.encode(body)
+        params['hashes'].append(blob_hash)
+        params['contents'].append(content)
+        params['contents_z'].append(content_z)
+        params['codecs'].append(codec)
+        params['sizes'].append(len(body.encode('utf-8')))
+        params['counts'].append(count)
+    return params
+
+def _store_blobs(cur, blobs):
+    """Reference the blobs that already exist and write only the new ones"""
+    if not blobs:
+        return
+    _execute(cur, queries.REFERENCE_BLOBS, _reference_params(blobs))
+    missing = blobs.keys() - {bytes(row[0]) for row in cur.fetchall()}
+    if missing:
+        _execute(cur, queries.INSERT_BLOBS, _new_blob_params(blobs, missing))
+
+def _insert_messages(cur, chat_id, first_seq, messages, branch_id=None):
+    """Append message rows starting at sequence number first_seq"""
+    if messages:
+        params, blobs = _message_params(chat_id, first_seq, messages, branch_id)
+        _store_blobs(cur, blobs)
+        _execute(cur, queries.INSERT_MESSAGES, params)
+
+def _lock_chat(cur, username, chat_id):
+    """Lock a chat row for update, migrating a legacy blob first.
+
+    Returns the locked row or None if the chat doesn't exist.
+    """
+    params = {'chat_id': chat_id, 'username': username}
+    _execute(cur, queries.LOCK_CHAT, params)
+    row = cur.fetchone()
+    if row and row['chat_data'] is not None:
+        _backfill_chat(cur, row)
+        _execute(cur, queries.LOCK_CHAT, params)
+        row = cur.fetchone()
+    return row
+
+def _backfill_params(row):
+    """The legacy blob's messages and the queries.BACKFILL_CHAT parameters"""
+    chat_data = json.loads(row['chat_data'])
+    messages = chat_data.get('messages', [])
+    return messages, {
+        'chat_id': row['chat_id'],
+        'title': chat_data.get('title'),
+        'model': chat_data.get('model'),
+        'allow_downgrade': bool(chat_data.get('allowDowngrade')),
+        'added': len(messages),
+    }
+
+def _backfill_chat(cur, row):
+    """Move a legacy chat_data blob into message rows and metadata columns"""
+    messages, params = _backfill_params(row)
+    _insert_messages(cur, row['chat_id'], row['message_count'], messages)
+    _execute(cur, queries.BACKFILL_CHAT, params)
+
+def backfill_messages(batch_size=100):
+    """Migrate every legacy chat_data blob into message rows, in batches.
+
+    Each batch is one transaction; locked chats are skipped and picked up
+    by a later batch. Returns the number of chats migrated.
+    """
+    migrated = 0
+    while True:
         with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                # Check if chat exists
+            with conn.cursor(cursor_factory=DictCursor) as cur:
                 cur.execute(
-                    "SELECT id FROM chats WHERE chat_id = %s AND username = %s",
-                    (chat_id, username)
+                    """
+                    SELECT chat_id, message_count, chat_data
+                    FROM chats
+                    WHERE chat_data IS NOT NULL
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    (batch_size,)
                 )
-                result = cur.fetchone()
-                
-                if result:
-                    # Update existing chat
-                    cur.execute(
-                        """
-                        UPDATE chats 
-                        SET chat_data = %s, updated_at = NOW()
-                        WHERE chat_id = %s AND username = %s
-                        """,
-                        (json.dumps(chat_data), chat_id, username)
-                    )
+                rows = cur.fetchall()
+                for row in rows:
+                    _backfill_chat(cur, row)
+                conn.commit()
+        migrated += len(rows)
+        if len(rows) < batch_size:
+            return migrated
+        print(f"Backfilled {migrated} chats")
+
+def _chat_params(username, chat_id, chat_data, added=0):
+    """Parameters for the chat upsert/update/insert queries"""
+    return {
+        'chat_id': chat_id,
+        'username': username,
+        'title': chat_data.get('title'),
+        'model': chat_data.get('model'),
+        'allow_downgrade': chat_data.get('allowDowngrade'),
+        'created_at': chat_data.get('created_at'),
+        'added': added,
+    }
+
+def save_chat_metadata(username, chat_id, chat_data):
+    """Create or update a chat's metadata in a single upsert.
+
+    Fields missing from chat_data are left unchanged; a chat id owned by
+    another user is never overwritten.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            _execute(cur, queries.SAVE_CHAT_METADATA, _chat_params(username, chat_id, chat_data))
+            _publish_write(cur, username, chat_id)
+            conn.commit()
+    chat_cache.invalidate_chat(username, chat_id)
+
+def save_chat(username, chat_id, chat_data):
+    """Save chat metadata and append any messages not stored yet"""
+    messages = chat_data.get('messages', [])
+    try:
+        if not messages:
+            save_chat_metadata(username, chat_id, chat_data)
+            return
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                row = _lock_chat(cur, username, chat_id)
+                stored = row['message_count'] if row else 0
+                new_messages = messages[stored:]
+
+                params = _chat_params(username, chat_id, chat_data, len(new_messages))
+                if row:
+                    _execute(cur, queries.UPDATE_SAVED_CHAT, params)
                 else:
-                    # Insert new chat
-                    cur.execute(
-                        """
-                        INSERT INTO chats (chat_id, username, chat_data)
-                        VALUES (%s, %s, %s)
-                        """,
-                        (chat_id, username, json.dumps(chat_data))
-                    )
+                    params['allow_downgrade'] = bool(params['allow_downgrade'])
+                    _execute(cur, queries.INSERT_SAVED_CHAT, params)
+                _insert_messages(cur, chat_id, stored, new_messages)
+                _publish_write(cur, username, chat_id)
                 conn.commit()
+        chat_cache.invalidate_chat(username, chat_id)
     except Exception as e:
         print(f"Error saving chat: {e}")
         raise
 
-def get_user_chats(username):
+def append_messages(username, chat_id, messages, model=None):
+    """Append messages to a chat in one transaction, creating it if needed.
+
+    Returns the chat metadata (without messages).
+    """
     try:
         with get_db_connection() as conn:
-            with conn.cursor() as cur:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                row = _lock_chat(cur, username, chat_id)
+                if row is None:
+                    _execute(cur, queries.INSERT_NEW_CHAT,
+                             {'chat_id': chat_id, 'username': username, 'model': model})
+                    stored, title = 0, 'New Chat'
+                else:
+                    stored, title = row['message_count'], row['title']
+
+                if not title or title == 'New Chat':
+                    title = default_title(messages)
+
+                _insert_messages(cur, chat_id, stored, messages)
+                _execute(cur, queries.UPDATE_APPENDED_CHAT, {
+                    'chat_id': chat_id, 'title': title, 'model': model,
+                    'added': len(messages),
+                })
+                chat = _chat_from_row(cur.fetchone(), None)
+                del chat['messages']
+                _publish_write(cur, username, chat_id)
+                conn.commit()
+        chat_cache.invalidate_chat(username, chat_id)
+        return chat
+    except Exception as e:
+        print(f"Error appending messages: {e}")
+        raise
+
+def _chats_with_messages(rows, message_rows):
+    """Combine chat rows with their message rows (dictionaries loaded)"""
+    messages = {}
+    for message in message_rows:
+        messages.setdefault(message['chat_id'], []).append(_message_from_row(message))
+
+    chats = []
+    for row in rows:
+        chat_messages = messages.get(row['chat_id'], [])
+        if row['chat_data'] is not None:
+            # Not backfilled yet: messages are still in the legacy blob
+            chat_messages = json.loads(row['chat_data']).get('messages', [])
+        chats.append(_chat_from_row(row, chat_messages))
+    return chats
+
+def _load_chats(cur, query, params):
+    """Load the chats ``query`` selects with their messages, in its order"""
+    _execute(cur, query, params)
+    rows = cur.fetchall()
+    if not rows:
+        return []
+
+    _execute(cur, queries.SELECT_CHAT_MESSAGES, {'chat_ids': [row['chat_id'] for row in rows]})
+    message_rows = cur.fetchall()
+    for message in message_rows:
+        _ensure_dictionary(cur, message['codec'])
+    return _chats_with_messages(rows, message_rows)
+
+class BranchError(ValueError):
+    """Raised for a fork point or branch that doesn't exist in the chat"""
+
+# Errors a retry can't fix (e.g. saving into a chat id owned by another user)
+PERMANENT_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError)
+
+def _branch_from_row(row):
+    return {
+        'id': row['branch_id'],
+        'parent_branch_id': row['parent_branch_id'],
+        'fork_seq': row['fork_seq'],
+        'message_count': row['message_count'],
+        'title': row['title'],
+        'created_at': _isoformat(row['created_at']),
+        'updated_at': _isoformat(row['updated_at']),
+    }
+
+def fork_chat(username, chat_id, at_seq, parent_branch_id=None, title=None):
+    """Start a branch that shares the parent line's messages below
+    ``at_seq``; the branch's first own message will have seq ``at_seq``.
+
+    The parent is the main line unless ``parent_branch_id`` is given.
+    Nothing is copied, so a fork is one row whatever the chat's length.
+    Returns the new branch.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            row = _lock_chat(cur, username, chat_id)
+            if row is None:
+                raise BranchError(f"chat {chat_id} not found")
+            if parent_branch_id is None:
+                length = row['message_count']
+            else:
+                _execute(cur, queries.LOCK_BRANCH,
+                         {'branch_id': parent_branch_id, 'chat_id': chat_id})
+                parent = cur.fetchone()
+                if parent is None:
+                    raise BranchError(f"branch {parent_branch_id} not found")
+                length = parent['fork_seq'] + parent['message_count']
+            if not 0 <= at_seq <= length:
+                raise BranchError(f"fork point {at_seq} is outside 0..{length}")
+
+            _execute(cur, queries.INSERT_BRANCH, {
+                'branch_id': uuid.uuid4().hex, 'chat_id': chat_id,
+                'parent_branch_id': parent_branch_id, 'fork_seq': at_seq,
+                'title': title,
+            })
+            branch = _branch_from_row(cur.fetchone())
+            _publish_write(cur, username, chat_id)
+            conn.commit()
+    chat_cache.invalidate_chat(username, chat_id)
+    return branch
+
+def _read_branches(username, chat_id):
+    with get_read_connection(username) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            _execute(cur, queries.SELECT_CHAT, {'chat_id': chat_id, 'username': username})
+            if cur.fetchone() is None:
+                return None
+            _execute(cur, queries.SELECT_BRANCHES, {'chat_id': chat_id})
+            return [_branch_from_row(row) for row in cur.fetchall()]
+
+def list_branches(username, chat_id):
+    """A chat's branches, oldest first, or None if the chat doesn't exist"""
+    return chat_cache.get(
+        (username, chat_id, 'branches'),
+        lambda: _read_branches(username, chat_id)
+    )
+
+def _read_branch_history(username, chat_id, branch_id):
+    with get_read_connection(username) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            _execute(cur, queries.SELECT_CHAT, {'chat_id': chat_id, 'username': username})
+            if cur.fetchone() is None:
+                return None
+            _execute(cur, queries.FIND_BRANCH, {'branch_id': branch_id, 'chat_id': chat_id})
+            if cur.fetchone() is None:
+                return None
+            _execute(cur, queries.SELECT_BRANCH_MESSAGES,
+                     {'chat_id': chat_id, 'branch_id': branch_id})
+            rows = cur.fetchall()
+            for row in rows:
+                _ensure_dictionary(cur, row['codec'])
+            return [dict(_message_from_row(row), seq=row['seq']) for row in rows]
+
+def get_branch_history(username, chat_id, branch_id):
+    """A branch's full linear history (inherited messages first), or None
+    if the chat or branch doesn't exist"""
+    return chat_cache.get(
+        (username, chat_id, 'branch', branch_id),
+        lambda: _read_branch_history(username, chat_id, branch_id)
+    )
+
+def append_branch_messages(username, chat_id, branch_id, messages):
+    """Append messages to a branch; returns the updated branch"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            # The chat lock orders this with forks and main-line appends
+            if _lock_chat(cur, username, chat_id) is None:
+                raise BranchError(f"chat {chat_id} not found")
+            _execute(cur, queries.LOCK_BRANCH, {'branch_id': branch_id, 'chat_id': chat_id})
+            branch = cur.fetchone()
+            if branch is None:
+                raise BranchError(f"branch {branch_id} not found")
+            _insert_messages(
+                cur, chat_id, branch['fork_seq'] + branch['message_count'], messages, branch_id
+            )
+            _execute(cur, queries.UPDATE_BRANCH_COUNT,
+                     {'branch_id': branch_id, 'added': len(messages)})
+            branch = _branch_from_row(cur.fetchone())
+            _execute(cur, queries.TOUCH_CHAT, {'chat_id': chat_id})
+            _publish_write(cur, username, chat_id)
+            conn.commit()
+    chat_cache.invalidate_chat(username, chat_id)
+    return branch
+
+def _messages_window(cur, row, limit, before=None):
+    """Latest ``limit`` messages of a chat older than seq ``before``.
+
+    Returns ``(messages, before_cursor)``; the cursor is None once the start
+    of the chat has been reached.
+    """
+    if row['chat_data'] is not None:
+        # Not backfilled yet: window over the legacy blob
+        messages = json.loads(row['chat_data']).get('messages', [])
+        end = len(messages) if before is None else min(before, len(messages))
+        start = max(0, end - limit)
+        window = [dict(message, seq=start + offset) for offset, message in enumerate(messages[start:end])]
+        return window, (start if start > 0 else None)
+
+    _execute(cur, queries.SELECT_CHAT_WINDOW,
+             {'chat_id': row['chat_id'], 'before': before, 'limit': limit + 1})
+    rows = cur.fetchall()
+    for message in rows:
+        _ensure_dictionary(cur, message['codec'])
+    has_more = len(rows) > limit
+    rows = list(reversed(rows[:limit]))
+    window = [dict(_message_from_row(message), seq=message['seq']) for message in rows]
+    return window, (rows[0]['seq'] if has_more else None)
+
+def _read_chat_window(username, chat_id, limit, before):
+    """Load a chat's metadata with only its latest messages.
+
+    ``before`` in the result is the cursor for get_chat_window/older pages,
+    or None if every message has been returned. Returns None if the chat
+    doesn't exist.
+    """
+    try:
+        with get_read_connection(username) as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
                 cur.execute(
                     """
-                    SELECT chat_id, chat_data
+                    SELECT chat_id, title, model, allow_downgrade, created_at,
+                           updated_at, chat_data
                     FROM chats
-                    WHERE username = %s
-                    ORDER BY updated_at DESC
+                    WHERE chat_id = %s AND username = %s
                     """,
-                    (username,)
-                )
-                results = cur.fetchall()
-                
-                chats = {}
-                for chat_id, chat_data in results:
-                    chats[chat_id] = json.loads(chat_data)
-                return chats
+                    (chat_id, username)
+                )
+                row = cur.fetchone()
+                if row is None:
+                    return None
+                messages, before = _messages_window(cur, row, limit, before)
+                chat = _chat_from_row(row, messages)
+                chat['before'] = before
+                return chat
+    except Exception as e:
+        print(f"Error getting chat window: {e}")
+        raise
+
+def _read_chat(username, chat_id):
+    try:
+        with get_read_connection(username) as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                chats = _load_chats(
+                    cur, queries.SELECT_CHAT, {'chat_id': chat_id, 'username': username}
+                )
+                return chats[0] if chats else None
+    except Exception as e:
+        print(f"Error getting chat: {e}")
+        raise
+
+def _encode_cursor(updated_at, chat_id):
+    raw = json.dumps([updated_at.isoformat(), chat_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    """ValueError if ``cursor`` isn't one _encode_cursor produced"""
+    try:
+        updated_at, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(chat_id, str):
+            raise TypeError
+        return datetime.fromisoformat(updated_at), chat_id
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor") from None
+
+def _read_chat_summaries(username, limit, cursor):
+    """One page of a user's chats, newest first, without messages.
+
+    Uses keyset pagination on (updated_at, chat_id); pass the returned
+    ``next_cursor`` to get the following page.
+    """
+    query = queries.SELECT_CHAT_SUMMARIES
+    params = {'username': username, 'limit': limit + 1}
+    if cursor:
+        query = queries.SELECT_CHAT_SUMMARIES_AFTER
+        params['updated_at'], params['chat_id'] = _decode_cursor(cursor)
+
+    try:
+        with get_read_connection(username) as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                _execute(cur, query, params)
+                rows = cur.fetchall()
+    except Exception as e:
+        print(f"Error getting chat summaries: {e}")
+        raise
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]['updated_at'], rows[-1]['chat_id'])
+    return {
+        'chats': [
+            {
+                'id': row['chat_id'],
+                'title': row['title'] or 'New Chat',
+                'model': row['model'],
+                'message_count': row['message_count'],
+                'updated_at': _isoformat(row['updated_at']),
+            }
+            for row in rows
+        ],
+        'next_cursor': next_cursor,
+    }
+
+def _read_user_chats(username):
+    try:
+        with get_read_connection(username) as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                chats = _load_chats(cur, queries.SELECT_USER_CHATS, {'username': username})
+                return {chat['id']: chat for chat in chats}
     except Exception as e:
         print(f"Error getting chats: {e}")
         raise
         
-def delete_old_chats(username):
-    """Delete oldest chats keeping only the most recent 20"""
+def get_chat_window(username, chat_id, limit=50, before=None):
+    return chat_cache.get(
+        (username, chat_id, 'window', limit, before),
+        lambda: _read_chat_window(username, chat_id, limit, before)
+    )
+
+def get_chat(username, chat_id):
+    """Load one chat with its messages, or None if it doesn't exist"""
+    return chat_cache.get(
+        (username, chat_id, 'chat'),
+        lambda: _read_chat(username, chat_id)
+    )
+
+def get_chat_summaries(username, limit=50, cursor=None):
+    return chat_cache.get(
+        (username, None, 'summaries', limit, cursor),
+        lambda: _read_chat_summaries(username, limit, cursor)
+    )
+
+def get_user_chats(username):
+    return chat_cache.get(
+        (username, None, 'all'),
+        lambda: _read_user_chats(username)
+    )
+
+def warm_chat_cache(username):
+    """Preload a user's first sidebar page and most recent chat"""
+    try:
+        page = get_chat_summaries(username)
+        if page['chats']:
+            get_chat_window(username, page['chats'][0]['id'])
+    except Exception as e:
+        print(f"Error warming chat cache: {e}")
+
+def export_chats(username=None, after=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield complete chats (with messages and username) in chat_id order.
+
+    Reads ``batch_size`` chats at a time by keyset on chat_id, returning the
+    connection to the pool between batches, so a slow download holds
+    neither a connection nor an open transaction. Each chat is consistent
+    but the export as a whole is not one snapshot. ``username`` None
+    exports every user; ``after`` resumes after that chat id. Runs on the
+    read replica when allowed.
+    """
+    while True:
+        with get_read_connection(username) as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                _execute(cur, queries.EXPORT_CHATS,
+                         {'username': username, 'after': after, 'limit': batch_size})
+                chats = []
+                for row in cur:
+                    if not chats or row['chat_id'] != chats[-1]['id']:
+                        chat = _chat_from_row(
+                            dict(row, title=row['chat_title'], model=row['chat_model']), []
+                        )
+                        chat['username'] = row['username']
+                        if row['chat_data'] is not None:
+                            # Not backfilled yet: messages are still in the legacy blob
+                            chat['messages'] = json.loads(row['chat_data']).get('messages', [])
+                        chats.append(chat)
+                    if row['role'] is not None and row['chat_data'] is None:
+                        _ensure_dictionary(cur, row['codec'])
+                        chats[-1]['messages'].append(_message_from_row(row))
+        yield from chats
+        if len(chats) < batch_size:
+            return
+        after = chats[-1]['id']
+
+def _copy_value(value):
+    """Format a value for COPY's text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def _copy_rows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+def _import_batch(cur, default_username, chats):
+    """COPY one batch into the staging tables and merge it. Chats whose id
+    already exists are skipped whole, which makes re-runs idempotent.
+
+    Returns ``(chats inserted, messages inserted, usernames written)``.
+    """
+    chat_rows, message_rows, blobs = [], [], {}
+    for chat in chats:
+        username = default_username or chat.get('username')
+        updated_at = chat.get('updated_at') or chat.get('created_at')
+        chat_rows.append((
+            chat['id'], username, chat.get('title') or default_title(chat['messages']),
+            chat.get('model'), bool(chat.get('allowDowngrade')), len(chat['messages']),
+            chat.get('created_at') or updated_at, updated_at
+        ))
+        for seq, message in enumerate(chat['messages']):
+            blob_hash = _blob_hash(message['content'])
+            if blob_hash is None:
+                content, content_z, codec = codecs.encode(message['content'])
+            else:
+                content, content_z, codec = None, None, None
+                blobs.setdefault(blob_hash, [message['content'], 0])[1] += 1
+            message_rows.append((
+                chat['id'], seq, message['role'], content, content_z, codec, blob_hash,
+                message.get('model'), bool(message.get('downgraded')),
+                message.get('timestamp') or updated_at, search_text(message['content'])
+            ))
+    blob_params = _new_blob_params(blobs, blobs)
+
+    cur.execute("TRUNCATE import_chats, import_messages, import_blobs")
+    _copy_rows(cur, 'import_chats', (
+        'chat_id', 'username', 'title', 'model', 'allow_downgrade',
+        'message_count', 'created_at', 'updated_at'
+    ), chat_rows)
+    _copy_rows(cur, 'import_messages', (
+        'chat_id', 'seq', 'role', 'content', 'content_z', 'codec', 'blob_hash',
+        'model', 'downgraded', 'timestamp', 'search_text'
+    ), message_rows)
+    _copy_rows(cur, 'import_blobs', ('hash', 'content', 'content_z', 'codec', 'size'), zip(
+        blob_params['hashes'], blob_params['contents'], blob_params['contents_z'],
+        blob_params['codecs'], blob_params['sizes']
+    ))
+    cur.execute(
+        """
+        WITH inserted AS (
+            INSERT INTO chats
+                (chat_id, username, title, model, allow_downgrade, message_count,
+                 created_at, updated_at)
+            SELECT chat_id, username, title, model, allow_downgrade, message_count,
+                   COALESCE(created_at, NOW()), COALESCE(updated_at, NOW())
+            FROM import_chats
+            ON CONFLICT (chat_id) DO NOTHING
+            RETURNING chat_id, username
+        ), messages_inserted AS (
+            INSERT INTO messages
+                (chat_id, seq, role, content, content_z, codec, blob_hash,
+                 model, downgraded, timestamp, search_vector)
+            SELECT m.chat_id, m.seq, m.role, m.content, m.content_z, m.codec,
+                   m.blob_hash, m.model, m.downgraded, COALESCE(m.timestamp, NOW()),
+                   to_tsvector(%s, m.search_text)
+            FROM import_messages m
+            JOIN inserted USING (chat_id)
+            RETURNING blob_hash
+        ), blobs_referenced AS (
+            -- Only messages of chats actually inserted count as references
+            INSERT INTO message_blobs (hash, content, content_z, codec, size, refcount)
+            SELECT b.hash, b.content, b.content_z, b.codec, b.size, r.n
+            FROM (
+                SELECT blob_hash, count(*) AS n
+                FROM messages_inserted
+                WHERE blob_hash IS NOT NULL
+                GROUP BY blob_hash
+            ) r
+            JOIN import_blobs b ON b.hash = r.blob_hash
+            ORDER BY b.hash
+            ON CONFLICT (hash) DO UPDATE
+            SET refcount = message_blobs.refcount + EXCLUDED.refcount,
+                last_referenced_at = NOW()
+        )
+        SELECT (SELECT count(*) FROM inserted),
+               (SELECT count(*) FROM messages_inserted),
+               (SELECT array_agg(DISTINCT username) FROM inserted)
+        """,
+        (SEARCH_CONFIG,)
+    )
+    inserted_chats, inserted_messages, usernames = cur.fetchone()
+    for username in usernames or []:
+        _publish_write(cur, username)
+    return inserted_chats, inserted_messages, usernames or []
+
+def import_chats(chats, username=None, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """Bulk-load normalised chats (see chat_import) for ``username``, or
+    each chat's own ``username`` if None.
+
+    Batches of ``batch_size`` chats are COPYed into session temp tables
+    and merged in one statement per batch, each in its own transaction.
+    Uses a dedicated direct connection because temp tables need a real
+    session. ``progress(stats)`` is called after every batch. Returns the
+    final stats dict.
+    """
+    stats = {'read': 0, 'chats': 0, 'messages': 0, 'skipped': 0}
+    seen = set()
+    conn = psycopg2.connect(get_direct_database_url(), application_name="krishnaco-ai-import")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMP TABLE import_chats (
+                    chat_id TEXT, username TEXT, title TEXT, model TEXT,
+                    allow_downgrade BOOLEAN, message_count INTEGER,
+                    created_at TIMESTAMP, updated_at TIMESTAMP
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TEMP TABLE import_messages (
+                    chat_id TEXT, seq INTEGER, role TEXT, content TEXT,
+                    content_z BYTEA, codec TEXT, blob_hash BYTEA, model TEXT,
+                    downgraded BOOLEAN, timestamp TIMESTAMP, search_text TEXT
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TEMP TABLE import_blobs (
+                    hash BYTEA, content TEXT, content_z BYTEA, codec TEXT,
+                    size INTEGER
+                )
+                """
+            )
+            conn.commit()
+
+            def flush(batch):
+                chats_inserted, messages_inserted, usernames = _import_batch(cur, username, batch)
+                conn.commit()
+                for name in usernames:
+                    chat_cache.invalidate_user(name)
+                stats['chats'] += chats_inserted
+                stats['messages'] += messages_inserted
+                stats['skipped'] += len(batch) - chats_inserted
+                if progress:
+                    progress(dict(stats))
+
+            batch = []
+            for chat in chats:
+                stats['read'] += 1
+                if chat['id'] in seen or not (username or chat.get('username')):
+                    stats['skipped'] += 1
+                    continue
+                seen.add(chat['id'])
+                batch.append(chat)
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+    finally:
+        conn.close()
+    # Old messages land in the default partition; move them into months
+    ensure_message_partitions()
+    return stats
+
+def _encode_search_cursor(rank, chat_id, branch_key, seq):
+    raw = json.dumps([rank, chat_id, branch_key, seq])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_search_cursor(cursor):
+    """ValueError if ``cursor`` isn't one _encode_search_cursor produced"""
+    try:
+        rank, chat_id, branch_key, seq = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor") from None
+    if (not isinstance(rank, (int, float)) or isinstance(rank, bool)
+            or not isinstance(chat_id, str) or not isinstance(branch_key, str)
+            or not isinstance(seq, int) or isinstance(seq, bool)):
+        raise ValueError("Invalid cursor")
+    return rank, chat_id, branch_key, seq
+
+def search_messages(username, query, limit=20, cursor=None):
+    """Full-text search over a user's messages, best matches first.
+
+    ``query`` uses web search syntax ("quoted phrases", -exclusions, or).
+    Each result carries a snippet with ``[start, end]`` highlight offsets
+    into the snippet text. Paginates by keyset on (rank, chat_id, branch,
+    seq), with '' standing for the main line since branches repeat seqs;
+    pass ``next_cursor`` back to continue.
+    """
+    params = {
+        'config': SEARCH_CONFIG, 'query': query, 'username': username,
+        'limit': limit + 1,
+    }
+    after = ""
+    if cursor:
+        after = """
+            WHERE (rank, chat_id, branch_key, seq)
+                < (%(rank)s::real, %(chat_id)s, %(branch_key)s, %(seq)s)
+        """
+        (params['rank'], params['chat_id'], params['branch_key'],
+         params['seq']) = _decode_search_cursor(cursor)
+
+    with get_read_connection(username) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(
+                "SELECT tsvector_to_array(to_tsvector(%s, %s))",
+                (SEARCH_CONFIG, query)
+            )
+            pattern = lexeme_pattern(cur.fetchone()[0])
+            cur.execute(
+                f"""
+                SELECT * FROM (
+                    SELECT m.chat_id, m.branch_id, COALESCE(m.branch_id, '') AS branch_key,
+                           m.seq, m.role, {queries.MESSAGE_BODY},
+                           m.model, m.downgraded, m.timestamp,
+                           c.title,
+                           ts_rank_cd(m.search_vector, q.query) AS rank
+                    FROM websearch_to_tsquery(%(config)s, %(query)s) AS q (query)
+                    JOIN messages m ON m.search_vector @@ q.query
+                    JOIN chats c ON c.chat_id = m.chat_id
+                    LEFT JOIN message_blobs b ON b.hash = m.blob_hash
+                    WHERE c.username = %(username)s
+                ) ranked
+                {after}
+                ORDER BY rank DESC, chat_id DESC, branch_key DESC, seq DESC
+                LIMIT %(limit)s
+                """,
+                params
+            )
+            rows = cur.fetchall()
+            results = []
+            for row in rows[:limit]:
+                _ensure_dictionary(cur, row['codec'])
+                message = _message_from_row(row)
+                results.append({
+                    'chat_id': row['chat_id'],
+                    'chat_title': row['title'] or 'New Chat',
+                    'branch_id': row['branch_id'],
+                    'seq': row['seq'],
+                    'role': message['role'],
+                    'timestamp': _isoformat(row['timestamp']),
+                    'rank': row['rank'],
+                    'snippet': snippet(message['content'], pattern),
+                })
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = _encode_search_cursor(
+            last['rank'], last['chat_id'], last['branch_key'], last['seq']
+        )
+    return {'results': results, 'next_cursor': next_cursor}
+
+def search_chat_titles(username, query, limit=10):
+    """A user's chats whose title contains ``query``, most similar first"""
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    with get_read_cursor(username) as cursor:
+        cursor.execute(
+            """
+            SELECT chat_id, title, updated_at, similarity(title, %s) AS score
+            FROM chats
+            WHERE username = %s AND title ILIKE %s
+            ORDER BY score DESC, updated_at DESC
+            LIMIT %s
+            """,
+            (query, username, pattern, limit)
+        )
+        return [
+            {
+                'id': row['chat_id'],
+                'title': row['title'],
+                'updated_at': _isoformat(row['updated_at']),
+            }
+            for row in cursor.fetchall()
+        ]
+
+def index_messages(batch_size=500):
+    """Fill search_vector for messages stored before search existed, in
+    batches. Returns the number of messages indexed."""
+    indexed = 0
+    last_id = 0
+    while True:
+        with get_db_cursor(commit=True) as cursor:
+            cursor.execute(
+                f"""
+                SELECT m.id, m.timestamp, {queries.MESSAGE_BODY}
+                FROM messages m
+                LEFT JOIN message_blobs b ON b.hash = m.blob_hash
+                WHERE m.id > %s AND m.search_vector IS NULL
+                ORDER BY m.id
+                LIMIT %s
+                """,
+                (last_id, batch_size)
+            )
+            rows = cursor.fetchall()
+            updates = []
+            for row in rows:
+                _ensure_dictionary(cursor, row['codec'])
+                content = codecs.decode(row['content'], row['content_z'], row['codec'])
+                updates.append((row['id'], row['timestamp'], search_text(content)))
+            if updates:
+                execute_values(
+                    cursor,
+                    f"""
+                    UPDATE messages AS m
+                    SET search_vector = to_tsvector('{SEARCH_CONFIG}', v.body)
+                    FROM (VALUES %s) AS v (id, timestamp, body)
+                    WHERE m.id = v.id AND m.timestamp = v.timestamp
+                    """,
+                    updates
+                )
+        indexed += len(rows)
+        if len(rows) < batch_size:
+            return indexed
+        last_id = rows[-1]['id']
+
+def load_dictionaries():
+    """Load stored zstd dictionaries; the newest active one encodes new rows"""
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            "SELECT id, dictionary, active FROM compression_dictionaries ORDER BY id"
+        )
+        for row in cursor.fetchall():
+            codecs.add_dictionary(row['id'], bytes(row['dictionary']), active=row['active'])
+
+def train_compression_dictionary(sample_limit=5000):
+    """Train a zstd dictionary on a random sample of stored messages and
+    make it the active one. Returns the new dictionary id."""
+    with get_db_cursor(commit=True) as cursor:
+        cursor.execute(
+            f"""
+            SELECT {queries.MESSAGE_BODY}
+            FROM messages m
+            LEFT JOIN message_blobs b ON b.hash = m.blob_hash
+            ORDER BY random()
+            LIMIT %s
+            """,
+            (sample_limit,)
+        )
+        samples = []
+        for row in cursor.fetchall():
+            _ensure_dictionary(cursor, row['codec'])
+            samples.append(codecs.decode(row['content'], row['content_z'], row['codec']))
+        dictionary = train_dictionary(samples)
+
+        cursor.execute("UPDATE compression_dictionaries SET active = FALSE WHERE active")
+        cursor.execute(
+            """
+            INSERT INTO compression_dictionaries (dictionary, sample_count, active)
+            VALUES (%s, %s, TRUE)
+            RETURNING id
+            """,
+            (psycopg2.Binary(dictionary), len(samples))
+        )
+        dictionary_id = cursor.fetchone()[0]
+    codecs.add_dictionary(dictionary_id, dictionary, active=True)
+    return dictionary_id
+
+def compress_messages(batch_size=500):
+    """Compress stored plain-text bodies above the threshold, in batches.
+
+    Returns the number of messages rewritten.
+    """
+    compressed = 0
+    last_id = 0
+    while True:
+        with get_db_cursor(commit=True) as cursor:
+            cursor.execute(
+                """
+                SELECT id, content FROM messages
+                WHERE id > %s AND codec IS NULL
+                  AND octet_length(content) >= %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (last_id, codecs.threshold, batch_size)
+            )
+            rows = cursor.fetchall()
+            updates = []
+            for row in rows:
+                content, content_z, codec = codecs.encode(row['content'])
+                if codec is not None:
+                    updates.append((row['id'], psycopg2.Binary(content_z), codec))
+            if updates:
+                execute_values(
+                    cursor,
+                    """
+                    UPDATE messages AS m
+                    SET content = NULL, content_z = v.content_z, codec = v.codec
+                    FROM (VALUES %s) AS v (id, content_z, codec)
+                    WHERE m.id = v.id
+                    """,
+                    updates
+                )
+        compressed += len(updates)
+        if len(rows) < batch_size:
+            return compressed
+        last_id = rows[-1]['id']
+
+def dedupe_messages(batch_size=500):
+    """Move stored bodies at or above DEDUP_THRESHOLD into message_blobs,
+    in batches. Returns the number of messages rewritten."""
+    deduped = 0
+    last_id = 0
+    while True:
+        with get_db_cursor(commit=True) as cursor:
+            cursor.execute(
+                """
+                SELECT id, timestamp, content, content_z, codec FROM messages
+                WHERE id > %s AND blob_hash IS NULL
+                  AND (content_z IS NOT NULL OR octet_length(content) >= %s)
+                ORDER BY id
+                LIMIT %s
+                """,
+                (last_id, DEDUP_THRESHOLD, batch_size)
+            )
+            rows = cursor.fetchall()
+            blobs, updates = {}, []
+            for row in rows:
+                _ensure_dictionary(cursor, row['codec'])
+                content = codecs.decode(row['content'], row['content_z'], row['codec'])
+                blob_hash = _blob_hash(content)
+                if blob_hash is not None:
+                    blobs.setdefault(blob_hash, [content, 0])[1] += 1
+                    updates.append((row['id'], row['timestamp'], psycopg2.Binary(blob_hash)))
+            if updates:
+                _store_blobs(cursor, blobs)
+                execute_values(
+                    cursor,
+                    """
+                    UPDATE messages AS m
+                    SET content = NULL, content_z = NULL, codec = NULL,
+                        blob_hash = v.blob_hash
+                    FROM (VALUES %s) AS v (id, timestamp, blob_hash)
+                    WHERE m.id = v.id AND m.timestamp = v.timestamp
+                    """,
+                    updates
+                )
+        deduped += len(updates)
+        if len(rows) < batch_size:
+            return deduped
+        last_id = rows[-1]['id']
+
+def collect_message_blobs(batch_size=1000, grace=BLOB_GC_GRACE):
+    """Delete blobs no message references and correct drifted refcounts.
+
+    Refcounts go up on insert and down on explicit chat deletes, but chats
+    removed by cascade and dropped partitions release nothing, so this
+    recounts references from messages. Only blobs untouched for ``grace``
+    seconds are considered: a writer taking a reference bumps
+    last_referenced_at, which keeps its blob out of the pass. Returns
+    ``{'deleted', 'freed_bytes', 'recounted'}``.
+    """
+    result = {'deleted': 0, 'freed_bytes': 0, 'recounted': 0}
+    after = b''
+    while True:
+        with get_db_cursor(commit=True) as cursor:
+            cursor.execute(
+                """
+                WITH batch AS (
+                    SELECT hash FROM message_blobs
+                    WHERE hash > %(after)s
+                      AND last_referenced_at < NOW() - %(grace)s * interval '1 second'
+                    ORDER BY hash
+                    LIMIT %(limit)s
+                ), counted AS (
+                    SELECT batch.hash,
+                           (SELECT count(*) FROM messages m WHERE m.blob_hash = batch.hash) AS n
+                    FROM batch
+                ), deleted AS (
+                    DELETE FROM message_blobs b
+                    USING counted c
+                    WHERE b.hash = c.hash AND c.n = 0
+                      AND b.last_referenced_at < NOW() - %(grace)s * interval '1 second'
+                    RETURNING COALESCE(octet_length(b.content_z), octet_length(b.content)) AS stored
+                ), recounted AS (
+                    UPDATE message_blobs b
+                    SET refcount = c.n
+                    FROM counted c
+                    WHERE b.hash = c.hash AND c.n > 0 AND b.refcount <> c.n
+                      AND b.last_referenced_at < NOW() - %(grace)s * interval '1 second'
+                    RETURNING 1
+                )
+                SELECT (SELECT count(*) FROM batch), (SELECT max(hash) FROM batch),
+                       (SELECT count(*) FROM deleted),
+                       (SELECT COALESCE(sum(stored), 0) FROM deleted),
+                       (SELECT count(*) FROM recounted)
+                """,
+                {'after': psycopg2.Binary(after), 'grace': grace, 'limit': batch_size}
+            )
+            scanned, last_hash, deleted, freed, recounted = cursor.fetchone()
+        result['deleted'] += deleted
+        result['freed_bytes'] += int(freed)
+        result['recounted'] += recounted
+        if scanned < batch_size:
+            return result
+        after = bytes(last_hash)
+
+def message_blob_stats():
+    """How much deduplication saves: bytes messages reference versus bytes
+    actually stored once per blob (before and after compression)"""
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT count(*) AS blobs,
+                   COALESCE(sum(refcount), 0) AS references,
+                   COALESCE(sum(size::bigint * refcount), 0) AS referenced_bytes,
+                   COALESCE(sum(size), 0) AS unique_bytes,
+                   COALESCE(sum(COALESCE(octet_length(content_z), octet_length(content))), 0)
+                       AS stored_bytes
+            FROM message_blobs
+            """
+        )
+        row = cursor.fetchone()
+    stats = {key: int(row[key]) for key in (
+        'blobs', 'references', 'referenced_bytes', 'unique_bytes', 'stored_bytes'
+    )}
+    stats['dedup_ratio'] = (
+        round(stats['referenced_bytes'] / stats['unique_bytes'], 2) if stats['unique_bytes'] else None
+    )
+    stats['saved_bytes'] = stats['referenced_bytes'] - stats['stored_bytes']
+    return stats
+
+def _delete_excess_chats(cur, username, keep):
+    """Delete a user's oldest chats beyond the ``keep`` most recent"""
+    _execute(cur, queries.DELETE_EXCESS_CHATS, {'username': username, 'keep': keep})
+    deleted = cur.rowcount
+    if deleted:
+        _publish_write(cur, username)
+    return deleted
+
+def delete_old_chats(username, keep=CHAT_HISTORY_LIMIT):
+    """Delete oldest chats keeping only the most recent ``keep`` (0: no limit)"""
+    if keep <= 0:
+        return 0
+    with get_db_cursor(commit=True) as cursor:
+        deleted = _delete_excess_chats(cursor, username, keep)
+    if deleted:
+        chat_cache.invalidate_user(username)
+    return deleted
+
+def enforce_chat_limits(keep=CHAT_HISTORY_LIMIT, batch_size=100):
+    """Trim every user to their ``keep`` most recent chats, ``batch_size``
+    users per transaction. Returns the number of chats deleted."""
+    if keep <= 0:
+        return 0
+    deleted = 0
+    last_username = ''
+    while True:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT username
+                    FROM chats
+                    WHERE username > %s
+                    GROUP BY username
+                    HAVING count(*) > %s
+                    ORDER BY username
+                    LIMIT %s
+                    """,
+                    (last_username, keep, batch_size)
+                )
+                usernames = [row['username'] for row in cur.fetchall()]
+                for username in usernames:
+                    deleted += _delete_excess_chats(cur, username, keep)
+                conn.commit()
+        for username in usernames:
+            chat_cache.invalidate_user(username)
+        if len(usernames) < batch_size:
+            return deleted
+        last_username = usernames[-1]
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+def _partition_name(month):
+    return f"messages_y{month.year}m{month.month:02d}"
+
+def _partition_month(name):
+    """The first day of the month a partition holds, or None if ``name``
+    isn't a monthly partition"""
+    try:
+        return datetime.strptime(name, "messages_y%Ym%m")
+    except ValueError:
+        return None
+
+def _message_partitions(cur):
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+        """
+    )
+    return [row[0] for row in cur.fetchall()]
+
+def _create_message_partition(month):
+    """Create and attach one month's partition, first moving any rows for
+    that month out of the default partition"""
+    name = sql.Identifier(_partition_name(month))
+    end = _add_months(month, 1)
     with get_db_cursor(commit=True) as cursor:
-        cursor.execute('''
-            WITH old_chats AS (
-                SELECT chat_id
-                FROM chats
-                WHERE username = %s
-                ORDER BY updated_at DESC
-                OFFSET 20
+        # Keeps rows for this month from landing in the default partition
+        # between the move and the attach
+        cursor.execute("LOCK TABLE messages_default IN SHARE ROW EXCLUSIVE MODE")
+        cursor.execute(
+            sql.SQL(
+                "CREATE TABLE {} (LIKE messages INCLUDING DEFAULTS INCLUDING STORAGE)"
+            ).format(name)
+        )
+        cursor.execute(
+            sql.SQL(
+                """
+                WITH moved AS (
+                    DELETE FROM messages_default
+                    WHERE timestamp >= %s AND timestamp < %s
+                    RETURNING *
+                )
+                INSERT INTO {} SELECT * FROM moved
+                """
+            ).format(name),
+            (month, end)
+        )
+        cursor.execute(
+            sql.SQL(
+                "ALTER TABLE messages ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)"
+            ).format(name),
+            (month, end)
+        )
+
+def ensure_message_partitions(months_ahead=MESSAGE_PARTITIONS_AHEAD):
+    """Make sure monthly message partitions exist from the oldest row still
+    in the default partition through ``months_ahead`` months from now.
+
+    Returns the names of the partitions created.
+    """
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT date_trunc('month', LOCALTIMESTAMP),
+                   (SELECT date_trunc('month', min(timestamp)) FROM messages_default)
+            """
+        )
+        this_month, oldest = cursor.fetchone()
+        existing = set(_message_partitions(cursor))
+
+    created = []
+    month = min(oldest, this_month) if oldest else this_month
+    last = _add_months(this_month, months_ahead)
+    while month <= last:
+        name = _partition_name(month)
+        if name not in existing:
+            _create_message_partition(month)
+            created.append(name)
+        month = _add_months(month, 1)
+    return created
+
+def drop_expired_message_partitions(retention_months, detach_only=False):
+    """Remove monthly partitions that lie entirely before the retention
+    horizon, oldest first. With ``detach_only`` the tables are kept (e.g.
+    for archiving) but no longer part of messages.
+
+    Chats that lose messages are renumbered afterwards (see
+    _renumber_chat_messages). Returns the names of the partitions removed.
+    """
+    with get_db_cursor() as cursor:
+        cursor.execute("SELECT date_trunc('month', LOCALTIMESTAMP)")
+        horizon = _add_months(cursor.fetchone()[0], -retention_months)
+        expired = sorted(
+            name for name in _message_partitions(cursor)
+            if _partition_month(name) and _partition_month(name) < horizon
+        )
+
+    for name in expired:
+        partition = sql.Identifier(name)
+        with get_db_cursor(commit=True) as cursor:
+            cursor.execute(
+                sql.SQL(
+                    """
+                    SELECT DISTINCT c.username, c.chat_id
+                    FROM chats c
+                    JOIN {} m ON m.chat_id = c.chat_id
+                    """
+                ).format(partition)
             )
-            DELETE FROM chats
-            WHERE chat_id IN (SELECT chat_id FROM old_chats)
-        ''', (username,))
\ No newline at end of file
+            chats = [(row['username'], row['chat_id']) for row in cursor.fetchall()]
+            usernames = {username for username, _ in chats}
+            cursor.execute(
+                sql.SQL("ALTER TABLE messages DETACH PARTITION {}").format(partition)
+            )
+            if not detach_only:
+                cursor.execute(sql.SQL("DROP TABLE {}").format(partition))
+            for username in usernames:
+                _publish_write(cursor, username)
+        for username in usernames:
+            chat_cache.invalidate_user(username)
+        for username, chat_id in chats:
+            _renumber_chat_messages(username, chat_id)
+    return expired
+
+def _renumber_chat_messages(username, chat_id):
+    """Close the seq gaps left by dropping a chat's oldest messages.
+
+    seq is a message's position in its line and message_count the next
+    one, which appends, save_chat and fork_chat rely on, so after a
+    partition drop each line is renumbered from 0 in its old order. A
+    branch's fork_seq becomes the number of its parent line's surviving
+    messages below the old fork point, and its own messages follow on.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            if _lock_chat(cur, username, chat_id) is None:
+                return
+            cur.execute(
+                "SELECT branch_id, parent_branch_id, fork_seq FROM chat_branches WHERE chat_id = %s",
+                (chat_id,)
+            )
+            branches = {row['branch_id']: row for row in cur.fetchall()}
+            cur.execute(
+                """
+                SELECT id, timestamp, branch_id, seq
+                FROM messages
+                WHERE chat_id = %s
+                ORDER BY seq, id
+                """,
+                (chat_id,)
+            )
+            own = {}
+            for row in cur.fetchall():
+                own.setdefault(row['branch_id'], []).append(row)
+
+            lines = {}
+
+            def line(branch_id):
+                """Old seqs of a line's surviving messages, in order"""
+                if branch_id not in lines:
+                    if branch_id is None:
+                        inherited = []
+                    else:
+                        branch = branches[branch_id]
+                        inherited = [
+                            seq for seq in line(branch['parent_branch_id'])
+                            if seq < branch['fork_seq']
+                        ]
+                    lines[branch_id] = inherited + [row['seq'] for row in own.get(branch_id, [])]
+                return lines[branch_id]
+
+            updates = []
+            counts = {}
+            for branch_id in [None, *branches]:
+                start = 0 if branch_id is None else len(line(branch_id)) - len(own.get(branch_id, []))
+                rows = own.get(branch_id, [])
+                counts[branch_id] = (start, len(rows))
+                updates.extend(
+                    (row['id'], row['timestamp'], start + offset)
+                    for offset, row in enumerate(rows) if row['seq'] != start + offset
+                )
+            if updates:
+                execute_values(
+                    cur,
+                    """
+                    UPDATE messages AS m
+                    SET seq = v.seq
+                    FROM (VALUES %s) AS v (id, timestamp, seq)
+                    WHERE m.id = v.id AND m.timestamp = v.timestamp
+                    """,
+                    updates
+                )
+            for branch_id, (fork_seq, count) in counts.items():
+                if branch_id is None:
+                    cur.execute(
+                        "UPDATE chats SET message_count = %s WHERE chat_id = %s",
+                        (count, chat_id)
+                    )
+                else:
+                    cur.execute(
+                        """
+                        UPDATE chat_branches SET fork_seq = %s, message_count = %s
+                        WHERE branch_id = %s
+                        """,
+                        (fork_seq, count, branch_id)
+                    )
+            _publish_write(cur, username, chat_id)
+            conn.commit()
+    chat_cache.invalidate_chat(username, chat_id)
+
+def delete_expired_chats(retention_months, batch_size=500):
+    """Delete chats not updated within the retention horizon, in batches.
+
+    Returns the number of chats deleted.
+    """
+    deleted = 0
+    while True:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                cur.execute(
+                    """
+                    DELETE FROM chats
+                    WHERE chat_id IN (
+                        SELECT chat_id
+                        FROM chats
+                        WHERE updated_at < date_trunc('month', LOCALTIMESTAMP)
+                                           - make_interval(months => %s)
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING username
+                    """,
+                    (retention_months, batch_size)
+                )
+                usernames = {row['username'] for row in cur.fetchall()}
+                count = cur.rowcount
+                for username in usernames:
+                    _publish_write(cur, username)
+                conn.commit()
+        for username in usernames:
+            chat_cache.invalidate_user(username)
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+def delete_user_chat(username, chat_id):
+    """Delete a chat and its messages, scoped to the owning user"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            params = {'chat_id': chat_id, 'username': username}
+            _execute(cur, queries.RELEASE_CHAT_BLOBS, params)
+            _execute(cur, queries.DELETE_CHAT_MESSAGES, params)
+            _execute(cur, queries.DELETE_CHAT, params)
+            _publish_write(cur, username, chat_id)
+            conn.commit()
+    chat_cache.invalidate_chat(username, chat_id)
@@ -0,0 +1,230 @@
+"""asyncpg-backed versions of the chat reads and writes for async callers.
+
+Runs the same statements as database.py (from queries) on its own pool.
+Only the save, list and delete paths have async callers so far; appends,
+windows, summaries, branches and export keep their statements in queries
+too, ready for the async layer to run unchanged when it needs them.
+asyncpg prepares every statement on first use and caches it per
+connection; set ASYNC_DB_STATEMENT_CACHE_SIZE=0 behind a transaction-mode
+pooler, which can't keep prepared statements across transactions.
+"""
+import asyncio
+import os
+from datetime import datetime
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+import queries
+from chat_cache import chat_cache
+from compression import codecs
+from database import (
+    CHAT_HISTORY_LIMIT, _backfill_params, _chat_params, _chats_with_messages,
+    _message_params, _new_blob_params, _reference_params, get_database_url
+)
+from invalidation import INSTANCE_ID, INVALIDATION_CHANNEL
+
+ASYNC_DB_POOL_MIN = int(os.getenv('ASYNC_DB_POOL_MIN', 1))
+ASYNC_DB_POOL_MAX = int(os.getenv('ASYNC_DB_POOL_MAX', 10))
+ASYNC_DB_STATEMENT_CACHE_SIZE = int(os.getenv('ASYNC_DB_STATEMENT_CACHE_SIZE', 100))
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+# queries.* text -> (asyncpg text, parameter names)
+_statements = {}
+
+
+def _statement(query):
+    if query not in _statements:
+        _statements[query] = queries.positional(query)
+    return _statements[query]
+
+
+def _args(query, params):
+    text, names = _statement(query)
+    return text, [params[name] for name in names]
+
+
+async def _execute(conn, query, params):
+    text, args = _args(query, params)
+    return await conn.execute(text, *args)
+
+
+async def _fetch(conn, query, params):
+    text, args = _args(query, params)
+    return await conn.fetch(text, *args)
+
+
+async def _fetchrow(conn, query, params):
+    text, args = _args(query, params)
+    return await conn.fetchrow(text, *args)
+
+
+def _timestamp(value):
+    """asyncpg wants datetimes where psycopg2 took ISO strings"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    return value
+
+
+async def get_pool():
+    global _pool
+    if asyncpg is None:
+        raise RuntimeError("asyncpg is required for the async data layer")
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    get_database_url(),
+                    min_size=ASYNC_DB_POOL_MIN,
+                    max_size=ASYNC_DB_POOL_MAX,
+                    statement_cache_size=ASYNC_DB_STATEMENT_CACHE_SIZE,
+                    server_settings={'application_name': 'krishnaco-ai-async'},
+                )
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def pool_stats():
+    if _pool is None:
+        return {}
+    return {
+        'size': _pool.get_size(),
+        'idle': _pool.get_idle_size(),
+        'max': _pool.get_max_size(),
+    }
+
+
+async def _publish_write(conn, username, chat_id=None):
+    await _execute(conn, queries.PUBLISH_WRITE, {
+        'username': username, 'channel': INVALIDATION_CHANNEL,
+        'chat_id': chat_id, 'origin': INSTANCE_ID,
+    })
+
+
+async def _ensure_dictionary(conn, codec):
+    dictionary_id = codecs.dictionary_id(codec)
+    if dictionary_id is None or codecs.has_dictionary(dictionary_id):
+        return
+    row = await _fetchrow(conn, queries.SELECT_DICTIONARY, {'id': dictionary_id})
+    codecs.add_dictionary(dictionary_id, bytes(row['dictionary']))
+
+
+async def _store_blobs(conn, blobs):
+    if not blobs:
+        return
+    rows = await _fetch(conn, queries.REFERENCE_BLOBS, _reference_params(blobs))
+    missing = blobs.keys() - {bytes(row['hash']) for row in rows}
+    if missing:
+        await _execute(conn, queries.INSERT_BLOBS, _new_blob_params(blobs, missing))
+
+
+async def _insert_messages(conn, chat_id, first_seq, messages):
+    if messages:
+        params, blobs = _message_params(chat_id, first_seq, messages)
+        await _store_blobs(conn, blobs)
+        await _execute(conn, queries.INSERT_MESSAGES, params)
+
+
+async def _lock_chat(conn, username, chat_id):
+    params = {'chat_id': chat_id, 'username': username}
+    row = await _fetchrow(conn, queries.LOCK_CHAT, params)
+    if row and row['chat_data'] is not None:
+        messages, backfill = _backfill_params(row)
+        await _insert_messages(conn, chat_id, row['message_count'], messages)
+        await _execute(conn, queries.BACKFILL_CHAT, backfill)
+        row = await _fetchrow(conn, queries.LOCK_CHAT, params)
+    return row
+
+
+async def save_chat(username, chat_id, chat_data):
+    """Save chat metadata and append any messages not stored yet"""
+    messages = chat_data.get('messages', [])
+    pool = await get_pool()
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                params = _chat_params(username, chat_id, chat_data)
+                params['created_at'] = _timestamp(params['created_at'])
+                if not messages:
+                    await _execute(conn, queries.SAVE_CHAT_METADATA, params)
+                else:
+                    row = await _lock_chat(conn, username, chat_id)
+                    stored = row['message_count'] if row else 0
+                    new_messages = messages[stored:]
+                    params['added'] = len(new_messages)
+                    if row:
+                        await _execute(conn, queries.UPDATE_SAVED_CHAT, params)
+                    else:
+                        params['allow_downgrade'] = bool(params['allow_downgrade'])
+                        await _execute(conn, queries.INSERT_SAVED_CHAT, params)
+                    await _insert_messages(conn, chat_id, stored, new_messages)
+                await _publish_write(conn, username, chat_id)
+        chat_cache.invalidate_chat(username, chat_id)
+    except Exception as e:
+        print(f"Error saving chat: {e}")
+        raise
+
+
+async def get_user_chats(username):
+    """All of a user's chats with their messages, keyed by chat id.
+
+    Reads go straight to the database: the chat cache's loader and version
+    check are synchronous. Writes here still invalidate it.
+    """
+    pool = await get_pool()
+    try:
+        async with pool.acquire() as conn:
+            rows = await _fetch(conn, queries.SELECT_USER_CHATS, {'username': username})
+            if not rows:
+                return {}
+            message_rows = await _fetch(
+                conn, queries.SELECT_CHAT_MESSAGES,
+                {'chat_ids': [row['chat_id'] for row in rows]}
+            )
+            for message in message_rows:
+                await _ensure_dictionary(conn, message['codec'])
+    except Exception as e:
+        print(f"Error getting chats: {e}")
+        raise
+    return {chat['id']: chat for chat in _chats_with_messages(rows, message_rows)}
+
+
+async def delete_old_chats(username, keep=CHAT_HISTORY_LIMIT):
+    """Delete oldest chats keeping only the most recent ``keep`` (0: no limit)"""
+    if keep <= 0:
+        return 0
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            status = await _execute(
+                conn, queries.DELETE_EXCESS_CHATS, {'username': username, 'keep': keep}
+            )
+            deleted = int(status.split()[-1])
+            if deleted:
+                await _publish_write(conn, username)
+    if deleted:
+        chat_cache.invalidate_user(username)
+    return deleted
+
+
+async def delete_user_chat(username, chat_id):
+    """Delete a chat and its messages, scoped to the owning user"""
+    params = {'chat_id': chat_id, 'username': username}
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await _execute(conn, queries.RELEASE_CHAT_BLOBS, params)
+            await _execute(conn, queries.DELETE_CHAT_MESSAGES, params)
+            await _execute(conn, queries.DELETE_CHAT, params)
+            await _publish_write(conn, username, chat_id)
+    chat_cache.invalidate_chat(username, chat_id)
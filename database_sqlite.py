@@ -0,0 +1,784 @@
+"""Embedded SQLite implementation of the chat operations in database.py.
+
+For single-node installs and local performance testing; select it with
+DB_BACKEND=sqlite (see repository.py). It needs only the standard library
+(plus zstandard, if installed, for compression). The database runs in WAL
+mode, so readers never wait for the writer, with synchronous=NORMAL: a
+crash of the application loses nothing, a power failure at most the last
+few commits.
+
+Compared with the Postgres backend, bodies are compressed but not
+deduplicated, search uses FTS5 with the porter stemmer, and there is no
+chat cache since reads don't leave the process. Sign-in needs no server
+either: unless AUTH_BACKEND=rest, Repository checks passwords against the
+users configured in the environment (USERnn_NAME/USERnn_PASSWORD).
+"""
+import atexit
+import base64
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from compression import codecs
+from search import lexeme_pattern, search_text, snippet
+
+SQLITE_CACHE_MB = int(os.getenv('SQLITE_CACHE_MB', 64))
+SQLITE_MMAP_MB = int(os.getenv('SQLITE_MMAP_MB', 256))
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+# Idle connections kept open for reuse
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', 8))
+# 0 (the default) keeps every chat; otherwise users keep their most recent N
+CHAT_HISTORY_LIMIT = int(os.getenv('CHAT_HISTORY_LIMIT', 0))
+# Chats read per transaction by export_chats
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 100))
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    title TEXT,
+    model TEXT,
+    allow_downgrade INTEGER NOT NULL DEFAULT 0,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chats_username_updated_at_idx
+    ON chats (username, updated_at DESC, chat_id DESC);
+
+CREATE TABLE IF NOT EXISTS chat_branches (
+    branch_id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL REFERENCES chats (chat_id) ON DELETE CASCADE,
+    parent_branch_id TEXT REFERENCES chat_branches (branch_id) ON DELETE CASCADE,
+    fork_seq INTEGER NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    title TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chat_branches_chat_id_idx ON chat_branches (chat_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id TEXT NOT NULL REFERENCES chats (chat_id) ON DELETE CASCADE,
+    branch_id TEXT,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    content_z BLOB,
+    codec TEXT,
+    model TEXT,
+    downgraded INTEGER NOT NULL DEFAULT 0,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_id_seq_idx
+    ON messages (chat_id, branch_id, seq);
+
+-- Message bodies (decompressed) for search, keyed by messages.id
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+    USING fts5(body, tokenize = 'porter unicode61');
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+BEGIN
+    DELETE FROM messages_fts WHERE rowid = old.id;
+END;
+"""
+
+_idle = []
+_idle_lock = threading.Lock()
+_connections_opened = 0
+
+
+class BranchError(ValueError):
+    """Raised for a fork point or branch that doesn't exist in the chat"""
+
+
+# Errors a retry can't fix (e.g. saving into a chat id owned by another user)
+PERMANENT_ERRORS = (sqlite3.IntegrityError, sqlite3.DataError)
+
+
+def get_database_path():
+    """Read SQLITE_PATH at call time (after load_dotenv)"""
+    return os.getenv('SQLITE_PATH', 'krishnaco.db')
+
+
+def _connect():
+    global _connections_opened
+    conn = sqlite3.connect(
+        get_database_path(), isolation_level=None, check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    # WAL makes NORMAL safe against corruption; fsync only at checkpoints
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_MB * 1024}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    with _idle_lock:
+        _connections_opened += 1
+    return conn
+
+
+@contextmanager
+def get_connection():
+    """Borrow a connection; idle ones are reused up to SQLITE_POOL_SIZE"""
+    with _idle_lock:
+        conn = _idle.pop() if _idle else None
+    if conn is None:
+        conn = _connect()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        with _idle_lock:
+            if len(_idle) < SQLITE_POOL_SIZE:
+                _idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+
+@contextmanager
+def _transaction():
+    """A write transaction. BEGIN IMMEDIATE takes the write lock up front,
+    so it waits (busy_timeout) instead of failing to upgrade mid-way."""
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+        conn.execute("COMMIT")
+
+
+@contextmanager
+def _snapshot():
+    """A read transaction, so multi-statement reads see one state"""
+    with get_connection() as conn:
+        conn.execute("BEGIN")
+        yield conn
+        conn.execute("COMMIT")
+
+
+def close_db():
+    with _idle_lock:
+        connections = list(_idle)
+        _idle.clear()
+    for conn in connections:
+        conn.execute("PRAGMA optimize")
+        conn.close()
+
+
+atexit.register(close_db)
+
+
+def init_db():
+    """Create the schema if this file doesn't have it yet"""
+    with get_connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            conn.executescript(SCHEMA)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def pool_stats():
+    with _idle_lock:
+        return {
+            'path': get_database_path(),
+            'idle': len(_idle),
+            'opened': _connections_opened,
+        }
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None).isoformat(timespec='microseconds')
+
+
+def _timestamp(value):
+    """Client timestamps in the fixed-width format stored here, so they
+    sort as text"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.isoformat(timespec='microseconds')
+
+
+def default_title(messages):
+    """Title a chat after its first message, as the client used to"""
+    for message in messages:
+        if message.get('role') == 'user':
+            return message['content'][:30] + '...'
+    return 'New Chat'
+
+
+def _chat_from_row(row, messages):
+    return {
+        'id': row['chat_id'],
+        'title': row['title'] or 'New Chat',
+        'model': row['model'],
+        'allowDowngrade': bool(row['allow_downgrade']),
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at'],
+        'messages': messages,
+    }
+
+
+def _message_from_row(row):
+    content = codecs.decode(row['content'], row['content_z'], row['codec'])
+    message = {'role': row['role'], 'content': content}
+    if row['downgraded']:
+        message['model'] = row['model']
+        message['downgraded'] = True
+    return message
+
+
+def _branch_from_row(row):
+    return {
+        'id': row['branch_id'],
+        'parent_branch_id': row['parent_branch_id'],
+        'fork_seq': row['fork_seq'],
+        'message_count': row['message_count'],
+        'title': row['title'],
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at'],
+    }
+
+
+def _insert_messages(conn, chat_id, first_seq, messages, branch_id=None):
+    """Append message rows (and their search entries) from first_seq"""
+    now = _now()
+    for offset, message in enumerate(messages):
+        content, content_z, codec = codecs.encode(message['content'])
+        cursor = conn.execute(
+            """
+            INSERT INTO messages
+                (chat_id, branch_id, seq, role, content, content_z, codec,
+                 model, downgraded, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (chat_id, branch_id, first_seq + offset, message['role'], content,
+             content_z, codec, message.get('model'), bool(message.get('downgraded')), now)
+        )
+        conn.execute(
+            "INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+            (cursor.lastrowid, search_text(message['content']))
+        )
+
+
+def _owned_chat(conn, username, chat_id):
+    return conn.execute(
+        "SELECT * FROM chats WHERE chat_id = ? AND username = ?", (chat_id, username)
+    ).fetchone()
+
+
+def save_chat(username, chat_id, chat_data):
+    """Save chat metadata and append any messages not stored yet.
+
+    Fields missing from chat_data are left unchanged; a chat id owned by
+    another user is never overwritten.
+    """
+    messages = chat_data.get('messages', [])
+    allow_downgrade = chat_data.get('allowDowngrade')
+    with _transaction() as conn:
+        row = conn.execute(
+            "SELECT username, message_count FROM chats WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is not None and row['username'] != username:
+            return
+        now = _now()
+        stored = row['message_count'] if row else 0
+        new_messages = messages[stored:]
+        if row is None:
+            conn.execute(
+                """
+                INSERT INTO chats
+                    (chat_id, username, title, model, allow_downgrade,
+                     message_count, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (chat_id, username, chat_data.get('title'), chat_data.get('model'),
+                 bool(allow_downgrade), len(new_messages),
+                 _timestamp(chat_data.get('created_at')) or now, now)
+            )
+        else:
+            conn.execute(
+                """
+                UPDATE chats
+                SET title = COALESCE(?, title), model = COALESCE(?, model),
+                    allow_downgrade = COALESCE(?, allow_downgrade),
+                    message_count = message_count + ?, updated_at = ?
+                WHERE chat_id = ?
+                """,
+                (chat_data.get('title'), chat_data.get('model'),
+                 None if allow_downgrade is None else bool(allow_downgrade),
+                 len(new_messages), now, chat_id)
+            )
+        _insert_messages(conn, chat_id, stored, new_messages)
+
+
+def append_messages(username, chat_id, messages, model=None):
+    """Append messages to a chat in one transaction, creating it if needed.
+
+    Returns the chat metadata (without messages).
+    """
+    with _transaction() as conn:
+        now = _now()
+        row = _owned_chat(conn, username, chat_id)
+        if row is None:
+            conn.execute(
+                """
+                INSERT INTO chats (chat_id, username, title, model, created_at, updated_at)
+                VALUES (?, ?, 'New Chat', ?, ?, ?)
+                """,
+                (chat_id, username, model, now, now)
+            )
+            stored, title = 0, 'New Chat'
+        else:
+            stored, title = row['message_count'], row['title']
+
+        if not title or title == 'New Chat':
+            title = default_title(messages)
+
+        _insert_messages(conn, chat_id, stored, messages)
+        conn.execute(
+            """
+            UPDATE chats
+            SET title = ?, model = COALESCE(?, model),
+                message_count = message_count + ?, updated_at = ?
+            WHERE chat_id = ?
+            """,
+            (title, model, len(messages), now, chat_id)
+        )
+        chat = _chat_from_row(_owned_chat(conn, username, chat_id), None)
+    del chat['messages']
+    return chat
+
+
+def _chats_with_messages(conn, rows):
+    """Chat dicts for ``rows``, each with its main-line messages"""
+    chats = {row['chat_id']: _chat_from_row(row, []) for row in rows}
+    if not chats:
+        return []
+    placeholders = ', '.join('?' * len(chats))
+    for message in conn.execute(
+        f"""
+        SELECT chat_id, role, content, content_z, codec, model, downgraded
+        FROM messages
+        WHERE chat_id IN ({placeholders}) AND branch_id IS NULL
+        ORDER BY chat_id, seq
+        """,
+        list(chats)
+    ):
+        chats[message['chat_id']]['messages'].append(_message_from_row(message))
+    return list(chats.values())
+
+
+def get_chat(username, chat_id):
+    """Load one chat with its messages, or None if it doesn't exist"""
+    with _snapshot() as conn:
+        row = _owned_chat(conn, username, chat_id)
+        if row is None:
+            return None
+        return _chats_with_messages(conn, [row])[0]
+
+
+def get_user_chats(username):
+    """All of a user's chats with their messages, keyed by chat id"""
+    with _snapshot() as conn:
+        rows = conn.execute(
+            "SELECT * FROM chats WHERE username = ? ORDER BY updated_at DESC", (username,)
+        ).fetchall()
+        return {chat['id']: chat for chat in _chats_with_messages(conn, rows)}
+
+
+def get_chat_window(username, chat_id, limit=50, before=None):
+    """A chat's metadata with only its latest ``limit`` messages older than
+    seq ``before``; ``before`` in the result pages further back (None at
+    the start). Returns None if the chat doesn't exist."""
+    with _snapshot() as conn:
+        row = _owned_chat(conn, username, chat_id)
+        if row is None:
+            return None
+        rows = conn.execute(
+            """
+            SELECT seq, role, content, content_z, codec, model, downgraded
+            FROM messages
+            WHERE chat_id = ? AND branch_id IS NULL AND (? IS NULL OR seq < ?)
+            ORDER BY seq DESC
+            LIMIT ?
+            """,
+            (chat_id, before, before, limit + 1)
+        ).fetchall()
+    has_more = len(rows) > limit
+    rows = list(reversed(rows[:limit]))
+    chat = _chat_from_row(
+        row, [dict(_message_from_row(message), seq=message['seq']) for message in rows]
+    )
+    chat['before'] = rows[0]['seq'] if has_more else None
+    return chat
+
+
+def _encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _decode_cursor(cursor, *types):
+    """The values of a cursor from _encode_cursor, checked against
+    ``types``; ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor") from None
+    if (not isinstance(values, list) or len(values) != len(types)
+            or any(isinstance(value, bool) or not isinstance(value, kind)
+                   for value, kind in zip(values, types))):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def get_chat_summaries(username, limit=50, cursor=None):
+    """One page of a user's chats, newest first, without messages"""
+    updated_at, after_id = _decode_cursor(cursor, str, str) if cursor else (None, None)
+    with get_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT chat_id, title, model, message_count, updated_at
+            FROM chats
+            WHERE username = ? AND (? IS NULL OR (updated_at, chat_id) < (?, ?))
+            ORDER BY updated_at DESC, chat_id DESC
+            LIMIT ?
+            """,
+            (username, updated_at, updated_at, after_id, limit + 1)
+        ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]['updated_at'], rows[-1]['chat_id'])
+    return {
+        'chats': [
+            {
+                'id': row['chat_id'],
+                'title': row['title'] or 'New Chat',
+                'model': row['model'],
+                'message_count': row['message_count'],
+                'updated_at': row['updated_at'],
+            }
+            for row in rows
+        ],
+        'next_cursor': next_cursor,
+    }
+
+
+def warm_chat_cache(username):
+    """Nothing to warm: there is no chat cache in front of SQLite"""
+
+
+def fork_chat(username, chat_id, at_seq, parent_branch_id=None, title=None):
+    """Start a branch sharing the parent line's messages below ``at_seq``
+    (see database.fork_chat). Returns the new branch."""
+    with _transaction() as conn:
+        row = _owned_chat(conn, username, chat_id)
+        if row is None:
+            raise BranchError(f"chat {chat_id} not found")
+        if parent_branch_id is None:
+            length = row['message_count']
+        else:
+            parent = conn.execute(
+                "SELECT * FROM chat_branches WHERE branch_id = ? AND chat_id = ?",
+                (parent_branch_id, chat_id)
+            ).fetchone()
+            if parent is None:
+                raise BranchError(f"branch {parent_branch_id} not found")
+            length = parent['fork_seq'] + parent['message_count']
+        if not 0 <= at_seq <= length:
+            raise BranchError(f"fork point {at_seq} is outside 0..{length}")
+
+        branch_id, now = uuid.uuid4().hex, _now()
+        conn.execute(
+            """
+            INSERT INTO chat_branches
+                (branch_id, chat_id, parent_branch_id, fork_seq, title,
+                 created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (branch_id, chat_id, parent_branch_id, at_seq, title, now, now)
+        )
+        return _branch_from_row(conn.execute(
+            "SELECT * FROM chat_branches WHERE branch_id = ?", (branch_id,)
+        ).fetchone())
+
+
+def list_branches(username, chat_id):
+    """A chat's branches, oldest first, or None if the chat doesn't exist"""
+    with _snapshot() as conn:
+        if _owned_chat(conn, username, chat_id) is None:
+            return None
+        return [
+            _branch_from_row(row) for row in conn.execute(
+                """
+                SELECT * FROM chat_branches WHERE chat_id = ?
+                ORDER BY created_at, branch_id
+                """,
+                (chat_id,)
+            )
+        ]
+
+
+def get_branch_history(username, chat_id, branch_id):
+    """A branch's full linear history (inherited messages first), or None
+    if the chat or branch doesn't exist"""
+    with _snapshot() as conn:
+        if _owned_chat(conn, username, chat_id) is None:
+            return None
+        branch = conn.execute(
+            "SELECT 1 FROM chat_branches WHERE branch_id = ? AND chat_id = ?",
+            (branch_id, chat_id)
+        ).fetchone()
+        if branch is None:
+            return None
+        rows = conn.execute(
+            """
+            WITH RECURSIVE lineage AS (
+                SELECT branch_id, parent_branch_id, fork_seq, NULL AS upto
+                FROM chat_branches
+                WHERE branch_id = :branch_id AND chat_id = :chat_id
+                UNION ALL
+                SELECT b.branch_id, b.parent_branch_id, b.fork_seq,
+                       min(COALESCE(l.upto, l.fork_seq), l.fork_seq)
+                FROM chat_branches b
+                JOIN lineage l ON b.branch_id = l.parent_branch_id
+            ), segments AS (
+                SELECT branch_id, upto FROM lineage
+                UNION ALL
+                SELECT NULL, min(COALESCE(upto, fork_seq), fork_seq)
+                FROM lineage WHERE parent_branch_id IS NULL
+            )
+            SELECT m.seq, m.role, m.content, m.content_z, m.codec, m.model,
+                   m.downgraded
+            FROM segments s
+            JOIN messages m
+              ON m.chat_id = :chat_id
+             AND m.branch_id IS s.branch_id
+             AND (s.upto IS NULL OR m.seq < s.upto)
+            ORDER BY m.seq
+            """,
+            {'branch_id': branch_id, 'chat_id': chat_id}
+        ).fetchall()
+    return [dict(_message_from_row(row), seq=row['seq']) for row in rows]
+
+
+def append_branch_messages(username, chat_id, branch_id, messages):
+    """Append messages to a branch; returns the updated branch"""
+    with _transaction() as conn:
+        if _owned_chat(conn, username, chat_id) is None:
+            raise BranchError(f"chat {chat_id} not found")
+        branch = conn.execute(
+            "SELECT * FROM chat_branches WHERE branch_id = ? AND chat_id = ?",
+            (branch_id, chat_id)
+        ).fetchone()
+        if branch is None:
+            raise BranchError(f"branch {branch_id} not found")
+        _insert_messages(
+            conn, chat_id, branch['fork_seq'] + branch['message_count'], messages, branch_id
+        )
+        now = _now()
+        conn.execute(
+            """
+            UPDATE chat_branches
+            SET message_count = message_count + ?, updated_at = ?
+            WHERE branch_id = ?
+            """,
+            (len(messages), now, branch_id)
+        )
+        conn.execute("UPDATE chats SET updated_at = ? WHERE chat_id = ?", (now, chat_id))
+        return _branch_from_row(conn.execute(
+            "SELECT * FROM chat_branches WHERE branch_id = ?", (branch_id,)
+        ).fetchone())
+
+
+def delete_user_chat(username, chat_id):
+    """Delete a chat, its branches and messages, scoped to the owning user"""
+    with _transaction() as conn:
+        conn.execute(
+            "DELETE FROM chats WHERE chat_id = ? AND username = ?", (chat_id, username)
+        )
+
+
+def delete_old_chats(username, keep=CHAT_HISTORY_LIMIT):
+    """Delete oldest chats keeping only the most recent ``keep`` (0: no limit)"""
+    if keep <= 0:
+        return 0
+    with _transaction() as conn:
+        return conn.execute(
+            """
+            DELETE FROM chats
+            WHERE chat_id IN (
+                SELECT chat_id FROM chats
+                WHERE username = ?
+                ORDER BY updated_at DESC, chat_id DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (username, keep)
+        ).rowcount
+
+
+_SEARCH_TERM = re.compile(r'(-?)"([^"]*)"?|(\S+)')
+
+
+def _match_expression(query):
+    """Translate web search syntax (as websearch_to_tsquery takes it) into
+    an FTS5 query: terms and "phrases" must all match, ``or`` between
+    terms allows either, and ``-term`` excludes. Returns ``(expression,
+    words to highlight)``; the expression is None if nothing is required."""
+    groups, excluded, words = [], [], []
+    alternate = False
+    for match in _SEARCH_TERM.finditer(query):
+        negated = match.group(1) == '-' or (match.group(3) or '').startswith('-')
+        text = match.group(2) if match.group(2) is not None else match.group(3).lstrip('-')
+        if match.group(3) and match.group(3).lower() == 'or':
+            alternate = bool(groups)
+            continue
+        terms = re.findall(r"\w+", text)
+        if not terms:
+            continue
+        phrase = '"' + ' '.join(terms) + '"'
+        if negated:
+            excluded.append(phrase)
+        elif alternate:
+            groups[-1].append(phrase)
+        else:
+            groups.append([phrase])
+        if not negated:
+            words.extend(term.lower() for term in terms)
+        alternate = False
+    if not groups:
+        return None, words
+    expression = ' AND '.join(f"({' OR '.join(group)})" for group in groups)
+    for phrase in excluded:
+        expression += f" NOT {phrase}"
+    return expression, words
+
+
+def search_messages(username, query, limit=20, cursor=None):
+    """Full-text search over a user's messages, best matches first; same
+    results shape and cursor paging as database.search_messages"""
+    expression, words = _match_expression(query)
+    if expression is None:
+        return {'results': [], 'next_cursor': None}
+    # '' keys the main line: branches repeat seqs, so they are part of the keyset
+    rank, after_chat, after_branch, after_seq = (
+        _decode_cursor(cursor, (int, float), str, str, int) if cursor
+        else (None, None, None, None)
+    )
+    pattern = lexeme_pattern(words)
+    with get_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT * FROM (
+                SELECT m.chat_id, m.branch_id, COALESCE(m.branch_id, '') AS branch_key,
+                       m.seq, m.role, m.content,
+                       m.content_z, m.codec, m.model, m.downgraded, m.timestamp,
+                       c.title, -bm25(messages_fts) AS rank
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                JOIN chats c ON c.chat_id = m.chat_id
+                WHERE messages_fts MATCH ? AND c.username = ?
+            )
+            WHERE ? IS NULL OR (rank, chat_id, branch_key, seq) < (?, ?, ?, ?)
+            ORDER BY rank DESC, chat_id DESC, branch_key DESC, seq DESC
+            LIMIT ?
+            """,
+            (expression, username, rank, rank, after_chat, after_branch, after_seq, limit + 1)
+        ).fetchall()
+
+    results = []
+    for row in rows[:limit]:
+        message = _message_from_row(row)
+        results.append({
+            'chat_id': row['chat_id'],
+            'chat_title': row['title'] or 'New Chat',
+            'branch_id': row['branch_id'],
+            'seq': row['seq'],
+            'role': message['role'],
+            'timestamp': row['timestamp'],
+            'rank': row['rank'],
+            'snippet': snippet(message['content'], pattern),
+        })
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = _encode_cursor(
+            last['rank'], last['chat_id'], last['branch_key'], last['seq']
+        )
+    return {'results': results, 'next_cursor': next_cursor}
+
+
+def search_chat_titles(username, query, limit=10):
+    """A user's chats whose title contains ``query``; exact titles first,
+    then most recently updated"""
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    with get_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT chat_id, title, updated_at
+            FROM chats
+            WHERE username = ? AND title LIKE ? ESCAPE '\\'
+            ORDER BY lower(title) = lower(?) DESC, updated_at DESC
+            LIMIT ?
+            """,
+            (username, pattern, query, limit)
+        ).fetchall()
+    return [
+        {'id': row['chat_id'], 'title': row['title'], 'updated_at': row['updated_at']}
+        for row in rows
+    ]
+
+
+def export_chats(username=None, after=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield complete chats (with messages and username) in chat_id order,
+    ``batch_size`` chats per read transaction; ``username`` None exports
+    every user, ``after`` resumes after that chat id"""
+    while True:
+        with get_connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT c.chat_id, c.username, c.title AS chat_title,
+                       c.model AS chat_model, c.allow_downgrade, c.created_at,
+                       c.updated_at, m.seq, m.role, m.content, m.content_z,
+                       m.codec, m.model, m.downgraded
+                FROM (
+                    SELECT * FROM chats
+                    WHERE (:username IS NULL OR username = :username)
+                      AND (:after IS NULL OR chat_id > :after)
+                    ORDER BY chat_id
+                    LIMIT :limit
+                ) c
+                LEFT JOIN messages m ON m.chat_id = c.chat_id AND m.branch_id IS NULL
+                ORDER BY c.chat_id, m.seq
+                """,
+                {'username': username, 'after': after, 'limit': batch_size}
+            ).fetchall()
+        chats = []
+        for row in rows:
+            if not chats or row['chat_id'] != chats[-1]['id']:
+                chat = _chat_from_row(
+                    dict(row, title=row['chat_title'], model=row['chat_model']), []
+                )
+                chat['username'] = row['username']
+                chats.append(chat)
+            if row['role'] is not None:
+                chats[-1]['messages'].append(_message_from_row(row))
+        yield from chats
+        if len(chats) < batch_size:
+            return
+        after = chats[-1]['id']
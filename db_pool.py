@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool.
+
+    Connections are health-checked on checkout when they have been idle for
+    more than ``idle_check`` seconds and are retired after ``max_lifetime``.
+    Returned connections are only rolled back, never reconfigured, so no
+    session state leaks between checkouts; that keeps the pool safe behind
+    a transaction-mode pgbouncer such as Supabase's pooler.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=10,
+                 max_lifetime=1800, idle_check=30, on_connect=None, **connect_kwargs):
+        self.dsn = dsn
+        self.on_connect = on_connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_check = idle_check
+        self.connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._closed = False
+        self.checkouts = 0
+        self.waits = 0
+        self.created = 0
+        self.discarded = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        if self.on_connect:
+            self.on_connect(conn)
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self.created += 1
+        return conn
+
+    def _expired(self, conn):
+        created_at = self._created_at.get(id(conn), 0)
+        return time.monotonic() - created_at > self.max_lifetime
+
+    def _healthy(self, conn, idle_for):
+        if conn.closed or self._expired(conn):
+            return False
+        if idle_for < self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self.discarded += 1
+            self._cond.notify()
+
+    def fill(self):
+        """Open connections until the pool holds at least ``minconn``"""
+        while True:
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            self.putconn(conn)
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"no connection available after {self.timeout}s")
+                    self.waits += 1
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(conn, time.monotonic() - returned_at):
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self.checkouts += 1
+            return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                status = conn.get_transaction_status()
+                if status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed or self._expired(conn) or self._closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max': self.maxconn,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'created': self.created,
+                'discarded': self.discarded,
+            }
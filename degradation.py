@@ -0,0 +1,82 @@
+import os
+import threading
+
+# A model class degrades when its queue is this full or its recent latency
+# passes the class' ``degrade_latency``, and is restored once the queue has
+# drained below DEGRADE_RESTORE_FRACTION and latency is back under
+# DEGRADE_LATENCY_RESTORE x ``degrade_latency``.
+DEGRADE_QUEUE_FRACTION = float(os.getenv('DEGRADE_QUEUE_FRACTION', 0.5))
+DEGRADE_RESTORE_FRACTION = float(os.getenv('DEGRADE_RESTORE_FRACTION', 0.1))
+DEGRADE_LATENCY_RESTORE = float(os.getenv('DEGRADE_LATENCY_RESTORE', 0.8))
+DEGRADE_LATENCY_HORIZON = float(os.getenv('DEGRADE_LATENCY_HORIZON', 60))
+DEGRADE_LATENCY_PERCENTILE = float(os.getenv('DEGRADE_LATENCY_PERCENTILE', 0.95))
+DEGRADE_OPT_IN_USERS = {
+    user.strip() for user in os.getenv('DEGRADE_OPT_IN_USERS', '').split(',') if user.strip()
+}
+
+
+class DegradationPolicy:
+    """Downgrades opted-in requests to a faster model while a class is overloaded.
+
+    Uses the ``fallback`` and ``degrade_latency`` keys of each model class
+    config; classes without a fallback are never downgraded.
+    """
+
+    def __init__(self, bulkheads, timeout_policies):
+        self.bulkheads = bulkheads
+        self.timeout_policies = timeout_policies
+        self._lock = threading.Lock()
+        self._degraded = set()
+        self.downgrades = 0
+
+    def _overloaded(self, model, model_class, config):
+        stats = self.bulkheads.bulkheads[model_class].stats()
+        queue_fill = stats['queued'] / stats['max_queue'] if stats['max_queue'] else 0
+        latency = self.timeout_policies.recent_latency(
+            model, DEGRADE_LATENCY_HORIZON, DEGRADE_LATENCY_PERCENTILE
+        )
+        latency_limit = config.get('degrade_latency')
+
+        with self._lock:
+            degraded = model_class in self._degraded
+            if not degraded:
+                degraded = (
+                    queue_fill >= DEGRADE_QUEUE_FRACTION
+                    or (latency_limit and latency is not None and latency >= latency_limit)
+                )
+            else:
+                latency_ok = (
+                    not latency_limit or latency is None
+                    or latency < latency_limit * DEGRADE_LATENCY_RESTORE
+                )
+                degraded = not (queue_fill <= DEGRADE_RESTORE_FRACTION and latency_ok)
+
+            if degraded:
+                self._degraded.add(model_class)
+            else:
+                self._degraded.discard(model_class)
+        return degraded
+
+    def route(self, model, username=None, allow_downgrade=False):
+        """Return ``(model_to_use, downgraded)`` for a request"""
+        model_class = self.bulkheads.classify(model)
+        config = self.bulkheads.model_classes[model_class]
+        fallback = config.get('fallback')
+        if not fallback or fallback == model:
+            return model, False
+
+        if not self._overloaded(model, model_class, config):
+            return model, False
+        if not (allow_downgrade or username in DEGRADE_OPT_IN_USERS):
+            return model, False
+
+        with self._lock:
+            self.downgrades += 1
+        return fallback, True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'degraded_classes': sorted(self._degraded),
+                'downgrades': self.downgrades,
+            }
@@ -0,0 +1,104 @@
+import json
+import select
+import threading
+import time
+import uuid
+
+import psycopg2
+
+INVALIDATION_CHANNEL = 'chat_invalidation'
+
+# Identifies this process so it can skip its own notifications
+INSTANCE_ID = uuid.uuid4().hex
+
+
+class InvalidationListener:
+    """Background LISTEN loop that evicts cache entries written elsewhere.
+
+    Payloads are JSON objects with ``username``, ``chat_id`` (None for
+    user-wide changes), ``version`` (the user's write counter) and
+    ``origin``. ``on_connected``/``on_disconnected`` let the cache switch to
+    version-checked reads while notifications may be missed.
+    ``on_write(username)``, if given, is called for every write seen.
+    """
+
+    def __init__(self, dsn, cache, channel=INVALIDATION_CHANNEL,
+                 poll_interval=5, max_backoff=30, on_write=None):
+        self.dsn = dsn
+        self.cache = cache
+        self.on_write = on_write
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.received = 0
+        self.reconnects = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='cache-invalidation', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def _handle(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if event.get('origin') == INSTANCE_ID:
+            return
+        self.received += 1
+        if self.on_write:
+            self.on_write(event['username'])
+        if event.get('chat_id'):
+            self.cache.invalidate_chat(event['username'], event['chat_id'])
+        else:
+            self.cache.invalidate_user(event['username'])
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn, keepalives=1, keepalives_idle=30)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {self.channel}")
+            # Anything cached before now may have missed notifications
+            self.cache.clear()
+            self.cache.validate = False
+            self.connected = True
+            while not self._stopping.is_set():
+                if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                    # Idle: make sure the connection is really still alive
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._handle(conn.notifies.pop(0).payload)
+        finally:
+            self.connected = False
+            self.cache.validate = True
+            conn.close()
+
+    def _run(self):
+        backoff = 1
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+                backoff = 1
+            except Exception as e:
+                print(f"Cache invalidation listener error: {e}")
+            if self._stopping.is_set():
+                return
+            self.reconnects += 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'received': self.received,
+            'reconnects': self.reconnects,
+        }
@@ -0,0 +1,234 @@
+"""Maintenance commands: python manage.py <command> [options]"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import database
+import migrations
+import retention
+from chat_export import export_chunks, last_exported_id
+from chat_import import InvalidChat, normalize_chat, read_export
+
+
+def backfill(args):
+    database.init_db()
+    migrated = database.backfill_messages(batch_size=args.batch_size)
+    print(f"Backfilled {migrated} chats into message rows")
+
+
+def migrate(args):
+    applied = migrations.migrate(database.get_direct_database_url(), target=args.target)
+    if applied:
+        print(f"Applied migrations {applied}")
+    else:
+        print("Schema is up to date")
+
+
+def train_dictionary(args):
+    database.init_db()
+    dictionary_id = database.train_compression_dictionary(sample_limit=args.samples)
+    print(f"Trained compression dictionary {dictionary_id}")
+
+
+def compress(args):
+    database.init_db()
+    compressed = database.compress_messages(batch_size=args.batch_size)
+    print(f"Compressed {compressed} messages")
+
+
+def index_search(args):
+    database.init_db()
+    indexed = database.index_messages(batch_size=args.batch_size)
+    print(f"Indexed {indexed} messages for search")
+
+
+def dedupe(args):
+    database.init_db()
+    deduped = database.dedupe_messages(batch_size=args.batch_size)
+    print(f"Moved {deduped} message bodies into shared blobs")
+
+
+def blobs(args):
+    database.init_db()
+    if args.gc:
+        result = database.collect_message_blobs(batch_size=args.batch_size, grace=args.grace)
+        print(f"Deleted {result['deleted']} unreferenced blobs ({result['freed_bytes']} bytes), "
+              f"recounted {result['recounted']}")
+    print(json.dumps(database.message_blob_stats(), indent=2))
+
+
+def partitions(args):
+    database.init_db()
+    created = database.ensure_message_partitions(months_ahead=args.months_ahead)
+    print(f"Created partitions {created}" if created else "Partitions are up to date")
+
+
+def retain(args):
+    database.init_db()
+    worker = retention.RetentionWorker(
+        retention_months=args.months, keep_chats=args.keep_chats,
+        detach_only=args.detach_only
+    )
+    result = worker.run_once()
+    if result is None:
+        print("Another retention pass is running")
+    else:
+        print(json.dumps(result, indent=2))
+
+
+def export(args):
+    database.init_db()
+    after = args.after
+    mode = 'wb'
+    if args.resume and os.path.exists(args.output):
+        if args.gzip:
+            sys.exit("--resume needs an NDJSON export; pass --after for gzip")
+        after = last_exported_id(args.output) or after
+        mode = 'ab'
+        print(f"Resuming after chat {after}")
+
+    exported = 0
+    last_id = after
+
+    def progress(chats):
+        nonlocal exported, last_id
+        for chat in chats:
+            yield chat
+            exported += 1
+            last_id = chat['id']
+            if exported % 1000 == 0:
+                print(f"Exported {exported} chats (last id {last_id})", file=sys.stderr)
+
+    chats = progress(database.export_chats(args.user, after=after, batch_size=args.batch_size))
+    with open(args.output, mode) as output:
+        for chunk in export_chunks(chats, compress=args.gzip):
+            output.write(chunk)
+    print(f"Exported {exported} chats to {args.output} (last id {last_id})")
+
+
+def import_chats(args):
+    database.init_db()
+    invalid = 0
+
+    def valid_chats():
+        nonlocal invalid
+        for raw in read_export(args.input):
+            try:
+                yield normalize_chat(raw)
+            except InvalidChat as e:
+                invalid += 1
+                print(f"Skipping invalid chat: {e}", file=sys.stderr)
+
+    start = time.monotonic()
+
+    def progress(stats):
+        elapsed = max(time.monotonic() - start, 1e-6)
+        print(f"Imported {stats['chats']} chats, {stats['messages']} messages "
+              f"({stats['messages'] / elapsed:.0f} messages/s), "
+              f"{stats['skipped']} already present", file=sys.stderr)
+
+    stats = database.import_chats(
+        valid_chats(), username=args.user, batch_size=args.batch_size, progress=progress
+    )
+    print(f"Read {stats['read'] + invalid} chats: imported {stats['chats']} "
+          f"({stats['messages']} messages), skipped {stats['skipped']}, "
+          f"invalid {invalid} in {time.monotonic() - start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_backfill = commands.add_parser(
+        'backfill', help='Migrate legacy chat_data blobs into message rows'
+    )
+    parser_backfill.add_argument('--batch-size', type=int, default=100)
+    parser_backfill.set_defaults(func=backfill)
+
+    parser_migrate = commands.add_parser('migrate', help='Apply pending schema migrations')
+    parser_migrate.add_argument('--target', type=int, default=migrations.LATEST_VERSION)
+    parser_migrate.set_defaults(func=migrate)
+
+    parser_train = commands.add_parser(
+        'train-dictionary', help='Train a zstd dictionary on stored messages'
+    )
+    parser_train.add_argument('--samples', type=int, default=5000)
+    parser_train.set_defaults(func=train_dictionary)
+
+    parser_compress = commands.add_parser(
+        'compress', help='Compress existing message bodies above the threshold'
+    )
+    parser_compress.add_argument('--batch-size', type=int, default=500)
+    parser_compress.set_defaults(func=compress)
+
+    parser_index = commands.add_parser(
+        'index-search', help='Fill search vectors for messages stored before search'
+    )
+    parser_index.add_argument('--batch-size', type=int, default=500)
+    parser_index.set_defaults(func=index_search)
+
+    parser_dedupe = commands.add_parser(
+        'dedupe', help='Move existing large message bodies into shared blobs'
+    )
+    parser_dedupe.add_argument('--batch-size', type=int, default=500)
+    parser_dedupe.set_defaults(func=dedupe)
+
+    parser_blobs = commands.add_parser(
+        'blobs', help='Report message blob deduplication (and collect garbage)'
+    )
+    parser_blobs.add_argument('--gc', action='store_true',
+                              help='delete unreferenced blobs and fix refcounts first')
+    parser_blobs.add_argument('--grace', type=float, default=database.BLOB_GC_GRACE,
+                              help='seconds since last reference before a blob can go')
+    parser_blobs.add_argument('--batch-size', type=int, default=1000)
+    parser_blobs.set_defaults(func=blobs)
+
+    parser_partitions = commands.add_parser(
+        'partitions', help='Create upcoming monthly message partitions'
+    )
+    parser_partitions.add_argument('--months-ahead', type=int,
+                                   default=database.MESSAGE_PARTITIONS_AHEAD)
+    parser_partitions.set_defaults(func=partitions)
+
+    parser_retain = commands.add_parser(
+        'retain', help='Run one retention pass (partitions, expiry, chat limits)'
+    )
+    parser_retain.add_argument('--months', type=int, default=retention.MESSAGE_RETENTION_MONTHS,
+                               help='drop months older than this (0 keeps everything)')
+    parser_retain.add_argument('--keep-chats', type=int, default=database.CHAT_HISTORY_LIMIT)
+    parser_retain.add_argument('--detach-only', action='store_true',
+                               default=retention.RETENTION_DETACH_ONLY)
+    parser_retain.set_defaults(func=retain)
+
+    parser_export = commands.add_parser(
+        'export', help='Stream chats to an NDJSON (or gzip JSONL) file'
+    )
+    parser_export.add_argument('output')
+    parser_export.add_argument('--user', help='only this user (default: everyone)')
+    parser_export.add_argument('--gzip', action='store_true')
+    parser_export.add_argument('--after', help='start after this chat id')
+    parser_export.add_argument('--resume', action='store_true',
+                               help='continue an interrupted NDJSON export in place')
+    parser_export.add_argument('--batch-size', type=int, default=database.EXPORT_BATCH_SIZE)
+    parser_export.set_defaults(func=export)
+
+    parser_import = commands.add_parser(
+        'import', help='Bulk-load chats from an export or ChatGPT conversations.json'
+    )
+    parser_import.add_argument('input', help='NDJSON/JSONL(.gz) or JSON array file')
+    parser_import.add_argument('--user', help="owner of the chats (default: each chat's username)")
+    parser_import.add_argument('--batch-size', type=int, default=database.IMPORT_BATCH_SIZE)
+    parser_import.set_defaults(func=import_chats)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
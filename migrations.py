@@ -0,0 +1,301 @@
+"""Versioned schema migrations.
+
+Each migration runs once and is recorded in ``schema_migrations``. Ordinary
+migrations run in a single transaction together with their version row.
+``concurrent`` migrations (``CREATE INDEX CONCURRENTLY``) can't run in a
+transaction, so they run in autocommit mode and must be idempotent
+(``IF NOT EXISTS``) in case they are interrupted before being recorded.
+"""
+import re
+from collections import namedtuple
+
+import psycopg2
+
+Migration = namedtuple('Migration', ['version', 'name', 'statements', 'concurrent'])
+
+# Arbitrary key for the advisory lock that serialises migration runs
+MIGRATION_LOCK_KEY = 7235001
+
+MIGRATIONS = [
+    Migration(1, 'create chats and messages', [
+        '''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            title TEXT,
+            model TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(chat_id, username)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats (chat_id) ON DELETE CASCADE
+        )
+        ''',
+    ], False),
+    Migration(2, 'append-only message rows', [
+        # chat_data is the legacy whole-chat blob, cleared by the backfill
+        '''
+        ALTER TABLE chats
+            ADD COLUMN IF NOT EXISTS chat_data TEXT,
+            ADD COLUMN IF NOT EXISTS allow_downgrade BOOLEAN NOT NULL DEFAULT FALSE,
+            ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0
+        ''',
+        '''
+        ALTER TABLE messages
+            ADD COLUMN IF NOT EXISTS seq INTEGER,
+            ADD COLUMN IF NOT EXISTS model TEXT,
+            ADD COLUMN IF NOT EXISTS downgraded BOOLEAN NOT NULL DEFAULT FALSE
+        ''',
+    ], False),
+    Migration(3, 'index chats by user and recency', [
+        # Covering index for the paginated sidebar listing
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS chats_username_updated_at_idx
+        ON chats (username, updated_at DESC, chat_id DESC)
+        INCLUDE (title, model, message_count)
+        ''',
+    ], True),
+    Migration(4, 'index messages by chat and sequence', [
+        # Message windows are read newest-first by (chat_id, seq)
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_chat_id_seq_idx
+        ON messages (chat_id, seq)
+        ''',
+    ], True),
+    Migration(5, 'compressed message bodies', [
+        # Large bodies move to content_z with a codec marker; content is
+        # NULL for those rows
+        '''
+        ALTER TABLE messages
+            ALTER COLUMN content DROP NOT NULL,
+            ADD COLUMN IF NOT EXISTS content_z BYTEA,
+            ADD COLUMN IF NOT EXISTS codec TEXT
+        ''',
+        # Already compressed, so skip TOAST's own pglz pass
+        "ALTER TABLE messages ALTER COLUMN content_z SET STORAGE EXTERNAL",
+        '''
+        CREATE TABLE IF NOT EXISTS compression_dictionaries (
+            id SERIAL PRIMARY KEY,
+            dictionary BYTEA NOT NULL,
+            sample_count INTEGER NOT NULL,
+            active BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ], False),
+    Migration(6, 'per-user write versions', [
+        # Bumped by every chat write; cache entries are validated against it
+        # when invalidation notifications may have been missed
+        '''
+        CREATE TABLE IF NOT EXISTS chat_versions (
+            username TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+    ], False),
+    Migration(7, 'partition messages by month', [
+        # Rebuilds messages as a range-partitioned table so retention can
+        # drop whole months. Everything lands in the default partition
+        # first; database.ensure_message_partitions then moves rows into
+        # monthly partitions. The primary key has to include the partition
+        # key, and ids keep coming from the existing sequence.
+        "ALTER TABLE messages RENAME TO messages_unpartitioned",
+        "ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey",
+        "ALTER INDEX IF EXISTS messages_chat_id_seq_idx RENAME TO messages_unpartitioned_chat_id_seq_idx",
+        '''
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+            chat_id TEXT NOT NULL REFERENCES chats (chat_id) ON DELETE CASCADE,
+            seq INTEGER,
+            role TEXT NOT NULL,
+            content TEXT,
+            content_z BYTEA,
+            codec TEXT,
+            model TEXT,
+            downgraded BOOLEAN NOT NULL DEFAULT FALSE,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+        ''',
+        "ALTER TABLE messages ALTER COLUMN content_z SET STORAGE EXTERNAL",
+        "ALTER SEQUENCE messages_id_seq OWNED BY messages.id",
+        "CREATE TABLE messages_default PARTITION OF messages DEFAULT",
+        '''
+        INSERT INTO messages
+            (id, chat_id, seq, role, content, content_z, codec, model,
+             downgraded, timestamp)
+        SELECT id, chat_id, seq, role, content, content_z, codec, model,
+               downgraded, COALESCE(timestamp, CURRENT_TIMESTAMP)
+        FROM messages_unpartitioned
+        ''',
+        "DROP TABLE messages_unpartitioned",
+        "CREATE INDEX messages_chat_id_seq_idx ON messages (chat_id, seq)",
+    ], False),
+    Migration(8, 'message search vectors', [
+        # Filled by the application from the decoded body, because
+        # compressed rows have no plain-text content to generate it from.
+        # The GIN index is built before the column has any values, so the
+        # build is quick even though it can't run concurrently on a
+        # partitioned table; new partitions inherit it on attach.
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        "CREATE INDEX IF NOT EXISTS messages_search_vector_idx ON messages USING GIN (search_vector)",
+    ], False),
+    Migration(9, 'trigram index on chat titles', [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        # Substring title matches (ILIKE '%term%') for search
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS chats_title_trgm_idx
+        ON chats USING GIN (title gin_trgm_ops)
+        ''',
+    ], True),
+    Migration(10, 'conversation branches', [
+        # A branch shares its parent's messages below fork_seq and stores
+        # only its own from there on; parent_branch_id NULL means it was
+        # forked from the chat's main line (messages with branch_id NULL)
+        '''
+        CREATE TABLE IF NOT EXISTS chat_branches (
+            branch_id TEXT PRIMARY KEY,
+            chat_id TEXT NOT NULL REFERENCES chats (chat_id) ON DELETE CASCADE,
+            parent_branch_id TEXT REFERENCES chat_branches (branch_id) ON DELETE CASCADE,
+            fork_seq INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            title TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS chat_branches_chat_id_idx ON chat_branches (chat_id)",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS branch_id TEXT",
+        '''
+        CREATE INDEX IF NOT EXISTS messages_branch_id_seq_idx
+        ON messages (branch_id, seq) WHERE branch_id IS NOT NULL
+        ''',
+    ], False),
+    Migration(11, 'content-addressed message bodies', [
+        # Large bodies are stored once per SHA-256 and referenced from
+        # messages.blob_hash. refcount is kept up to date on insert and
+        # explicit deletes and recomputed by the GC pass, which also covers
+        # cascades and dropped partitions
+        '''
+        CREATE TABLE IF NOT EXISTS message_blobs (
+            hash BYTEA PRIMARY KEY,
+            content TEXT,
+            content_z BYTEA,
+            codec TEXT,
+            size INTEGER NOT NULL,
+            refcount BIGINT NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_referenced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "ALTER TABLE message_blobs ALTER COLUMN content_z SET STORAGE EXTERNAL",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS blob_hash BYTEA",
+        '''
+        CREATE INDEX IF NOT EXISTS messages_blob_hash_idx
+        ON messages (blob_hash) WHERE blob_hash IS NOT NULL
+        ''',
+    ], False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(cursor):
+    """Return the applied schema version (0 for a fresh database)"""
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cursor.fetchone()[0]
+
+
+def migrate(dsn, target=LATEST_VERSION):
+    """Apply pending migrations up to ``target``; returns versions applied.
+
+    Uses its own connection because session-level advisory locks and
+    autocommit DDL don't work through a transaction-mode pooler, so ``dsn``
+    should point at the database directly.
+    """
+    applied = []
+    conn = psycopg2.connect(dsn)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            try:
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                version = current_version(cur)
+                for migration in MIGRATIONS:
+                    if migration.version <= version or migration.version > target:
+                        continue
+                    print(f"Applying migration {migration.version}: {migration.name}")
+                    _apply(conn, migration)
+                    applied.append(migration.version)
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+    finally:
+        conn.close()
+    return applied
+
+
+def _apply(conn, migration):
+    record = "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)"
+    if migration.concurrent:
+        with conn.cursor() as cur:
+            for statement in migration.statements:
+                _execute_concurrently(cur, statement)
+            cur.execute(record, (migration.version, migration.name))
+        return
+
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            for statement in migration.statements:
+                cur.execute(statement)
+            cur.execute(record, (migration.version, migration.name))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+
+_INDEX_NAME = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)',
+    re.IGNORECASE
+)
+
+
+def _execute_concurrently(cur, statement):
+    """Run a concurrent index build, replacing an invalid leftover index.
+
+    An interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index behind
+    that IF NOT EXISTS would silently keep, so drop it and build again.
+    """
+    cur.execute(statement)
+    match = _INDEX_NAME.search(statement)
+    if not match:
+        return
+    index = match.group(1)
+    cur.execute(
+        "SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(%s) AND NOT indisvalid",
+        (index,)
+    )
+    if cur.fetchone():
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")
+        cur.execute(statement)
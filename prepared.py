@@ -0,0 +1,77 @@
+import threading
+import weakref
+
+import psycopg2.errors
+
+import queries
+
+
+class PreparedStatements:
+    """Runs registered queries.* statements as server-side prepared
+    statements (PREPARE once per connection, then EXECUTE).
+
+    What is prepared is tracked per connection object, so a replacement
+    connection from the pool (after a reconnect, or max_lifetime) is
+    prepared afresh on first use. Prepared statements live in the server
+    session, so connections that go through a transaction-mode pooler,
+    where consecutive transactions can land on different server sessions,
+    must be passed to ``skip`` (typically from the pool's on_connect) to
+    run the same queries unprepared.
+    """
+
+    def __init__(self, statements, enabled=True):
+        self.enabled = enabled
+        self._statements = {}
+        for name, query in statements.items():
+            text, names = queries.positional(query)
+            self._statements[query] = (name, text, names)
+        self._prepared = weakref.WeakKeyDictionary()
+        self._skipped = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self.prepares = 0
+        self.executions = 0
+
+    def skip(self, conn):
+        """Never prepare statements on ``conn``"""
+        with self._lock:
+            self._skipped.add(conn)
+
+    def handles(self, cur, query):
+        return (
+            self.enabled and query in self._statements
+            and cur.connection not in self._skipped
+        )
+
+    def execute(self, cur, query, params):
+        name, text, names = self._statements[query]
+        with self._lock:
+            prepared = self._prepared.setdefault(cur.connection, set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {text}")
+            prepared.add(name)
+            with self._lock:
+                self.prepares += 1
+        try:
+            if names:
+                placeholders = ', '.join(['%s'] * len(names))
+                cur.execute(f"EXECUTE {name} ({placeholders})", [params[key] for key in names])
+            else:
+                cur.execute(f"EXECUTE {name}")
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The session lost it (e.g. it was reset under us); this
+            # transaction is gone, but the next one will prepare again
+            prepared.discard(name)
+            raise
+        with self._lock:
+            self.executions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'statements': len(self._statements),
+                'connections': len(self._prepared),
+                'unprepared_connections': len(self._skipped),
+                'prepares': self.prepares,
+                'executions': self.executions,
+            }
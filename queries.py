@@ -0,0 +1,337 @@
+"""SQL shared by the sync (psycopg2) and async (asyncpg) data layers.
+
+Statements use psycopg2's named ``%(name)s`` placeholders; ``positional``
+rewrites them to asyncpg's ``$n`` form, so both layers run the same text.
+Casts are explicit wherever asyncpg couldn't infer a parameter's type.
+"""
+import re
+
+from search import SEARCH_CONFIG
+
+# Body columns for messages aliased m, LEFT JOINed to message_blobs b on
+# m.blob_hash; deduplicated rows keep their body in the blob
+MESSAGE_BODY = """
+    COALESCE(b.content, m.content) AS content,
+    COALESCE(b.content_z, m.content_z) AS content_z,
+    COALESCE(b.codec, m.codec) AS codec
+"""
+
+PUBLISH_WRITE = """
+    WITH bumped AS (
+        INSERT INTO chat_versions (username, version) VALUES (%(username)s, 1)
+        ON CONFLICT (username)
+        DO UPDATE SET version = chat_versions.version + 1
+        RETURNING version
+    )
+    SELECT pg_notify(%(channel)s, json_build_object(
+        'username', %(username)s::text, 'chat_id', %(chat_id)s::text,
+        'version', bumped.version, 'origin', %(origin)s::text
+    )::text)
+    FROM bumped
+"""
+
+LOCK_CHAT = """
+    SELECT chat_id, title, model, message_count, chat_data
+    FROM chats
+    WHERE chat_id = %(chat_id)s AND username = %(username)s
+    FOR UPDATE
+"""
+
+BACKFILL_CHAT = """
+    UPDATE chats
+    SET title = COALESCE(%(title)s, title),
+        model = COALESCE(%(model)s, model),
+        allow_downgrade = %(allow_downgrade)s,
+        message_count = message_count + %(added)s,
+        chat_data = NULL
+    WHERE chat_id = %(chat_id)s
+"""
+
+SAVE_CHAT_METADATA = """
+    INSERT INTO chats
+        (chat_id, username, title, model, allow_downgrade, created_at)
+    VALUES (
+        %(chat_id)s, %(username)s, %(title)s, %(model)s,
+        COALESCE(%(allow_downgrade)s::boolean, FALSE),
+        COALESCE(%(created_at)s::timestamp, NOW())
+    )
+    ON CONFLICT (chat_id) DO UPDATE
+    SET title = COALESCE(%(title)s, chats.title),
+        model = COALESCE(%(model)s, chats.model),
+        allow_downgrade = COALESCE(%(allow_downgrade)s::boolean, chats.allow_downgrade),
+        updated_at = NOW()
+    WHERE chats.username = EXCLUDED.username
+"""
+
+UPDATE_SAVED_CHAT = """
+    UPDATE chats
+    SET title = COALESCE(%(title)s, title),
+        model = COALESCE(%(model)s, model),
+        allow_downgrade = COALESCE(%(allow_downgrade)s::boolean, allow_downgrade),
+        message_count = message_count + %(added)s, updated_at = NOW()
+    WHERE chat_id = %(chat_id)s AND username = %(username)s
+"""
+
+INSERT_SAVED_CHAT = """
+    INSERT INTO chats
+        (chat_id, username, title, model, allow_downgrade,
+         message_count, created_at)
+    VALUES (
+        %(chat_id)s, %(username)s, %(title)s, %(model)s, %(allow_downgrade)s,
+        %(added)s, COALESCE(%(created_at)s::timestamp, NOW())
+    )
+"""
+
+INSERT_NEW_CHAT = """
+    INSERT INTO chats (chat_id, username, title, model)
+    VALUES (%(chat_id)s, %(username)s, 'New Chat', %(model)s)
+"""
+
+UPDATE_APPENDED_CHAT = """
+    UPDATE chats
+    SET title = %(title)s, model = COALESCE(%(model)s, model),
+        message_count = message_count + %(added)s, updated_at = NOW()
+    WHERE chat_id = %(chat_id)s
+    RETURNING chat_id, title, model, allow_downgrade, created_at, updated_at
+"""
+
+TOUCH_CHAT = """
+    UPDATE chats SET updated_at = NOW() WHERE chat_id = %(chat_id)s
+"""
+
+# One row per array element; seq counts up from first_seq. branch_id is
+# NULL for the chat's main line
+INSERT_MESSAGES = f"""
+    INSERT INTO messages
+        (chat_id, branch_id, seq, role, content, content_z, codec, blob_hash,
+         model, downgraded, search_vector)
+    SELECT %(chat_id)s::text, %(branch_id)s::text,
+           %(first_seq)s::integer + m.ord::integer - 1, m.role,
+           m.content, m.content_z, m.codec, m.blob_hash, m.model, m.downgraded,
+           to_tsvector('{SEARCH_CONFIG}', m.body)
+    FROM unnest(
+        %(roles)s::text[], %(contents)s::text[], %(contents_z)s::bytea[],
+        %(codecs)s::text[], %(blob_hashes)s::bytea[], %(models)s::text[],
+        %(downgraded)s::boolean[], %(bodies)s::text[]
+    ) WITH ORDINALITY
+        AS m (role, content, content_z, codec, blob_hash, model, downgraded,
+              body, ord)
+"""
+
+SELECT_USER_CHATS = """
+    SELECT chat_id, title, model, allow_downgrade, created_at, updated_at,
+           chat_data
+    FROM chats
+    WHERE username = %(username)s
+    ORDER BY updated_at DESC
+"""
+
+SELECT_CHAT = """
+    SELECT chat_id, title, model, allow_downgrade, created_at, updated_at,
+           chat_data
+    FROM chats
+    WHERE chat_id = %(chat_id)s AND username = %(username)s
+"""
+
+SELECT_CHAT_MESSAGES = f"""
+    SELECT m.chat_id, m.role, {MESSAGE_BODY}, m.model, m.downgraded
+    FROM messages m
+    LEFT JOIN message_blobs b ON b.hash = m.blob_hash
+    WHERE m.chat_id = ANY(%(chat_ids)s::text[]) AND m.branch_id IS NULL
+    ORDER BY m.chat_id, m.seq
+"""
+
+# The main line's latest messages below seq ``before`` (NULL: the newest),
+# newest first; callers fetch one extra row to learn whether more remain
+SELECT_CHAT_WINDOW = f"""
+    SELECT m.seq, m.role, {MESSAGE_BODY}, m.model, m.downgraded
+    FROM messages m
+    LEFT JOIN message_blobs b ON b.hash = m.blob_hash
+    WHERE m.chat_id = %(chat_id)s AND m.branch_id IS NULL
+      AND (%(before)s::integer IS NULL OR m.seq < %(before)s)
+    ORDER BY m.seq DESC
+    LIMIT %(limit)s
+"""
+
+# Keyset pages of a user's chats on (updated_at, chat_id); the first page
+# has no keyset bound so it can use the index without an OR
+SELECT_CHAT_SUMMARIES = """
+    SELECT chat_id, title, model, message_count, updated_at
+    FROM chats
+    WHERE username = %(username)s
+    ORDER BY updated_at DESC, chat_id DESC
+    LIMIT %(limit)s
+"""
+
+SELECT_CHAT_SUMMARIES_AFTER = """
+    SELECT chat_id, title, model, message_count, updated_at
+    FROM chats
+    WHERE username = %(username)s
+      AND (updated_at, chat_id) < (%(updated_at)s::timestamp, %(chat_id)s::text)
+    ORDER BY updated_at DESC, chat_id DESC
+    LIMIT %(limit)s
+"""
+
+# A batch of whole chats in chat_id order, one row per main-line message;
+# NULL ``username`` exports every user, ``after`` resumes past a chat id
+EXPORT_CHATS = f"""
+    SELECT c.chat_id, c.username, c.title AS chat_title,
+           c.model AS chat_model, c.allow_downgrade, c.created_at,
+           c.updated_at, c.chat_data,
+           m.seq, m.role, {MESSAGE_BODY}, m.model, m.downgraded
+    FROM (
+        SELECT *
+        FROM chats
+        WHERE (%(username)s::text IS NULL OR username = %(username)s)
+          AND (%(after)s::text IS NULL OR chat_id > %(after)s)
+        ORDER BY chat_id
+        LIMIT %(limit)s
+    ) c
+    LEFT JOIN messages m
+           ON m.chat_id = c.chat_id AND m.branch_id IS NULL
+    LEFT JOIN message_blobs b ON b.hash = m.blob_hash
+    ORDER BY c.chat_id, m.seq
+"""
+
+LOCK_BRANCH = """
+    SELECT branch_id, chat_id, parent_branch_id, fork_seq, message_count
+    FROM chat_branches
+    WHERE branch_id = %(branch_id)s AND chat_id = %(chat_id)s
+    FOR UPDATE
+"""
+
+FIND_BRANCH = """
+    SELECT 1 FROM chat_branches
+    WHERE branch_id = %(branch_id)s AND chat_id = %(chat_id)s
+"""
+
+INSERT_BRANCH = """
+    INSERT INTO chat_branches
+        (branch_id, chat_id, parent_branch_id, fork_seq, title)
+    VALUES (%(branch_id)s, %(chat_id)s, %(parent_branch_id)s, %(fork_seq)s, %(title)s)
+    RETURNING branch_id, parent_branch_id, fork_seq, message_count, title,
+              created_at, updated_at
+"""
+
+SELECT_BRANCHES = """
+    SELECT branch_id, parent_branch_id, fork_seq, message_count, title,
+           created_at, updated_at
+    FROM chat_branches
+    WHERE chat_id = %(chat_id)s
+    ORDER BY created_at, branch_id
+"""
+
+# A branch's linear history: walk up to the main line, taking from each
+# ancestor only the messages below the lowest fork point seen so far
+SELECT_BRANCH_MESSAGES = f"""
+    WITH RECURSIVE lineage AS (
+        SELECT branch_id, parent_branch_id, fork_seq, NULL::integer AS upto
+        FROM chat_branches
+        WHERE branch_id = %(branch_id)s AND chat_id = %(chat_id)s
+        UNION ALL
+        SELECT b.branch_id, b.parent_branch_id, b.fork_seq,
+               LEAST(l.upto, l.fork_seq)
+        FROM chat_branches b
+        JOIN lineage l ON b.branch_id = l.parent_branch_id
+    ), segments AS (
+        SELECT branch_id, upto FROM lineage
+        UNION ALL
+        SELECT NULL, LEAST(upto, fork_seq) FROM lineage WHERE parent_branch_id IS NULL
+    )
+    SELECT m.seq, m.branch_id, m.role, {MESSAGE_BODY}, m.model, m.downgraded
+    FROM segments s
+    JOIN messages m
+      ON m.chat_id = %(chat_id)s
+     AND (m.branch_id = s.branch_id OR (s.branch_id IS NULL AND m.branch_id IS NULL))
+     AND (s.upto IS NULL OR m.seq < s.upto)
+    LEFT JOIN message_blobs b ON b.hash = m.blob_hash
+    ORDER BY m.seq
+"""
+
+UPDATE_BRANCH_COUNT = """
+    UPDATE chat_branches
+    SET message_count = message_count + %(added)s, updated_at = NOW()
+    WHERE branch_id = %(branch_id)s
+    RETURNING branch_id, parent_branch_id, fork_seq, message_count, title,
+              created_at, updated_at
+"""
+
+SELECT_DICTIONARY = """
+    SELECT dictionary FROM compression_dictionaries WHERE id = %(id)s
+"""
+
+DELETE_EXCESS_CHATS = """
+    WITH old_chats AS (
+        SELECT chat_id
+        FROM chats
+        WHERE username = %(username)s
+        ORDER BY updated_at DESC, chat_id DESC
+        OFFSET %(keep)s
+    )
+    DELETE FROM chats
+    WHERE chat_id IN (SELECT chat_id FROM old_chats)
+"""
+
+# Take a reference on the blobs that exist; returns the hashes found
+REFERENCE_BLOBS = """
+    UPDATE message_blobs AS b
+    SET refcount = b.refcount + v.n, last_referenced_at = NOW()
+    FROM unnest(%(hashes)s::bytea[], %(counts)s::integer[]) AS v (hash, n)
+    WHERE b.hash = v.hash
+    RETURNING b.hash
+"""
+
+INSERT_BLOBS = """
+    INSERT INTO message_blobs (hash, content, content_z, codec, size, refcount)
+    SELECT * FROM unnest(
+        %(hashes)s::bytea[], %(contents)s::text[], %(contents_z)s::bytea[],
+        %(codecs)s::text[], %(sizes)s::integer[], %(counts)s::integer[]
+    )
+    ON CONFLICT (hash) DO UPDATE
+    SET refcount = message_blobs.refcount + EXCLUDED.refcount,
+        last_referenced_at = NOW()
+"""
+
+RELEASE_CHAT_BLOBS = """
+    UPDATE message_blobs AS b
+    SET refcount = b.refcount - r.n
+    FROM (
+        SELECT blob_hash, count(*) AS n
+        FROM messages
+        WHERE chat_id = %(chat_id)s AND blob_hash IS NOT NULL AND chat_id IN (
+            SELECT chat_id FROM chats WHERE username = %(username)s
+        )
+        GROUP BY blob_hash
+    ) AS r
+    WHERE b.hash = r.blob_hash
+"""
+
+DELETE_CHAT_MESSAGES = """
+    DELETE FROM messages
+    WHERE chat_id = %(chat_id)s AND chat_id IN (
+        SELECT chat_id FROM chats WHERE username = %(username)s
+    )
+"""
+
+DELETE_CHAT = """
+    DELETE FROM chats
+    WHERE chat_id = %(chat_id)s AND username = %(username)s
+"""
+
+_PARAMETER = re.compile(r"%\((\w+)\)s")
+
+
+def positional(query):
+    """Rewrite named placeholders as ``$1, $2, ...``.
+
+    Returns ``(query, names)``; pass ``[params[name] for name in names]``
+    as the arguments.
+    """
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return _PARAMETER.sub(number, query), names
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+
+# Reads for a user stay on the primary this long after any write of theirs
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+# How often the replica's replay lag is re-measured
+REPLICA_LAG_CHECK = float(os.getenv('REPLICA_LAG_CHECK', 2))
+
+
+class ReplicaRouter:
+    """Decides whether a user's read may go to the read replica.
+
+    Read-your-writes comes from two rules: a user who wrote (on this
+    instance, or on another one as reported by the invalidation listener)
+    within the last ``sticky_seconds`` reads from the primary, and nobody
+    reads from the replica while its measured replay lag is as long as that
+    window, since the window would then no longer cover the lag. Lag is
+    measured by ``measure_lag()`` at most every ``lag_check`` seconds; a
+    failed measurement (or connection) keeps reads on the primary until the
+    next one succeeds.
+    """
+
+    def __init__(self, measure_lag, sticky_seconds=REPLICA_STICKY_SECONDS,
+                 lag_check=REPLICA_LAG_CHECK):
+        self.measure_lag = measure_lag
+        self.sticky_seconds = sticky_seconds
+        self.lag_check = lag_check
+        self.lag = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._writes = {}
+        self._checked_at = 0
+        self._checking = False
+
+    def note_write(self, username):
+        now = time.monotonic()
+        with self._lock:
+            self._writes[username] = now
+            if len(self._writes) > 10000:
+                # Forget users whose window has passed
+                cutoff = now - self.sticky_seconds
+                self._writes = {
+                    name: at for name, at in self._writes.items() if at > cutoff
+                }
+
+    def mark_failed(self):
+        with self._lock:
+            self.lag = None
+            self.failures += 1
+
+    def _refresh_lag(self):
+        with self._lock:
+            if self._checking or time.monotonic() - self._checked_at < self.lag_check:
+                return
+            self._checking = True
+        failed = False
+        try:
+            lag = self.measure_lag()
+        except Exception as e:
+            print(f"Replica lag check failed: {e}")
+            lag, failed = None, True
+        with self._lock:
+            self.lag = lag
+            self.failures += failed
+            self._checked_at = time.monotonic()
+            self._checking = False
+
+    def use_replica(self, username=None):
+        """True if a read for ``username`` (None: no particular user) can
+        safely be served by the replica"""
+        self._refresh_lag()
+        now = time.monotonic()
+        with self._lock:
+            replica = self.lag is not None and self.lag < self.sticky_seconds
+            if replica and username is not None:
+                replica = now - self._writes.get(username, float('-inf')) > self.sticky_seconds
+            if replica:
+                self.replica_reads += 1
+            else:
+                self.primary_reads += 1
+            return replica
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lag_seconds': self.lag,
+                'sticky_seconds': self.sticky_seconds,
+                'replica_reads': self.replica_reads,
+                'primary_reads': self.primary_reads,
+                'failures': self.failures,
+                'sticky_users': len(self._writes),
+            }
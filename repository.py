@@ -0,0 +1,283 @@
+"""The one place application code gets its data from.
+
+Chat data goes through a storage backend chosen by DB_BACKEND: database.py
+(Postgres over pooled psycopg2 connections) or database_sqlite.py (an
+embedded SQLite file); only the chosen one is imported. Users and password
+checks use the Postgres pool with direct SQL when it is available, or
+PostgREST over one shared, pooled HTTP session, which replaces a Supabase
+client and its own connections. Without Postgres they default to 'local':
+the users configured in the environment (USERnn_PASSWORD/USERnn_NAME),
+whose passwords may be plain or werkzeug hashes. Every operation is timed
+by name; see ``stats()``.
+"""
+import functools
+import hmac
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.security import check_password_hash
+
+# 'sql', 'rest', 'local', or 'auto' (SQL, falling back to PostgREST if it
+# fails); anything but 'rest' means 'local' when DB_BACKEND isn't postgres
+AUTH_BACKEND = os.getenv('AUTH_BACKEND', 'auto')
+REST_POOL_SIZE = int(os.getenv('REST_POOL_SIZE', 10))
+REST_TIMEOUT = float(os.getenv('REST_TIMEOUT', 10))
+DB_BACKEND = os.getenv('DB_BACKEND', 'postgres').lower()
+
+# DB_BACKEND -> module implementing the chat operations
+BACKENDS = {
+    'postgres': 'database',
+    'sqlite': 'database_sqlite',
+}
+
+
+class QueryTimings:
+    """Call count, errors and latency per named query"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                stats = self._stats.setdefault(
+                    name, {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+                )
+                stats['calls'] += 1
+                stats['errors'] += failed
+                stats['total_ms'] += elapsed
+                stats['max_ms'] = max(stats['max_ms'], elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    'calls': stats['calls'],
+                    'errors': stats['errors'],
+                    'avg_ms': round(stats['total_ms'] / stats['calls'], 2),
+                    'max_ms': round(stats['max_ms'], 2),
+                }
+                for name, stats in sorted(self._stats.items())
+            }
+
+
+def _timed(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.timings.timed(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class Repository:
+    def __init__(self, supabase_url=None, supabase_key=None, auth_backend=AUTH_BACKEND,
+                 backend=DB_BACKEND, local_users=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown DB_BACKEND {backend!r}; expected one of {sorted(BACKENDS)}")
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.backend = backend
+        self.db = importlib.import_module(BACKENDS[backend])
+        self.BranchError = self.db.BranchError
+        self.permanent_errors = self.db.PERMANENT_ERRORS
+        self.local_users = local_users or {}
+        # Without Postgres there is no pool to run auth SQL on
+        if backend != 'postgres' and auth_backend != 'rest':
+            auth_backend = 'local'
+        self.auth_backend = auth_backend
+        self.timings = QueryTimings()
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    # PostgREST
+
+    def _rest(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REST_POOL_SIZE)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update({
+                        'apikey': self.supabase_key,
+                        'Authorization': f"Bearer {self.supabase_key}",
+                    })
+                    self._session = session
+        return self._session
+
+    def _rest_url(self, path):
+        return f"{self.supabase_url.rstrip('/')}/rest/v1/{path}"
+
+    def _rest_get_user(self, username):
+        response = self._rest().get(
+            self._rest_url('auth.users'),
+            params={'select': '*', 'username': f"eq.{username}"},
+            timeout=REST_TIMEOUT
+        )
+        response.raise_for_status()
+        users = response.json()
+        return users[0] if users else None
+
+    def _rest_verify_password(self, password, hashed_password):
+        response = self._rest().post(
+            self._rest_url('rpc/verify_password'),
+            json={'input_password': password, 'hashed_password': hashed_password},
+            timeout=REST_TIMEOUT
+        )
+        response.raise_for_status()
+        return bool(response.json())
+
+    # Direct SQL
+
+    def _sql_get_user(self, username):
+        with self.db.get_db_cursor() as cursor:
+            cursor.execute("SELECT * FROM auth.users WHERE username = %s", (username,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def _sql_verify_password(self, password, hashed_password):
+        with self.db.get_db_cursor() as cursor:
+            cursor.execute("SELECT verify_password(%s, %s)", (password, hashed_password))
+            return bool(cursor.fetchone()[0])
+
+    # Local users
+
+    def _local_get_user(self, username):
+        user = self.local_users.get(username)
+        if not user or not user.get('password'):
+            return None
+        return {
+            'username': username,
+            'name': user.get('name') or username,
+            'password': user['password'],
+        }
+
+    def _local_verify_password(self, password, stored):
+        if stored.startswith(('pbkdf2:', 'scrypt:')):
+            return check_password_hash(stored, password)
+        return hmac.compare_digest(password.encode(), stored.encode())
+
+    def _auth(self, sql, rest, local, *args):
+        if self.auth_backend == 'local':
+            return local(*args)
+        if self.auth_backend == 'rest':
+            return rest(*args)
+        if self.auth_backend == 'sql':
+            return sql(*args)
+        import psycopg2  # 'auto' only happens with the Postgres backend
+        try:
+            return sql(*args)
+        except (psycopg2.ProgrammingError, psycopg2.OperationalError) as e:
+            # The table or function isn't reachable over SQL (missing
+            # grants, not exposed); PostgREST will be from now on
+            print(f"Direct SQL auth failed, using PostgREST: {e}")
+            if isinstance(e, psycopg2.ProgrammingError):
+                self.auth_backend = 'rest'
+            return rest(*args)
+
+    # Users
+
+    @_timed
+    def get_user(self, username):
+        """The user's row (with the password hash), or None"""
+        return self._auth(self._sql_get_user, self._rest_get_user, self._local_get_user,
+                          username)
+
+    @_timed
+    def verify_password(self, password, hashed_password):
+        return self._auth(self._sql_verify_password, self._rest_verify_password,
+                          self._local_verify_password, password, hashed_password)
+
+    def init_db(self):
+        return self.db.init_db()
+
+    # Chats
+
+    @_timed
+    def save_chat(self, username, chat_id, chat_data):
+        return self.db.save_chat(username, chat_id, chat_data)
+
+    @_timed
+    def append_messages(self, username, chat_id, messages, model=None):
+        return self.db.append_messages(username, chat_id, messages, model=model)
+
+    @_timed
+    def get_chat(self, username, chat_id):
+        return self.db.get_chat(username, chat_id)
+
+    @_timed
+    def get_chat_window(self, username, chat_id, limit=50, before=None):
+        return self.db.get_chat_window(username, chat_id, limit=limit, before=before)
+
+    @_timed
+    def get_chat_summaries(self, username, limit=50, cursor=None):
+        return self.db.get_chat_summaries(username, limit=limit, cursor=cursor)
+
+    @_timed
+    def get_user_chats(self, username):
+        return self.db.get_user_chats(username)
+
+    @_timed
+    def fork_chat(self, username, chat_id, at_seq, parent_branch_id=None, title=None):
+        return self.db.fork_chat(username, chat_id, at_seq,
+                                  parent_branch_id=parent_branch_id, title=title)
+
+    @_timed
+    def list_branches(self, username, chat_id):
+        return self.db.list_branches(username, chat_id)
+
+    @_timed
+    def get_branch_history(self, username, chat_id, branch_id):
+        return self.db.get_branch_history(username, chat_id, branch_id)
+
+    @_timed
+    def append_branch_messages(self, username, chat_id, branch_id, messages):
+        return self.db.append_branch_messages(username, chat_id, branch_id, messages)
+
+    @_timed
+    def delete_user_chat(self, username, chat_id):
+        return self.db.delete_user_chat(username, chat_id)
+
+    @_timed
+    def delete_old_chats(self, username):
+        return self.db.delete_old_chats(username)
+
+    @_timed
+    def search_messages(self, username, query, limit=20, cursor=None):
+        return self.db.search_messages(username, query, limit=limit, cursor=cursor)
+
+    @_timed
+    def search_chat_titles(self, username, query, limit=10):
+        return self.db.search_chat_titles(username, query, limit=limit)
+
+    @_timed
+    def warm_chat_cache(self, username):
+        return self.db.warm_chat_cache(username)
+
+    def export_chats(self, username=None, after=None):
+        """Like database.export_chats; timed until the stream is finished"""
+        with self.timings.timed('export_chats'):
+            yield from self.db.export_chats(username, after=after)
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'auth_backend': self.auth_backend,
+            'queries': self.timings.stats(),
+        }
@@ -0,0 +1,197 @@
+import hashlib
+import math
+import operator
+import os
+import random
+import re
+import threading
+from collections import OrderedDict, deque
+
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() == 'true'
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.95))
+SEMANTIC_CACHE_MAX_TEMPERATURE = float(os.getenv('SEMANTIC_CACHE_MAX_TEMPERATURE', 0.3))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 2000))
+SEMANTIC_CACHE_MAX_VECTORS = int(os.getenv('SEMANTIC_CACHE_MAX_VECTORS', 500))
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.getenv('SEMANTIC_CACHE_EMBEDDING_MODEL', 'text-embedding-3-small')
+# Fraction of semantic hits re-answered in the background to estimate false hits
+SEMANTIC_CACHE_SAMPLE_RATE = float(os.getenv('SEMANTIC_CACHE_SAMPLE_RATE', 0.02))
+SEMANTIC_CACHE_ANSWER_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_ANSWER_THRESHOLD', 0.85))
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_prompt(text):
+    """Collapse whitespace and case so trivially different prompts match"""
+    return _whitespace.sub(' ', text).strip().casefold()
+
+
+def single_turn_prompt(messages):
+    """Return the prompt of a single-turn conversation, or None"""
+    turns = [message for message in messages if message.get('role') != 'system']
+    if len(turns) != 1 or turns[0].get('role') != 'user':
+        return None
+    system = [message['content'] for message in messages if message.get('role') == 'system']
+    return '\n'.join(system + [turns[0]['content']])
+
+
+def _unit(vector):
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else vector
+
+
+def _dot(a, b):
+    return sum(map(operator.mul, a, b))
+
+
+class ResponseCache:
+    """Exact and embedding-similarity cache for single-turn completions.
+
+    ``embed`` maps text to a vector (or raises); when it fails the cache
+    falls back to exact matching only. Entries are scoped to the user who
+    asked, so one user's answer is never served to another.
+    """
+
+    def __init__(self, embed, threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.embed = embed
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._exact = OrderedDict()
+        # (username, model) -> deque of (vector, prompt, response), least
+        # recently used scope first; SEMANTIC_CACHE_MAX_VECTORS caps the total
+        self._vectors = OrderedDict()
+        self._vector_count = 0
+        self.lookups = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.sampled = 0
+        self.false_hits = 0
+        self.samples = deque(maxlen=50)
+
+    def eligible(self, messages, temperature, opt_in):
+        return (
+            SEMANTIC_CACHE_ENABLED and opt_in
+            and temperature <= SEMANTIC_CACHE_MAX_TEMPERATURE
+            and single_turn_prompt(messages) is not None
+        )
+
+    def _key(self, username, model, prompt):
+        return hashlib.sha256(f"{username}\0{model}\0{prompt}".encode()).hexdigest()
+
+    def _embed(self, prompt):
+        try:
+            return _unit(self.embed(prompt))
+        except Exception as e:
+            print(f"Cache embedding error: {e}")
+            return None
+
+    def get(self, model, messages, verify=None, username=None):
+        """Return ``(response, kind, vector)``.
+
+        On a miss ``response`` and ``kind`` are None and ``vector`` is the
+        prompt's embedding if one was computed, to be handed back to
+        ``put`` so a cacheable miss is only embedded once. ``verify`` is
+        called with no arguments for a sampled fraction of semantic hits
+        and should return a fresh answer, or None when it could not get one;
+        it runs in the background and feeds the false-hit metrics.
+        """
+        prompt = normalize_prompt(single_turn_prompt(messages))
+        key = self._key(username, model, prompt)
+        with self._lock:
+            self.lookups += 1
+            if key in self._exact:
+                self._exact.move_to_end(key)
+                self.exact_hits += 1
+                return self._exact[key], 'exact', None
+            scope = (username, model)
+            candidates = list(self._vectors.get(scope, ()))
+            if candidates:
+                self._vectors.move_to_end(scope)
+
+        if not candidates:
+            return None, None, None
+        vector = self._embed(prompt)
+        if vector is None:
+            return None, None, None
+
+        best, best_score = None, -1.0
+        for candidate in candidates:
+            score = _dot(vector, candidate[0])
+            if score > best_score:
+                best, best_score = candidate, score
+        if best_score < self.threshold:
+            return None, None, vector
+
+        _, cached_prompt, response = best
+        with self._lock:
+            self.semantic_hits += 1
+        if verify and random.random() < SEMANTIC_CACHE_SAMPLE_RATE:
+            threading.Thread(
+                target=self._check_hit,
+                args=(prompt, cached_prompt, best_score, response, verify),
+                daemon=True
+            ).start()
+        return response, 'semantic', vector
+
+    def put(self, model, messages, response, vector=None, username=None):
+        """Cache ``response``; ``vector`` is the embedding ``get`` returned"""
+        prompt = normalize_prompt(single_turn_prompt(messages))
+        key = self._key(username, model, prompt)
+        with self._lock:
+            self._exact[key] = response
+            self._exact.move_to_end(key)
+            while len(self._exact) > SEMANTIC_CACHE_MAX_ENTRIES:
+                self._exact.popitem(last=False)
+
+        if vector is None:
+            vector = self._embed(prompt)
+        if vector is None:
+            return
+        with self._lock:
+            scope = (username, model)
+            self._vectors.setdefault(scope, deque()).append((vector, prompt, response))
+            self._vectors.move_to_end(scope)
+            self._vector_count += 1
+            while self._vector_count > SEMANTIC_CACHE_MAX_VECTORS:
+                oldest_scope, oldest = next(iter(self._vectors.items()))
+                oldest.popleft()
+                self._vector_count -= 1
+                if not oldest:
+                    del self._vectors[oldest_scope]
+
+    def _check_hit(self, prompt, cached_prompt, similarity, cached_response, verify):
+        try:
+            fresh = verify()
+            if fresh is None:
+                # The re-answer failed; an error string says nothing about the hit
+                return
+            agreement = _dot(self._embed(cached_response), self._embed(fresh))
+        except Exception as e:
+            print(f"Cache false-hit sampling error: {e}")
+            return
+        with self._lock:
+            self.sampled += 1
+            if agreement < SEMANTIC_CACHE_ANSWER_THRESHOLD:
+                self.false_hits += 1
+            # Hashes only: these samples are served by /metrics
+            self.samples.append({
+                'prompt': hashlib.sha256(prompt.encode()).hexdigest()[:16],
+                'cached_prompt': hashlib.sha256(cached_prompt.encode()).hexdigest()[:16],
+                'similarity': round(similarity, 4),
+                'answer_similarity': round(agreement, 4),
+            })
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            return {
+                'threshold': self.threshold,
+                'lookups': self.lookups,
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'hit_rate': round(hits / self.lookups, 4) if self.lookups else 0.0,
+                'entries': len(self._exact),
+                'sampled_hits': self.sampled,
+                'false_hits': self.false_hits,
+                'false_hit_rate': round(self.false_hits / self.sampled, 4) if self.sampled else 0.0,
+                'recent_samples': list(self.samples),
+            }
@@ -0,0 +1,96 @@
+import os
+import threading
+
+import psycopg2
+
+import database
+
+RETENTION_ENABLED = os.getenv('RETENTION_ENABLED', 'true').lower() == 'true'
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))
+# 0 keeps messages forever; otherwise whole months older than this are dropped
+MESSAGE_RETENTION_MONTHS = int(os.getenv('MESSAGE_RETENTION_MONTHS', 0))
+RETENTION_DETACH_ONLY = os.getenv('RETENTION_DETACH_ONLY', 'false').lower() == 'true'
+
+# Arbitrary key for the advisory lock that keeps passes from overlapping
+RETENTION_LOCK_KEY = 7235002
+
+
+class RetentionWorker:
+    """Runs retention passes in the background every ``interval`` seconds.
+
+    A pass creates upcoming message partitions, drops (or detaches) the
+    monthly partitions and chats past the retention horizon, trims each
+    user to their ``keep_chats`` most recent chats, and then collects the
+    message blobs nothing references any more. Only one instance runs a
+    pass at a time; the others skip it.
+    """
+
+    def __init__(self, interval=RETENTION_INTERVAL,
+                 retention_months=MESSAGE_RETENTION_MONTHS,
+                 keep_chats=database.CHAT_HISTORY_LIMIT,
+                 detach_only=RETENTION_DETACH_ONLY):
+        self.interval = interval
+        self.retention_months = retention_months
+        self.keep_chats = keep_chats
+        self.detach_only = detach_only
+        self.passes = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_result = None
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def run_once(self):
+        """Run one pass; returns what it did, or None if another instance
+        holds the retention lock"""
+        conn = psycopg2.connect(database.get_direct_database_url())
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (RETENTION_LOCK_KEY,))
+                if not cur.fetchone()[0]:
+                    self.skipped += 1
+                    return None
+
+            result = {'partitions_created': database.ensure_message_partitions()}
+            if self.retention_months > 0:
+                result['partitions_removed'] = database.drop_expired_message_partitions(
+                    self.retention_months, detach_only=self.detach_only
+                )
+                result['chats_expired'] = database.delete_expired_chats(self.retention_months)
+            if self.keep_chats > 0:
+                result['chats_trimmed'] = database.enforce_chat_limits(self.keep_chats)
+            result['blobs_collected'] = database.collect_message_blobs()
+            result['message_blobs'] = database.message_blob_stats()
+            self.passes += 1
+            self.last_result = result
+            return result
+        finally:
+            # Closing the session releases the advisory lock
+            conn.close()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self.failures += 1
+                print(f"Retention pass error: {e}")
+            self._stopping.wait(self.interval)
+
+    def stats(self):
+        return {
+            'retention_months': self.retention_months,
+            'keep_chats': self.keep_chats,
+            'passes': self.passes,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'last_result': self.last_result,
+        }
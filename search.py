@@ -0,0 +1,42 @@
+import re
+
+SEARCH_CONFIG = 'english'
+# to_tsvector rejects very large inputs and keeps positions only up to
+# 16383, so only the start of huge messages is indexed
+SEARCH_TEXT_LIMIT = 100000
+SNIPPET_LENGTH = 160
+
+
+def search_text(content):
+    return content[:SEARCH_TEXT_LIMIT]
+
+
+def lexeme_pattern(lexemes):
+    """Regex matching words that start with any of the query's stemmed
+    lexemes, e.g. 'run' matches 'running'; None if there are none"""
+    if not lexemes:
+        return None
+    alternatives = '|'.join(re.escape(lexeme) for lexeme in sorted(lexemes, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternatives})\w*", re.IGNORECASE)
+
+
+def snippet(text, pattern, length=SNIPPET_LENGTH):
+    """A window of ``text`` around the first match, with the character
+    offsets of every match inside it.
+
+    Returns ``{'text': ..., 'highlights': [[start, end], ...]}``.
+    """
+    first = pattern.search(text) if pattern else None
+    if first is None:
+        return {'text': text[:length], 'highlights': []}
+    start = max(0, first.start() - length // 3)
+    # Don't start mid-word
+    if start:
+        space = text.find(' ', start, first.start())
+        start = space + 1 if space >= 0 else start
+    end = min(len(text), start + length)
+    window = text[start:end]
+    return {
+        'text': window,
+        'highlights': [[match.start(), match.end()] for match in pattern.finditer(window)],
+    }
@@ -1,6 +1,9 @@
 let currentModel = 'gpt-3.5-turbo';
 let currentChat = null;
 let chats = {};
+let nextChatsCursor = null;
+let loadingChats = false;
+let loadingOlderMessages = false;
 
 // Initialize the application
 document.addEventListener('DOMContentLoaded', function() {
@@ -47,15 +50,18 @@ function setupEventListeners() {
     document.getElementById('user-input').addEventListener('keypress', handleInputKeypress);
     document.getElementById('send-btn').addEventListener('click', sendMessage);
     document.getElementById('model-select').addEventListener('change', handleModelChange);
+    document.getElementById('allow-downgrade').addEventListener('change', handleDowngradeToggle);
     document.getElementById('user-input').addEventListener('input', autoResizeTextarea);
+    document.getElementById('chat-list').addEventListener('scroll', handleChatListScroll);
+    document.getElementById('messages').addEventListener('scroll', handleMessagesScroll);
 }
 
-function formatMessage(content, isAI = false) {
+function formatMessage(content, isAI = false, note = '') {
     try {
         // Check if marked is available
         if (typeof marked === 'undefined') {
             console.warn('Marked library not loaded, falling back to basic formatting');
-            return basicFormatting(content, isAI);
+            return basicFormatting(content, isAI, note);
         }
 
         // Process markdown content
@@ -78,18 +84,19 @@ function formatMessage(content, isAI = false) {
         // Convert markdown to HTML using marked.parse
         formattedContent = marked.parse ? marked.parse(formattedContent) : marked(formattedContent);
 
-        return createMessageHTML(formattedContent, isAI);
+        return createMessageHTML(formattedContent, isAI, note);
     } catch (error) {
         console.error('Error formatting message:', error);
-        return basicFormatting(content, isAI);
+        return basicFormatting(content, isAI, note);
     }
 }
 
-function basicFormatting(content, isAI) {
+function basicFormatting(content, isAI, note = '') {
     return `
         <div class="message ${isAI ? 'ai-message' : 'user-message'}">
             <div class="message-header">
                 <span class="role-label">${isAI ? 'AI' : 'You'}</span>
+                ${note ? `<span class="message-note">${note}</span>` : ''}
             </div>
             <div class="message-content">
                 <p>${content}</p>
@@ -98,11 +105,12 @@ function basicFormatting(content, isAI) {
     `;
 }
 
-function createMessageHTML(content, isAI) {
+function createMessageHTML(content, isAI, note = '') {
     return `
         <div class="message ${isAI ? 'ai-message' : 'user-message'}">
             <div class="message-header">
                 <span class="role-label">${isAI ? 'AI' : 'You'}</span>
+                ${note ? `<span class="message-note">${note}</span>` : ''}
             </div>
             <div class="message-content markdown">
                 ${content}
@@ -113,19 +121,85 @@ function createMessageHTML(content, isAI) {
 
 
 async function loadChats() {
+    await loadChatPage();
+
+    // If there are chats, select the most recent one
+    const chatIds = Object.keys(chats);
+    if (chatIds.length > 0) {
+        switchChat(chatIds[0]);
+    }
+}
+
+// Fetch one page of chat summaries; messages are loaded when a chat is opened
+async function loadChatPage(cursor = null) {
+    if (loadingChats) return;
+    loadingChats = true;
     try {
-        const response = await fetch('/get_chats');
+        const url = cursor ? `/chats?cursor=${encodeURIComponent(cursor)}` : '/chats';
+        const response = await fetch(url);
         const data = await response.json();
-        chats = data.chats || {};
+        (data.chats || []).forEach(summary => {
+            if (!chats[summary.id]) {
+                chats[summary.id] = summary;
+            }
+        });
+        nextChatsCursor = data.next_cursor || null;
         updateChatList();
-        
-        // If there are chats, select the most recent one
-        const chatIds = Object.keys(chats);
-        if (chatIds.length > 0) {
-            switchChat(chatIds[0]);
-        }
     } catch (error) {
         console.error('Error loading chats:', error);
+    } finally {
+        loadingChats = false;
+    }
+}
+
+function handleChatListScroll(e) {
+    const list = e.target;
+    if (nextChatsCursor && list.scrollTop + list.clientHeight >= list.scrollHeight - 50) {
+        loadChatPage(nextChatsCursor);
+    }
+}
+
+async function loadChatMessages(chatId) {
+    const chat = chats[chatId];
+    if (chat.messages) return chat;
+
+    const response = await fetch(`/chats/${encodeURIComponent(chatId)}`);
+    const data = await response.json();
+    if (data.chat) {
+        Object.assign(chat, data.chat);
+    } else {
+        chat.messages = [];
+    }
+    return chat;
+}
+
+// Chats are opened with only their latest messages; fetch older ones
+// a window at a time as the user scrolls up
+function handleMessagesScroll(e) {
+    const chat = chats[currentChat];
+    if (chat && chat.before != null && e.target.scrollTop < 50) {
+        loadOlderMessages(currentChat);
+    }
+}
+
+async function loadOlderMessages(chatId) {
+    if (loadingOlderMessages) return;
+    loadingOlderMessages = true;
+    try {
+        const chat = chats[chatId];
+        const response = await fetch(
+            `/chats/${encodeURIComponent(chatId)}/messages?before=${chat.before}`
+        );
+        const data = await response.json();
+        chat.messages = (data.messages || []).concat(chat.messages);
+        chat.before = data.before;
+        if (currentChat === chatId) {
+            displayMessages(chat.messages, true);
+        }
+    } catch (error) {
+        console.error('Error loading older messages:', error);
+    } finally {
+        loadingOlderMessages = false;
     }
 }
 
@@ -137,6 +211,13 @@ function handleModelChange(e) {
     }
 }
 
+function handleDowngradeToggle(e) {
+    if (currentChat) {
+        chats[currentChat].allowDowngrade = e.target.checked;
+        saveChat(currentChat, chats[currentChat]);
+    }
+}
+
 async function handleLogout() {
     try {
         const response = await fetch('/logout', {
@@ -158,7 +239,8 @@ async function createNewChat() {
         title: 'New Chat',
         model: currentModel,
         messages: [],
-        created_at: new Date().toISOString()
+        created_at: new Date().toISOString(),
+        updated_at: new Date().toISOString()
     };
     
     chats[chatId] = chat;
@@ -170,6 +252,8 @@ async function createNewChat() {
 }
 
 async function saveChat(chatId, chatData) {
+    // Messages are stored server-side as they are sent; only save metadata
+    const { messages, ...metadata } = chatData;
     try {
         await fetch('/save_chat', {
             method: 'POST',
@@ -178,7 +262,7 @@ async function saveChat(chatId, chatData) {
             },
             body: JSON.stringify({
                 chatId: chatId,
-                chatData: chatData
+                chatData: metadata
             }),
         });
     } catch (error) {
@@ -196,11 +280,11 @@ function updateChatList() {
     const chatList = document.getElementById('chat-list');
     chatList.innerHTML = '';
     
-    // Sort chats by created_at in descending order
+    // Sort chats by updated_at in descending order, matching the server
     const sortedChats = Object.entries(chats)
         .sort(([,a], [,b]) => {
-            const dateA = new Date(a.created_at || 0);
-            const dateB = new Date(b.created_at || 0);
+            const dateA = new Date(a.updated_at || a.created_at || 0);
+            const dateB = new Date(b.updated_at || b.created_at || 0);
             return dateB - dateA;
         });
 
@@ -257,20 +341,30 @@ function updateChatList() {
     });
 }
 
-function switchChat(chatId) {
+async function switchChat(chatId) {
     currentChat = chatId;
-    const chat = chats[chatId];
+    let chat = chats[chatId];
+    try {
+        chat = await loadChatMessages(chatId);
+    } catch (error) {
+        console.error('Error loading chat:', error);
+        return;
+    }
+    if (currentChat !== chatId) return;
     currentModel = chat.model;
     document.getElementById('model-select').value = currentModel;
+    document.getElementById('allow-downgrade').checked = !!chat.allowDowngrade;
     displayMessages(chat.messages);
 }
 
-function displayMessages(messages) {
+function displayMessages(messages, keepPosition = false) {
     const messagesContainer = document.getElementById('messages');
+    const distanceFromBottom = messagesContainer.scrollHeight - messagesContainer.scrollTop;
     messagesContainer.innerHTML = '';
     
     messages.forEach(message => {
-        const formattedMessage = formatMessage(message.content, message.role === 'assistant');
+        const note = message.downgraded ? `answered by ${message.model} (high load)` : '';
+        const formattedMessage = formatMessage(message.content, message.role === 'assistant', note);
         messagesContainer.insertAdjacentHTML('beforeend', formattedMessage);
     });
     
@@ -293,16 +387,20 @@ function displayMessages(messages) {
         hljs.highlightBlock(block);
     });
     
-    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    if (keepPosition) {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight - distanceFromBottom;
+    } else {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    }
 }
 
 async function sendMessage() {
     const input = document.getElementById('user-input');
     const message = input.value.trim();
     
-    if (!message || !currentChat) return;
-    
     const chat = chats[currentChat];
+    if (!message || !chat || !chat.messages) return;
+
     input.value = '';
     autoResizeTextarea();
 
@@ -311,14 +409,18 @@ async function sendMessage() {
     displayMessages(chat.messages);
     
     try {
-        const response = await fetch('/send_message', {
+        // The server owns the history: send only the new message and it
+        // loads, extends and saves the chat in one round trip
+        const response = await fetch('/conversation', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
             body: JSON.stringify({
+                chat_id: currentChat,
+                new_message: message,
                 model: chat.model,
-                messages: chat.messages
+                allowDowngrade: !!chat.allowDowngrade
             }),
         });
         
@@ -326,18 +428,19 @@ async function sendMessage() {
         
         if (data.response) {
             // Add assistant message
-            chat.messages.push({ role: 'assistant', content: data.response });
+            const reply = { role: 'assistant', content: data.response };
+            if (data.downgraded) {
+                reply.model = data.model;
+                reply.downgraded = true;
+            }
+            chat.messages.push(reply);
             displayMessages(chat.messages);
             
-            // Save chat after receiving response
-            await saveChat(currentChat, chat);
-            
-            // Update chat title if it's still the default
-            if (chat.title === 'New Chat' && chat.messages.length >= 2) {
-                chat.title = chat.messages[0].content.substring(0, 30) + '...';
-                updateChatList();
-                await saveChat(currentChat, chat);
+            chat.updated_at = new Date().toISOString();
+            if (data.title) {
+                chat.title = data.title;
             }
+            updateChatList();
         }
     } catch (error) {
         console.error('Error sending message:', error);
@@ -0,0 +1,73 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bulkheads import Bulkhead, BulkheadFull, BulkheadRegistry
+
+
+class BulkheadTest(unittest.TestCase):
+    def setUp(self):
+        self.bulkhead = Bulkhead('test', max_concurrent=2, max_queue=1)
+        self.release = threading.Event()
+        # Cleanups run last-in first-out: release the workers, then shut down
+        self.addCleanup(self.bulkhead._executor.shutdown)
+        self.addCleanup(self.release.set)
+
+    def blocked(self):
+        self.release.wait(5)
+        return 'done'
+
+    def test_rejects_once_workers_and_queue_are_full(self):
+        futures = [self.bulkhead.submit(self.blocked) for _ in range(3)]
+        with self.assertRaises(BulkheadFull):
+            self.bulkhead.submit(self.blocked)
+        self.assertEqual(self.bulkhead.stats()['rejected'], 1)
+
+        self.release.set()
+        self.assertEqual([future.result(timeout=5) for future in futures], ['done'] * 3)
+        # Finished work frees its slots
+        self.assertEqual(self.bulkhead.submit(lambda: 'again').result(timeout=5), 'again')
+        stats = self.bulkhead.stats()
+        self.assertEqual((stats['active'], stats['queued'], stats['completed']), (0, 0, 4))
+
+    def test_failing_work_still_frees_its_slot(self):
+        def fail():
+            raise ValueError('boom')
+
+        for _ in range(4):
+            with self.assertRaises(ValueError):
+                self.bulkhead.submit(fail).result(timeout=5)
+        self.assertEqual(self.bulkhead.stats()['rejected'], 0)
+
+
+class BulkheadRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = BulkheadRegistry({
+            'fast': {'match': ['mini', 'haiku'], 'max_concurrent': 2, 'max_queue': 2},
+            'slow': {'match': ['opus'], 'max_concurrent': 1, 'max_queue': 0},
+        }, default_class='fast')
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        for bulkhead in self.registry.bulkheads.values():
+            bulkhead._executor.shutdown()
+
+    def test_models_route_to_their_class(self):
+        self.assertEqual(self.registry.classify('anthropic/claude-3-opus'), 'slow')
+        self.assertEqual(self.registry.classify('gpt-4o-mini'), 'fast')
+        self.assertEqual(self.registry.classify('unknown-model'), 'fast')
+        self.assertIs(self.registry.for_model('claude-3-haiku'), self.registry.bulkheads['fast'])
+
+    def test_a_saturated_class_does_not_block_the_others(self):
+        self.registry.for_model('opus').submit(self.release.wait, 5)
+        with self.assertRaises(BulkheadFull):
+            self.registry.for_model('opus').submit(self.release.wait, 5)
+        self.assertEqual(self.registry.for_model('mini').submit(lambda: 1).result(timeout=5), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
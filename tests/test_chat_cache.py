@@ -0,0 +1,96 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_cache import ChatCache, _estimate_size
+
+
+class Loader:
+    """Counts loads; ``during`` runs mid-load, like a concurrent write"""
+
+    def __init__(self, value, during=None):
+        self.value = value
+        self.during = during
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.during:
+            self.during()
+        return self.value
+
+
+class ChatCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ChatCache(max_bytes=10_000, enabled=True)
+        self.cache.validate = False
+
+    def test_hits_after_the_first_load(self):
+        loader = Loader({'title': 'a'})
+        key = ('alice', 'c1', 'chat')
+        self.assertEqual(self.cache.get(key, loader), {'title': 'a'})
+        self.assertEqual(self.cache.get(key, loader), {'title': 'a'})
+        self.assertEqual(loader.calls, 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_a_write_during_the_load_keeps_the_stale_value_out(self):
+        key = ('alice', 'c1', 'chat')
+        stale = Loader({'title': 'old'},
+                       during=lambda: self.cache.invalidate_chat('alice', 'c1'))
+        self.assertEqual(self.cache.get(key, stale), {'title': 'old'})
+
+        fresh = Loader({'title': 'new'})
+        self.assertEqual(self.cache.get(key, fresh), {'title': 'new'})
+        self.assertEqual(fresh.calls, 1)
+
+    def test_invalidating_a_chat_drops_it_and_the_listings_only(self):
+        chat, other, listing = ('alice', 'c1', 'chat'), ('alice', 'c2', 'chat'), ('alice', None, 'list')
+        for key in (chat, other, listing):
+            self.cache.get(key, Loader(key[1]))
+        self.cache.invalidate_chat('alice', 'c1')
+
+        loaders = {key: Loader(key[1]) for key in (chat, other, listing)}
+        for key, loader in loaders.items():
+            self.cache.get(key, loader)
+        self.assertEqual([loaders[key].calls for key in (chat, other, listing)], [1, 0, 1])
+
+    def test_least_recently_used_entries_are_evicted_past_max_bytes(self):
+        value = {'body': 'x' * 100}
+        self.cache.max_bytes = _estimate_size(value) * 2
+        first, second, third = (('alice', f"c{i}", 'chat') for i in range(3))
+        self.cache.get(first, Loader(value))
+        self.cache.get(second, Loader(value))
+        self.cache.get(first, Loader(value))  # first is now the most recent
+        self.cache.get(third, Loader(value))
+
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertLessEqual(self.cache.stats()['bytes'], self.cache.max_bytes)
+        reloads = {key: Loader(value) for key in (first, second)}
+        for key, loader in reloads.items():
+            self.cache.get(key, loader)
+        self.assertEqual((reloads[first].calls, reloads[second].calls), (0, 1))
+
+    def test_values_larger_than_the_cache_are_not_stored(self):
+        self.cache.max_bytes = 10
+        loader = Loader({'body': 'x' * 100})
+        key = ('alice', 'c1', 'chat')
+        self.cache.get(key, loader)
+        self.cache.get(key, loader)
+        self.assertEqual((loader.calls, self.cache.stats()['entries']), (2, 0))
+
+    def test_validation_misses_when_the_write_version_moved(self):
+        versions = {'alice': 1}
+        self.cache.validate = True
+        self.cache.validator = versions.get
+        key = ('alice', 'c1', 'chat')
+        self.cache.get(key, Loader('v1'))
+        self.assertEqual(self.cache.get(key, Loader('unused')), 'v1')
+        versions['alice'] = 2
+        self.assertEqual(self.cache.get(key, Loader('v2')), 'v2')
+
+
+if __name__ == '__main__':
+    unittest.main()
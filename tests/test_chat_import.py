@@ -0,0 +1,119 @@
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_import import InvalidChat, iter_json_array, normalize_chat, read_export
+
+
+def node(node_id, parent, role=None, text=None, content_type='text'):
+    message = None
+    if role:
+        message = {
+            'author': {'role': role},
+            'content': {'content_type': content_type, 'parts': [text]},
+            'create_time': 1700000000,
+        }
+    return node_id, {'id': node_id, 'parent': parent, 'message': message}
+
+
+def conversation(*nodes, current_node):
+    return {
+        'conversation_id': 'abc', 'title': 'Trip', 'default_model_slug': 'gpt-4',
+        'create_time': 1700000000, 'update_time': 1700000100,
+        'mapping': dict(nodes), 'current_node': current_node,
+    }
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def test_elements_span_chunk_boundaries(self):
+        elements = [{'text': 'has ] and , inside'}, [1, [2, 3]], 'x' * 50, None]
+        document = ' \n' + json.dumps(elements, indent=2)
+        self.assertEqual(list(iter_json_array(io.StringIO(document), chunk_size=7)), elements)
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array(io.StringIO(' [ ] '), chunk_size=2)), [])
+
+    def test_malformed_input_raises(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('{"not": "an array"}')))
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('[{"a": 1}, {"b": '), chunk_size=4))
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('[1, 2'), chunk_size=4))
+
+
+class ReadExportTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.scratch.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.scratch.name, name)
+
+    def test_reads_json_arrays_and_gzipped_ndjson(self):
+        chats = [{'id': 'c1'}, {'id': 'c2'}]
+        with open(self.path('conversations.json'), 'w', encoding='utf-8') as f:
+            json.dump(chats, f)
+        with gzip.open(self.path('export.jsonl.gz'), 'wt', encoding='utf-8') as f:
+            f.write('\n'.join(json.dumps(chat) for chat in chats) + '\n\n')
+
+        self.assertEqual(list(read_export(self.path('conversations.json'))), chats)
+        self.assertEqual(list(read_export(self.path('export.jsonl.gz'))), chats)
+
+
+class NormalizeChatTest(unittest.TestCase):
+    def test_chatgpt_conversation_follows_the_current_branch(self):
+        raw = conversation(
+            node('root', None),
+            node('sys', 'root', 'system', 'You are helpful'),
+            node('q', 'sys', 'user', 'Plan a trip'),
+            node('a1', 'q', 'assistant', 'Abandoned answer'),
+            node('a2', 'q', 'assistant', 'Go to Lisbon'),
+            node('tool', 'a2', 'assistant', 'print(1)', content_type='code'),
+            current_node='tool',
+        )
+        chat = normalize_chat(raw)
+        self.assertEqual((chat['id'], chat['title'], chat['model']), ('chatgpt-abc', 'Trip', 'gpt-4'))
+        self.assertEqual(
+            [(message['role'], message['content']) for message in chat['messages']],
+            [('user', 'Plan a trip'), ('assistant', 'Go to Lisbon')]
+        )
+        self.assertIsInstance(chat['messages'][0]['timestamp'], datetime)
+
+    def test_exported_chat_round_trips(self):
+        chat = normalize_chat({
+            'id': 'c1', 'username': 'alice', 'title': 'T', 'model': 'm',
+            'created_at': '2024-01-02T03:04:05',
+            'messages': [{'role': 'user', 'content': 'hi', 'timestamp': None}],
+        })
+        self.assertEqual(chat['created_at'], datetime(2024, 1, 2, 3, 4, 5))
+        self.assertFalse(chat['allowDowngrade'])
+        self.assertEqual(chat['messages'][0]['content'], 'hi')
+
+    def test_malformed_chats_raise_invalid_chat(self):
+        malformed = [
+            ['not', 'an', 'object'],
+            conversation(node('q', 'gone', 'user', 'hi'), current_node='q'),
+            {'id': 'c1', 'created_at': 'yesterday', 'messages': []},
+            {'id': 'c1', 'messages': [{'role': 'tool', 'content': 'x'}]},
+            {'id': 'c1', 'messages': [{'role': 'user', 'content': None}]},
+            {'id': 'x' * 201, 'messages': []},
+            {'messages': []},
+        ]
+        for raw in malformed:
+            with self.subTest(raw=str(raw)[:40]):
+                with self.assertRaises(InvalidChat):
+                    normalize_chat(raw)
+
+
+if __name__ == '__main__':
+    unittest.main()
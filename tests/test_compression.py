@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+from compression import MessageCodecs, train_dictionary
+
+BODY = "Traceback (most recent call last):\n  File \"app.py\", line 12\n" * 40
+
+
+def samples(count=2000):
+    return [
+        f"user {i} asked about order {i * 7} shipping to city {i % 13}; "
+        f"the assistant replied with tracking number TRK{i:08d} and an apology"
+        for i in range(count)
+    ]
+
+
+class MessageCodecsTest(unittest.TestCase):
+    def setUp(self):
+        self.codecs = MessageCodecs(threshold=64)
+
+    def assertRoundTrips(self, text):
+        encoded = self.codecs.encode(text)
+        self.assertEqual(self.codecs.decode(*encoded), text)
+        return encoded
+
+    def test_short_bodies_stay_plain(self):
+        self.assertEqual(self.assertRoundTrips('hello'), ('hello', None, None))
+
+    def test_bodies_compression_would_grow_stay_plain(self):
+        self.codecs.threshold = 8
+        with mock.patch.object(compression, 'zstandard', None):
+            self.assertEqual(self.assertRoundTrips('qwertyuiop'), ('qwertyuiop', None, None))
+
+    def test_zlib_round_trip_without_zstandard(self):
+        with mock.patch.object(compression, 'zstandard', None):
+            content, content_z, codec = self.assertRoundTrips(BODY + ' naïve ✓')
+        self.assertEqual((content, codec), (None, 'zlib'))
+        self.assertLess(len(content_z), len(BODY))
+        # zlib rows stay readable, with or without zstandard
+        self.assertEqual(self.codecs.decode(None, memoryview(content_z), 'zlib'), BODY + ' naïve ✓')
+
+    def test_dictionary_id_parses_the_codec_marker(self):
+        self.assertEqual(self.codecs.dictionary_id('zstd:7'), 7)
+        self.assertIsNone(self.codecs.dictionary_id('zstd'))
+        self.assertIsNone(self.codecs.dictionary_id(None))
+
+    @unittest.skipIf(compression.zstandard is not None, "zstandard is installed")
+    def test_zstd_rows_need_zstandard(self):
+        with self.assertRaises(RuntimeError):
+            self.codecs.decode(None, b'\x28\xb5\x2f\xfd', 'zstd')
+        with self.assertRaises(RuntimeError):
+            train_dictionary(samples())
+
+
+@unittest.skipIf(compression.zstandard is None, "zstandard is not installed")
+class ZstdCodecsTest(unittest.TestCase):
+    def setUp(self):
+        self.codecs = MessageCodecs(threshold=64)
+
+    def test_zstd_round_trip_without_a_dictionary(self):
+        content, content_z, codec = self.codecs.encode(BODY)
+        self.assertEqual((content, codec), (None, 'zstd'))
+        self.assertEqual(self.codecs.decode(content, content_z, codec), BODY)
+
+    def test_round_trip_with_the_active_dictionary(self):
+        self.codecs.add_dictionary(3, train_dictionary(samples(), size=4096), active=True)
+        text = samples(2001)[-1] + ' ' + samples(2002)[-1]
+        content, content_z, codec = self.codecs.encode(text)
+        self.assertEqual((content, codec), (None, 'zstd:3'))
+        self.assertEqual(self.codecs.dictionary_id(codec), 3)
+        self.assertEqual(self.codecs.decode(content, content_z, codec), text)
+
+        # Rows written before the dictionary existed still decode
+        plain = MessageCodecs(threshold=64).encode(BODY)
+        self.assertEqual(self.codecs.decode(*plain), BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()
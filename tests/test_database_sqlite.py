@@ -0,0 +1,114 @@
+"""Smoke tests for the embedded SQLite backend (DB_BACKEND=sqlite).
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database_sqlite as db
+
+
+def turns(*contents):
+    return [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': content}
+        for i, content in enumerate(contents)
+    ]
+
+
+class SQLiteBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        self.previous_path = os.environ.get('SQLITE_PATH')
+        os.environ['SQLITE_PATH'] = os.path.join(self.scratch.name, 'test.db')
+        db.close_db()
+        db.init_db()
+
+    def tearDown(self):
+        db.close_db()
+        if self.previous_path is None:
+            del os.environ['SQLITE_PATH']
+        else:
+            os.environ['SQLITE_PATH'] = self.previous_path
+        self.scratch.cleanup()
+
+    def test_save_and_append(self):
+        db.save_chat('alice', 'c1', {
+            'title': 'Parsing', 'model': 'gpt-4o-mini',
+            'messages': turns('how do I parse yaml', 'use a yaml library'),
+        })
+        # Full-list saves only append the messages not stored yet
+        db.save_chat('alice', 'c1', {
+            'messages': turns('how do I parse yaml', 'use a yaml library', 'which one'),
+        })
+        db.append_messages('alice', 'c1', turns('ruamel', 'thanks'), model='gpt-4o')
+
+        chat = db.get_chat('alice', 'c1')
+        self.assertEqual(
+            [message['content'] for message in chat['messages']],
+            ['how do I parse yaml', 'use a yaml library', 'which one', 'ruamel', 'thanks']
+        )
+        self.assertEqual(chat['title'], 'Parsing')
+        self.assertIsNone(db.get_chat('bob', 'c1'))
+
+    def test_window_pages_back_to_the_start(self):
+        db.save_chat('alice', 'c1', {'messages': turns(*[f"m{i}" for i in range(7)])})
+
+        window = db.get_chat_window('alice', 'c1', limit=3)
+        self.assertEqual([m['seq'] for m in window['messages']], [4, 5, 6])
+        seqs = []
+        before = window['before']
+        while before is not None:
+            page = db.get_chat_window('alice', 'c1', limit=3, before=before)
+            seqs = [m['seq'] for m in page['messages']] + seqs
+            before = page['before']
+        self.assertEqual(seqs, [0, 1, 2, 3])
+
+    def test_fork_shares_history_below_the_fork_point(self):
+        db.save_chat('alice', 'c1', {'messages': turns('a', 'b', 'c', 'd')})
+
+        branch = db.fork_chat('alice', 'c1', 2)
+        db.append_branch_messages('alice', 'c1', branch['id'], turns('c2', 'd2'))
+        history = db.get_branch_history('alice', 'c1', branch['id'])
+        self.assertEqual([m['content'] for m in history], ['a', 'b', 'c2', 'd2'])
+        self.assertEqual([m['seq'] for m in history], [0, 1, 2, 3])
+
+        # The main line is untouched
+        main = db.get_chat('alice', 'c1')
+        self.assertEqual([m['content'] for m in main['messages']], ['a', 'b', 'c', 'd'])
+        self.assertIsNone(db.get_branch_history('alice', 'c1', 'no-such-branch'))
+        with self.assertRaises(db.BranchError):
+            db.fork_chat('alice', 'c1', 9)
+
+    def test_search_pages_across_branches(self):
+        db.save_chat('alice', 'c1', {
+            'messages': turns('stack trace in parser', 'retry the parser', 'parser again'),
+        })
+        branch = db.fork_chat('alice', 'c1', 1)
+        db.append_branch_messages('alice', 'c1', branch['id'], turns('parser branch reply'))
+        db.save_chat('bob', 'c2', {'messages': turns('parser for bob')})
+
+        found = []
+        cursor = None
+        while True:
+            page = db.search_messages('alice', 'parser', limit=1, cursor=cursor)
+            found.extend((r['chat_id'], r['branch_id'], r['seq']) for r in page['results'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        # Branch seqs repeat the main line's, yet every hit appears once
+        self.assertEqual(len(found), 4)
+        self.assertEqual(len(set(found)), 4)
+        self.assertTrue(all(chat_id == 'c1' for chat_id, _, _ in found))
+
+        excluded = db.search_messages('alice', 'parser -retry')
+        self.assertEqual(len(excluded['results']), 3)
+        with self.assertRaises(ValueError):
+            db.search_messages('alice', 'parser', cursor='not-a-cursor')
+
+
+if __name__ == '__main__':
+    unittest.main()
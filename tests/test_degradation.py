@@ -0,0 +1,82 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import degradation
+from bulkheads import BulkheadRegistry
+from degradation import DegradationPolicy
+
+# Queue lengths at the thresholds, for the slow class' queue of 10
+DEGRADE_QUEUED = int(10 * degradation.DEGRADE_QUEUE_FRACTION)
+RESTORE_QUEUED = int(10 * degradation.DEGRADE_RESTORE_FRACTION)
+
+
+class Latencies:
+    """recent_latency from a per-model table"""
+
+    def __init__(self):
+        self.latency = {}
+
+    def recent_latency(self, model, horizon, pct):
+        return self.latency.get(model)
+
+
+class DegradationPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = BulkheadRegistry({
+            'slow': {'match': ['opus'], 'max_concurrent': 1, 'max_queue': 10,
+                     'fallback': 'haiku', 'degrade_latency': 20},
+            'fast': {'match': ['haiku'], 'max_concurrent': 1, 'max_queue': 10},
+        }, default_class='fast')
+        self.latencies = Latencies()
+        self.policy = DegradationPolicy(self.registry, self.latencies)
+
+    def tearDown(self):
+        for bulkhead in self.registry.bulkheads.values():
+            bulkhead._executor.shutdown()
+
+    def queue(self, count):
+        """Pretend ``count`` requests are waiting in the slow bulkhead"""
+        self.registry.bulkheads['slow'].queued = count
+
+    def route(self, **kwargs):
+        kwargs.setdefault('allow_downgrade', True)
+        return self.policy.route('opus', **kwargs)
+
+    def test_healthy_classes_keep_the_requested_model(self):
+        self.queue(DEGRADE_QUEUED - 1)
+        self.assertEqual(self.route(), ('opus', False))
+        self.assertEqual(self.policy.route('haiku', allow_downgrade=True), ('haiku', False))
+
+    def test_queue_threshold_degrades_and_restores_with_hysteresis(self):
+        self.queue(DEGRADE_QUEUED)
+        self.assertEqual(self.route(), ('haiku', True))
+        # Still degraded until the queue drains below the restore fraction
+        self.queue(RESTORE_QUEUED + 1)
+        self.assertEqual(self.route(), ('haiku', True))
+        self.queue(RESTORE_QUEUED)
+        self.assertEqual(self.route(), ('opus', False))
+        self.assertEqual(self.policy.stats(), {'degraded_classes': [], 'downgrades': 2})
+
+    def test_latency_threshold_degrades_and_restores_with_hysteresis(self):
+        self.latencies.latency['opus'] = 20
+        self.assertEqual(self.route(), ('haiku', True))
+        self.latencies.latency['opus'] = 20 * degradation.DEGRADE_LATENCY_RESTORE
+        self.assertEqual(self.route(), ('haiku', True))
+        self.latencies.latency['opus'] -= 0.1
+        self.assertEqual(self.route(), ('opus', False))
+
+    def test_only_opted_in_requests_are_downgraded(self):
+        self.queue(DEGRADE_QUEUED)
+        self.assertEqual(self.route(username='alice', allow_downgrade=False), ('opus', False))
+        with mock.patch.object(degradation, 'DEGRADE_OPT_IN_USERS', {'alice'}):
+            self.assertEqual(self.route(username='alice', allow_downgrade=False), ('haiku', True))
+        # The class stays marked degraded either way
+        self.assertEqual(self.policy.stats()['degraded_classes'], ['slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
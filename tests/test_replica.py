@@ -0,0 +1,94 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import replica
+from replica import ReplicaRouter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Lag:
+    """measure_lag that returns ``value`` or raises it"""
+
+    def __init__(self, value=0.1):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+class ReplicaRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(replica.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lag = Lag()
+        self.router = ReplicaRouter(self.lag, sticky_seconds=5, lag_check=2)
+
+    def test_writer_reads_from_the_primary_for_the_sticky_window(self):
+        self.assertTrue(self.router.use_replica('alice'))
+        self.router.note_write('alice')
+        self.assertFalse(self.router.use_replica('alice'))
+        # Other users and user-less reads are unaffected
+        self.assertTrue(self.router.use_replica('bob'))
+        self.assertTrue(self.router.use_replica())
+
+        self.clock.now += 5
+        self.assertFalse(self.router.use_replica('alice'))
+        self.clock.now += 0.1
+        self.assertTrue(self.router.use_replica('alice'))
+        stats = self.router.stats()
+        self.assertEqual((stats['replica_reads'], stats['primary_reads']), (4, 2))
+
+    def test_lag_as_long_as_the_window_keeps_everyone_on_the_primary(self):
+        self.lag.value = 5
+        self.assertFalse(self.router.use_replica('alice'))
+        self.assertFalse(self.router.use_replica())
+
+    def test_lag_is_measured_at_most_every_lag_check(self):
+        for _ in range(3):
+            self.router.use_replica()
+        self.assertEqual(self.lag.calls, 1)
+        self.clock.now += 2
+        self.router.use_replica()
+        self.assertEqual(self.lag.calls, 2)
+
+    def test_failures_keep_reads_on_the_primary_until_the_next_good_check(self):
+        self.lag.value = OSError('replica down')
+        self.assertFalse(self.router.use_replica())
+
+        self.lag.value = 0.1
+        self.assertFalse(self.router.use_replica())  # not re-checked yet
+        self.clock.now += 2
+        self.assertTrue(self.router.use_replica())
+
+        self.router.mark_failed()
+        self.assertFalse(self.router.use_replica())
+        self.assertEqual(self.router.stats()['failures'], 2)
+
+    def test_old_writes_are_forgotten_once_the_table_is_large(self):
+        for i in range(10000):
+            self.router.note_write(f"user{i}")
+        self.clock.now += 6
+        self.router.note_write('alice')
+        self.router.note_write('bob')
+        self.assertEqual(self.router.stats()['sticky_users'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import response_cache
+from response_cache import ResponseCache
+
+
+def ask(prompt, system=None):
+    messages = [{'role': 'system', 'content': system}] if system else []
+    return messages + [{'role': 'user', 'content': prompt}]
+
+
+class StubEmbedder:
+    """Embeds the texts it was given vectors for; anything else fails"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        return self.vectors[text]
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.embed = StubEmbedder({
+            'what is a monad': [1.0, 0.0],
+            'explain monads': [0.99, 0.14],
+            'how do i bake bread': [0.0, 1.0],
+            'answer a': [1.0, 0.0],
+            'answer b': [0.0, 1.0],
+        })
+        self.cache = ResponseCache(self.embed, threshold=0.95)
+
+    def test_eligible_only_for_opted_in_cold_single_turn_prompts(self):
+        self.assertTrue(self.cache.eligible(ask('hi', system='be brief'), 0.0, True))
+        self.assertFalse(self.cache.eligible(ask('hi'), 0.0, False))
+        self.assertFalse(self.cache.eligible(ask('hi'), 0.9, True))
+        follow_up = ask('hi') + [{'role': 'assistant', 'content': 'hello'},
+                                 {'role': 'user', 'content': 'again'}]
+        self.assertFalse(self.cache.eligible(follow_up, 0.0, True))
+
+    def test_exact_hit_ignores_case_and_whitespace(self):
+        self.cache.put('m', ask('What is  a monad'), 'answer a', username='alice')
+        response, kind, _ = self.cache.get('m', ask('what is a MONAD '), username='alice')
+        self.assertEqual((response, kind), ('answer a', 'exact'))
+        # Other models miss
+        self.assertEqual(self.cache.get('other', ask('what is a monad'), username='alice')[:2],
+                         (None, None))
+
+    def test_entries_are_scoped_to_the_user(self):
+        self.cache.put('m', ask('what is a monad'), 'answer a', username='alice')
+        self.assertEqual(self.cache.get('m', ask('what is a monad'), username='bob')[:2],
+                         (None, None))
+        self.assertEqual(self.cache.get('m', ask('explain monads'), username='bob')[:2],
+                         (None, None))
+
+    def test_semantic_hit_needs_the_threshold(self):
+        self.cache.put('m', ask('what is a monad'), 'answer a', username='alice')
+        response, kind, vector = self.cache.get('m', ask('explain monads'), username='alice')
+        self.assertEqual((response, kind), ('answer a', 'semantic'))
+
+        response, kind, vector = self.cache.get('m', ask('how do i bake bread'), username='alice')
+        self.assertEqual((response, kind, vector), (None, None, [0.0, 1.0]))
+        # The miss's embedding is reused rather than computed again
+        calls = self.embed.calls
+        self.cache.put('m', ask('how do i bake bread'), 'answer b', vector, username='alice')
+        self.assertEqual(self.embed.calls, calls)
+
+    def test_exact_entries_are_evicted_least_recently_used_first(self):
+        with mock.patch.object(response_cache, 'SEMANTIC_CACHE_MAX_ENTRIES', 2):
+            self.cache.put('m', ask('one'), '1', [1.0, 0.0])
+            self.cache.put('m', ask('two'), '2', [1.0, 0.0])
+            self.cache.get('m', ask('one'))
+            self.cache.put('m', ask('three'), '3', [1.0, 0.0])
+        self.assertEqual(self.cache.get('m', ask('one'))[:2], ('1', 'exact'))
+        self.assertEqual(self.cache.get('m', ask('three'))[:2], ('3', 'exact'))
+        self.assertNotEqual(self.cache.get('m', ask('two'))[1], 'exact')
+
+    def test_vectors_are_capped_across_users(self):
+        with mock.patch.object(response_cache, 'SEMANTIC_CACHE_MAX_VECTORS', 2):
+            self.cache.put('m', ask('one'), '1', [1.0, 0.0], username='alice')
+            self.cache.put('m', ask('two'), '2', [0.0, 1.0], username='bob')
+            self.cache.put('m', ask('three'), '3', [0.0, 1.0], username='bob')
+        # alice's scope was the least recently used and has been dropped
+        self.assertEqual(self.cache.get('m', ask('explain monads'), username='alice')[:2],
+                         (None, None))
+        self.assertEqual(self.cache._vector_count, 2)
+
+    def test_failed_re_answers_are_not_sampled(self):
+        self.cache._check_hit('explain monads', 'what is a monad', 0.99, 'answer a',
+                              verify=lambda: None)
+        self.assertEqual((self.cache.sampled, self.cache.false_hits), (0, 0))
+
+        self.cache._check_hit('explain monads', 'what is a monad', 0.99, 'answer a',
+                              verify=lambda: 'answer b')
+        self.assertEqual((self.cache.sampled, self.cache.false_hits), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import timeouts
+from timeouts import (
+    DEFAULT_BUDGET, SLOW_MODEL_BUDGET, TIMEOUT_FACTOR, TIMEOUT_MIN_SAMPLES,
+    TIMEOUT_STEP, TimeoutPolicies
+)
+
+
+class TimeoutPoliciesTest(unittest.TestCase):
+    def setUp(self):
+        self.policies = TimeoutPolicies(window=100)
+
+    def observe(self, count, first_byte, total, model='m'):
+        for _ in range(count):
+            self.policies.record(model, first_byte, total)
+
+    def test_defaults_until_min_samples(self):
+        self.assertEqual(self.policies.budget('gpt-4o-mini'), DEFAULT_BUDGET)
+        self.assertEqual(self.policies.budget('anthropic/claude-3-opus'), SLOW_MODEL_BUDGET)
+        self.observe(TIMEOUT_MIN_SAMPLES - 1, 1, 2)
+        self.assertEqual(self.policies.budget('m'), DEFAULT_BUDGET)
+
+    def test_budget_is_percentile_times_factor(self):
+        self.observe(TIMEOUT_MIN_SAMPLES, 4, 10)
+        budget = self.policies.budget('m')
+        self.assertAlmostEqual(budget.first_byte, 4 * TIMEOUT_FACTOR)
+        self.assertAlmostEqual(budget.total, 10 * TIMEOUT_FACTOR)
+
+    def test_floors_and_ceilings(self):
+        self.observe(TIMEOUT_MIN_SAMPLES, 0.1, 0.2, model='fast')
+        fast = self.policies.budget('fast')
+        self.assertEqual(fast.first_byte, timeouts.FIRST_BYTE_FLOOR)
+        self.assertEqual(fast.total, timeouts.TOTAL_FLOOR)
+
+        self.observe(TIMEOUT_MIN_SAMPLES, 1000, 2000, model='slow')
+        slow = self.policies.budget('slow')
+        self.assertEqual(slow.first_byte, timeouts.FIRST_BYTE_CEILING)
+        self.assertEqual(slow.total, timeouts.TOTAL_CEILING)
+
+    def test_total_budget_never_below_first_byte_budget(self):
+        self.observe(TIMEOUT_MIN_SAMPLES, 20, 20)
+        budget = self.policies.budget('m')
+        self.assertGreaterEqual(budget.total, budget.first_byte)
+
+    def test_a_few_timeouts_add_one_bounded_step(self):
+        self.observe(TIMEOUT_MIN_SAMPLES * 2, 4, 10)
+        before = self.policies.budget('m')
+        for _ in range(3):
+            self.policies.record_timeout('m', before.total, first_byte=4)
+        after = self.policies.budget('m')
+        self.assertAlmostEqual(after.total, before.total * TIMEOUT_STEP)
+        # Only the expired budget moves
+        self.assertAlmostEqual(after.first_byte, before.first_byte)
+
+    def test_repeated_timeouts_do_not_ratchet_towards_the_ceiling(self):
+        self.observe(TIMEOUT_MIN_SAMPLES * 3, 4, 10)
+        budgets = []
+        for _ in range(TIMEOUT_MIN_SAMPLES):
+            budget = self.policies.budget('m')
+            budgets.append(budget.first_byte)
+            self.policies.record_timeout('m', budget.first_byte)
+        self.assertLessEqual(max(budgets), 4 * TIMEOUT_FACTOR * TIMEOUT_STEP)
+
+    def test_budget_shrinks_when_timeouts_dominate(self):
+        self.observe(TIMEOUT_MIN_SAMPLES, 8, 20)
+        for _ in range(TIMEOUT_MIN_SAMPLES):
+            self.policies.record_timeout('m', 16)
+        budget = self.policies.budget('m')
+        # Back to the bare first-byte percentile; the total budget never expired
+        self.assertAlmostEqual(budget.first_byte, 8)
+        self.assertAlmostEqual(budget.total, 20 * TIMEOUT_FACTOR)
+
+    def test_hung_model_without_history_fails_fast(self):
+        for _ in range(TIMEOUT_MIN_SAMPLES):
+            self.policies.record_timeout('m', DEFAULT_BUDGET.first_byte)
+        budget = self.policies.budget('m')
+        self.assertLess(budget.first_byte, DEFAULT_BUDGET.first_byte)
+        stats = self.policies.stats()['m']
+        self.assertEqual((stats['timeouts'], stats['first_byte_timeout_rate']),
+                         (TIMEOUT_MIN_SAMPLES, 1.0))
+
+    def test_recent_latency_counts_timeouts_at_their_elapsed_time(self):
+        self.observe(9, 1, 2)
+        self.policies.record_timeout('m', 30)
+        self.assertEqual(self.policies.recent_latency('m', 60, pct=1.0), 30)
+        self.assertIsNone(self.policies.recent_latency('other', 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
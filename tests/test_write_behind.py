@@ -0,0 +1,158 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from write_behind import WriteBehindBuffer, WriteBufferFull, merge_fields
+
+
+class Recorder:
+    """flush_fn that records writes and raises the queued errors first"""
+
+    def __init__(self):
+        self.writes = []
+        self.errors = []
+
+    def __call__(self, key, payload):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.writes.append((key, payload))
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.scratch.name, 'saves.journal')
+        self.buffers = []
+
+    def tearDown(self):
+        for buffer in self.buffers:
+            try:
+                buffer.close(timeout=1)
+            except Exception:
+                pass
+        self.scratch.cleanup()
+
+    def buffer(self, flush_fn, **kwargs):
+        kwargs.setdefault('window', 60)
+        kwargs.setdefault('retry_delay', 0)
+        buffer = WriteBehindBuffer(flush_fn, **kwargs)
+        self.buffers.append(buffer)
+        return buffer
+
+    def test_merge_keeps_older_fields_the_newer_save_leaves_unset(self):
+        self.assertEqual(
+            merge_fields({'title': 'a', 'model': 'm'}, {'title': 'b', 'model': None}),
+            {'title': 'b', 'model': 'm'}
+        )
+
+    def test_saves_to_one_key_are_coalesced_into_one_write(self):
+        recorder = Recorder()
+        buffer = self.buffer(recorder)
+        buffer.submit(('alice', 'c1'), {'title': 'first'})
+        buffer.submit(('alice', 'c1'), {'title': 'second', 'model': 'm'})
+        buffer.submit(('bob', 'c2'), {'title': 'other'})
+
+        buffer.flush(prefix=('alice',))
+        self.assertEqual(recorder.writes, [(('alice', 'c1'), {'title': 'second', 'model': 'm'})])
+        buffer.flush()
+        self.assertEqual(len(recorder.writes), 2)
+        stats = buffer.stats()
+        self.assertEqual((stats['submitted'], stats['coalesced'], stats['flushed']), (3, 1, 2))
+
+    def test_full_buffer_blocks_then_rejects(self):
+        buffer = self.buffer(Recorder(), max_pending=1, submit_timeout=0.05)
+        buffer.submit(('alice', 'c1'), {'title': 'a'})
+        # An already pending key still coalesces when the buffer is full
+        buffer.submit(('alice', 'c1'), {'title': 'b'})
+        with self.assertRaises(WriteBufferFull):
+            buffer.submit(('alice', 'c2'), {'title': 'c'})
+        self.assertEqual(buffer.stats()['rejected'], 1)
+
+    def test_background_thread_flushes_after_the_window(self):
+        recorder = Recorder()
+        buffer = self.buffer(recorder, window=0.01)
+        buffer.submit(('alice', 'c1'), {'title': 'a'})
+        deadline = time.monotonic() + 2
+        while not recorder.writes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(recorder.writes, [(('alice', 'c1'), {'title': 'a'})])
+
+    def test_journal_is_replayed_after_a_crash(self):
+        crashed = self.buffer(Recorder(), journal_path=self.journal)
+        crashed.submit(('alice', 'c1'), {'title': 'a'})
+        crashed.submit(('alice', 'c1'), {'model': 'm'})
+        # Simulate the process dying: the journal lock goes, nothing is flushed
+        crashed._journal_lock.close()
+        crashed._journal_lock = None
+        self.buffers.remove(crashed)
+
+        recorder = Recorder()
+        restarted = self.buffer(recorder, journal_path=self.journal)
+        self.assertEqual(restarted.journal_path, self.journal)
+        restarted.flush()
+        self.assertEqual(recorder.writes, [(('alice', 'c1'), {'title': 'a', 'model': 'm'})])
+
+    def test_each_live_process_gets_its_own_journal(self):
+        first = self.buffer(Recorder(), journal_path=self.journal)
+        # The lock is per open file description, so a second buffer in this
+        # process stands in for a second worker
+        second = self.buffer(Recorder(), journal_path=self.journal)
+        self.assertNotEqual(first.journal_path, second.journal_path)
+        second.submit(('bob', 'c2'), {'title': 'b'})
+        first.submit(('alice', 'c1'), {'title': 'a'})
+        first.flush()
+        # first compacting its journal leaves second's untouched
+        with open(second.journal_path) as journal:
+            self.assertEqual([json.loads(line)['key'] for line in journal], [['bob', 'c2']])
+
+    def test_permanent_errors_are_dead_lettered_and_leave_the_journal(self):
+        recorder = Recorder()
+        recorder.errors.append(KeyError('owned by another user'))
+        buffer = self.buffer(recorder, journal_path=self.journal, permanent_errors=(KeyError,))
+        buffer.submit(('alice', 'c1'), {'title': 'a'})
+        with self.assertRaises(KeyError):
+            buffer.flush()
+
+        stats = buffer.stats()
+        self.assertEqual((stats['pending'], stats['dead_lettered']), (0, 1))
+        self.assertEqual(stats['dead_letters'][0]['key'], ['alice', 'c1'])
+        with open(self.journal) as journal:
+            self.assertEqual(journal.read(), '')
+        buffer.flush()  # nothing left to fail
+
+    def test_transient_errors_are_retried_up_to_max_attempts(self):
+        recorder = Recorder()
+        recorder.errors.extend([OSError('down')] * 3)
+        buffer = self.buffer(recorder, max_attempts=3)
+        buffer.submit(('alice', 'c1'), {'title': 'a'})
+        for _ in range(2):
+            with self.assertRaises(OSError):
+                buffer.flush()
+            self.assertEqual(buffer.stats()['pending'], 1)
+        with self.assertRaises(OSError):
+            buffer.flush()
+        stats = buffer.stats()
+        self.assertEqual((stats['pending'], stats['dead_lettered'], stats['failures']), (0, 1, 3))
+
+    def test_a_success_resets_the_attempt_count(self):
+        recorder = Recorder()
+        recorder.errors.append(OSError('blip'))
+        buffer = self.buffer(recorder, max_attempts=2)
+        buffer.submit(('alice', 'c1'), {'title': 'a'})
+        with self.assertRaises(OSError):
+            buffer.flush()
+        buffer.flush()
+        recorder.errors.append(OSError('blip'))
+        buffer.submit(('alice', 'c1'), {'title': 'b'})
+        with self.assertRaises(OSError):
+            buffer.flush()
+        self.assertEqual(buffer.stats()['dead_lettered'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+# Rolling latency window and how budgets are derived from it
+TIMEOUT_WINDOW = int(os.getenv('TIMEOUT_WINDOW', 200))
+TIMEOUT_MIN_SAMPLES = int(os.getenv('TIMEOUT_MIN_SAMPLES', 20))
+TIMEOUT_PERCENTILE = float(os.getenv('TIMEOUT_PERCENTILE', 0.99))
+TIMEOUT_FACTOR = float(os.getenv('TIMEOUT_FACTOR', 2.0))
+# Timeouts don't enter the latency percentiles. While some of the window's
+# requests time out a budget gets one step of extra headroom; once at least
+# TIMEOUT_SHRINK_RATE of them do, the model looks hung rather than slow and
+# the budget drops to the bare percentile (no TIMEOUT_FACTOR) to fail fast.
+TIMEOUT_STEP = float(os.getenv('TIMEOUT_STEP', 1.5))
+TIMEOUT_SHRINK_RATE = float(os.getenv('TIMEOUT_SHRINK_RATE', 0.5))
+
+# Floors/ceilings (seconds) for each budget
+CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT', 5))
+FIRST_BYTE_FLOOR = float(os.getenv('FIRST_BYTE_TIMEOUT_FLOOR', 5))
+FIRST_BYTE_CEILING = float(os.getenv('FIRST_BYTE_TIMEOUT_CEILING', 300))
+TOTAL_FLOOR = float(os.getenv('TOTAL_TIMEOUT_FLOOR', 10))
+TOTAL_CEILING = float(os.getenv('TOTAL_TIMEOUT_CEILING', 360))
+
+TimeoutBudget = namedtuple('TimeoutBudget', ['connect', 'first_byte', 'total'])
+
+# Budgets used until a model has TIMEOUT_MIN_SAMPLES observations
+DEFAULT_BUDGET = TimeoutBudget(CONNECT_TIMEOUT, 30, 45)
+SLOW_MODEL_BUDGET = TimeoutBudget(CONNECT_TIMEOUT, 120, 180)
+SLOW_MODEL_MARKERS = ('o1-', 'o1/', '/o1', '405b', 'opus')
+
+
+def _clamp(value, floor, ceiling):
+    return max(floor, min(ceiling, value))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _adjust(budget, timeout_rate):
+    """Apply the window's timeout rate to a budget: one bounded step up
+    while some requests time out, back down to the bare percentile once
+    timeouts dominate"""
+    if timeout_rate >= TIMEOUT_SHRINK_RATE:
+        return budget / TIMEOUT_FACTOR
+    if timeout_rate > 0:
+        return budget * TIMEOUT_STEP
+    return budget
+
+
+class TimeoutPolicies:
+    """Per-model timeout budgets learned from observed latency"""
+
+    def __init__(self, window=TIMEOUT_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._first_byte = {}
+        self._total = {}
+        self._recent = {}
+        self._timeouts = {}
+        # Per request: None if it completed, else the budget that expired
+        self._outcomes = {}
+
+    def _default_budget(self, model):
+        if any(marker in model for marker in SLOW_MODEL_MARKERS):
+            return SLOW_MODEL_BUDGET
+        return DEFAULT_BUDGET
+
+    def record(self, model, first_byte, total):
+        """Record a completed request's latencies (seconds)"""
+        with self._lock:
+            self._first_byte.setdefault(model, deque(maxlen=self.window)).append(first_byte)
+            self._total.setdefault(model, deque(maxlen=self.window)).append(total)
+            self._recent.setdefault(model, deque(maxlen=self.window)).append((time.monotonic(), total))
+            self._outcomes.setdefault(model, deque(maxlen=self.window)).append(None)
+
+    def record_timeout(self, model, elapsed, first_byte=None):
+        """Record a timed-out request against the budget that expired: the
+        first-byte one if ``first_byte`` is None (nothing arrived),
+        otherwise the total one, with ``first_byte`` kept as the real
+        observation it is.
+
+        The elapsed time is only a lower bound on the latency, and it is the
+        current budget, so it isn't added to the percentiles (where a few of
+        them would double the next budget); the timeout rate adjusts the
+        budget instead, see ``budget``.
+        """
+        expired = 'first_byte' if first_byte is None else 'total'
+        with self._lock:
+            self._timeouts[model] = self._timeouts.get(model, 0) + 1
+            if first_byte is not None:
+                self._first_byte.setdefault(model, deque(maxlen=self.window)).append(first_byte)
+            self._recent.setdefault(model, deque(maxlen=self.window)).append((time.monotonic(), elapsed))
+            self._outcomes.setdefault(model, deque(maxlen=self.window)).append(expired)
+
+    def recent_latency(self, model, horizon, pct=TIMEOUT_PERCENTILE):
+        """Total-latency percentile over the last ``horizon`` seconds, or None"""
+        cutoff = time.monotonic() - horizon
+        with self._lock:
+            samples = [total for at, total in self._recent.get(model, ()) if at >= cutoff]
+        if not samples:
+            return None
+        return _percentile(samples, pct)
+
+    def _timeout_rates(self, model):
+        """Fractions of the window's requests that hit the first-byte and
+        total budgets, or None until TIMEOUT_MIN_SAMPLES have finished"""
+        with self._lock:
+            outcomes = list(self._outcomes.get(model, ()))
+        if len(outcomes) < TIMEOUT_MIN_SAMPLES:
+            return None
+        return (outcomes.count('first_byte') / len(outcomes),
+                outcomes.count('total') / len(outcomes))
+
+    def budget(self, model):
+        """Return the TimeoutBudget to use for the next request to model"""
+        with self._lock:
+            first_byte = list(self._first_byte.get(model, ()))
+            total = list(self._total.get(model, ()))
+
+        default = self._default_budget(model)
+        if len(total) < TIMEOUT_MIN_SAMPLES:
+            first_byte_budget, total_budget = default.first_byte, default.total
+        else:
+            first_byte_budget = _percentile(first_byte, TIMEOUT_PERCENTILE) * TIMEOUT_FACTOR
+            total_budget = _percentile(total, TIMEOUT_PERCENTILE) * TIMEOUT_FACTOR
+
+        rates = self._timeout_rates(model)
+        if rates:
+            first_byte_budget = _adjust(first_byte_budget, rates[0])
+            total_budget = _adjust(total_budget, rates[1])
+
+        first_byte_budget = _clamp(first_byte_budget, FIRST_BYTE_FLOOR, FIRST_BYTE_CEILING)
+        total_budget = _clamp(
+            total_budget, max(TOTAL_FLOOR, first_byte_budget), TOTAL_CEILING
+        )
+        return TimeoutBudget(CONNECT_TIMEOUT, first_byte_budget, total_budget)
+
+    def stats(self):
+        with self._lock:
+            models = list(dict.fromkeys([*self._total, *self._outcomes]))
+            timeouts = dict(self._timeouts)
+        result = {}
+        for model in models:
+            budget = self.budget(model)
+            with self._lock:
+                samples = len(self._total.get(model, ()))
+            rates = self._timeout_rates(model)
+            result[model] = {
+                'samples': samples,
+                'timeouts': timeouts.get(model, 0),
+                'first_byte_timeout_rate': round(rates[0], 4) if rates else None,
+                'total_timeout_rate': round(rates[1], 4) if rates else None,
+                'connect': budget.connect,
+                'first_byte': round(budget.first_byte, 2),
+                'total': round(budget.total, 2),
+            }
+        return result
+
+
+def read_with_deadline(response, deadline, chunk_size=8192):
+    """Read a streamed requests response, enforcing an absolute deadline"""
+    import requests
+
+    chunks = []
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        chunks.append(chunk)
+        if time.monotonic() > deadline:
+            response.close()
+            raise requests.Timeout("Total response budget exceeded")
+    return b''.join(chunks)
+
+
+timeout_policies = TimeoutPolicies()
@@ -0,0 +1,318 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Journal files tried per base path (journal, journal.1, ...) before giving up
+JOURNAL_SLOTS = 64
+
+
+class WriteBufferFull(Exception):
+    """Raised when the buffer stays full for longer than the submit timeout"""
+
+
+def merge_fields(older, newer):
+    """Coalesce two partial saves; fields set in the newer save win"""
+    if older is None:
+        return newer
+    merged = dict(older)
+    merged.update({key: value for key, value in newer.items() if value is not None})
+    return merged
+
+
+def _try_lock(lock_file):
+    """Take an exclusive, non-blocking lock on an open file; False if
+    another process holds it. Released when the file is closed."""
+    try:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+class WriteBehindBuffer:
+    """Coalesces writes per key and flushes them on a background thread.
+
+    Saves to the same key within ``window`` seconds are merged into one
+    call to ``flush_fn(key, payload)``. At most ``max_pending`` keys are
+    buffered; submitters block for up to ``submit_timeout`` seconds when it
+    is full (back-pressure) and then get WriteBufferFull.
+
+    A failed write is retried behind newer ones, up to ``max_attempts``
+    times; one that raises an exception in ``permanent_errors`` (say, an
+    integrity violation) is not retried at all. Either way it then goes to
+    the dead letters: logged, counted, kept in ``dead_letters`` and dropped
+    from the journal, so one bad payload can't wedge its key forever.
+
+    If ``journal_path`` is set, every accepted write is appended to a
+    journal and fsynced before submit returns, and the journal is replayed
+    on start, so queued writes survive a crash. Each process holds an
+    exclusive lock on the journal it uses: the first free one of
+    ``journal_path``, ``journal_path.1``, ... so workers sharing a directory
+    never rewrite each other's journals, and a crashed process's journal is
+    replayed by the next process to claim it. OSError if none is free.
+    Without a journal the queue lives in memory and is flushed on close
+    (registered at exit by the caller).
+    """
+
+    def __init__(self, flush_fn, window=0.5, max_pending=1000, submit_timeout=5,
+                 journal_path=None, merge=merge_fields, retry_delay=1.0,
+                 max_attempts=5, permanent_errors=()):
+        self.flush_fn = flush_fn
+        self.window = window
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self.journal_path = journal_path
+        self.merge = merge
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.permanent_errors = tuple(permanent_errors)
+        self._cond = threading.Condition()
+        self._pending = {}
+        # key -> payload being written, still journaled until it succeeds
+        self._inflight = {}
+        self._attempts = {}
+        self._closing = False
+        self._journal = None
+        self._journal_lock = None
+        self._journal_entries = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.failures = 0
+        self.rejected = 0
+        self.dead_lettered = 0
+        self.dead_letters = deque(maxlen=50)
+
+        if journal_path:
+            self._claim_journal(journal_path)
+            self._replay_journal()
+            self._journal = open(self.journal_path, 'a')
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def _claim_journal(self, base_path):
+        for slot in range(JOURNAL_SLOTS):
+            path = base_path if slot == 0 else f"{base_path}.{slot}"
+            lock_file = open(path + '.lock', 'a')
+            if _try_lock(lock_file):
+                self.journal_path = path
+                self._journal_lock = lock_file
+                return
+            lock_file.close()
+        raise OSError(f"all {JOURNAL_SLOTS} journals at {base_path} are in use")
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn final line from a crash mid-write
+                key = tuple(entry['key'])
+                since, older = self._pending.get(key, (time.monotonic(), None))
+                self._pending[key] = (since, self.merge(older, entry['payload']))
+        if self._pending:
+            print(f"Replaying {len(self._pending)} journaled writes")
+
+    def _append_journal(self, key, payload):
+        self._journal.write(json.dumps({'key': list(key), 'payload': payload}) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_entries += 1
+
+    def _compact_journal(self):
+        """Rewrite the journal to hold only what is still pending (lock held)"""
+        if not self._journal:
+            return
+        temp_path = self.journal_path + '.tmp'
+        entries = list(self._inflight.items()) + [
+            (key, payload) for key, (_, payload) in self._pending.items()
+        ]
+        with open(temp_path, 'w') as temp:
+            for key, payload in entries:
+                temp.write(json.dumps({'key': list(key), 'payload': payload}) + '\n')
+            temp.flush()
+            os.fsync(temp.fileno())
+        self._journal.close()
+        os.replace(temp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+        self._journal_entries = len(entries)
+
+    def submit(self, key, payload):
+        """Queue a write; returns once it is buffered (and journaled)"""
+        deadline = time.monotonic() + self.submit_timeout
+        with self._cond:
+            if self._closing:
+                raise WriteBufferFull("write buffer is shutting down")
+            while key not in self._pending and len(self._pending) >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise WriteBufferFull(f"{len(self._pending)} writes already pending")
+                self._cond.wait(remaining)
+
+            if self._journal:
+                self._append_journal(key, payload)
+            if key in self._pending:
+                since, older = self._pending[key]
+                self.coalesced += 1
+            else:
+                since, older = time.monotonic(), None
+            self._pending[key] = (since, self.merge(older, payload))
+            self.submitted += 1
+            self._cond.notify_all()
+
+    def discard(self, key):
+        """Drop a pending write, e.g. because its row is being deleted"""
+        with self._cond:
+            while key in self._inflight:
+                self._cond.wait()
+            if self._pending.pop(key, None) is not None and self._journal:
+                self._compact_journal()
+
+    def flush(self, key=None, prefix=None):
+        """Synchronously write ``key``, every key starting with the tuple
+        ``prefix``, or (neither given) everything that is still pending"""
+        if key is not None:
+            def match(k):
+                return k == key
+        elif prefix is not None:
+            def match(k):
+                return k[:len(prefix)] == prefix
+        else:
+            def match(k):
+                return True
+        with self._cond:
+            while any(match(k) for k in self._inflight):
+                self._cond.wait()
+            batch = [(k, self._pending.pop(k)[1]) for k in list(self._pending) if match(k)]
+            self._inflight.update(batch)
+        self._write(batch, retry=False)
+
+    def _write(self, batch, retry=True):
+        """Flush a batch; failed writes are re-queued behind newer ones.
+
+        With ``retry`` False the first error is raised after the whole
+        batch has been attempted. Failures count towards the key's attempts
+        on either path.
+        """
+        error = None
+        dead = False
+        try:
+            for key, payload in batch:
+                try:
+                    self.flush_fn(key, payload)
+                    with self._cond:
+                        self.flushed += 1
+                        self._attempts.pop(key, None)
+                except Exception as e:
+                    print(f"Write-behind flush error for {key}: {e}")
+                    with self._cond:
+                        self.failures += 1
+                        attempts = self._attempts.get(key, 0) + 1
+                        gave_up = (isinstance(e, self.permanent_errors)
+                                   or attempts >= self.max_attempts)
+                        if gave_up:
+                            self._dead_letter(key, e, attempts)
+                            dead = True
+                        else:
+                            self._attempts[key] = attempts
+                            since, newer = self._pending.get(key, (time.monotonic(), None))
+                            self._pending[key] = (
+                                since, self.merge(payload, newer) if newer else payload
+                            )
+                    error = error or e
+                    if retry and not gave_up:
+                        time.sleep(self.retry_delay)
+        finally:
+            with self._cond:
+                for key, _ in batch:
+                    self._inflight.pop(key, None)
+                if dead and self._journal:
+                    self._compact_journal()
+                elif not self._pending and not self._inflight:
+                    if self._journal and self._journal_entries:
+                        self._compact_journal()
+                elif self._journal and self._journal_entries > 10 * self.max_pending:
+                    self._compact_journal()
+                self._cond.notify_all()
+        if error is not None and not retry:
+            raise error
+
+    def _dead_letter(self, key, error, attempts):
+        """Give up on a write (lock held); a newer pending save for the key
+        is kept and starts with a clean attempt count"""
+        print(f"Write-behind giving up on {key} after {attempts} attempt(s): {error}")
+        self._attempts.pop(key, None)
+        self.dead_lettered += 1
+        self.dead_letters.append({
+            'key': list(key),
+            'attempts': attempts,
+            'error': f"{type(error).__name__}: {error}",
+            'at': time.time(),
+        })
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if self._closing:
+                    return
+                now = time.monotonic()
+                due = [
+                    key for key, (since, _) in self._pending.items()
+                    if now - since >= self.window and key not in self._inflight
+                ]
+                if not due:
+                    oldest = min(since for since, _ in self._pending.values())
+                    self._cond.wait(max(0.01, self.window - (now - oldest)))
+                    continue
+                batch = [(key, self._pending.pop(key)[1]) for key in due]
+                self._inflight.update(batch)
+                self._cond.notify_all()
+            self._write(batch)
+
+    def close(self, timeout=10):
+        """Stop the flush thread and write everything still pending"""
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        try:
+            self.flush()
+        finally:
+            if self._journal:
+                self._journal.close()
+            if self._journal_lock:
+                self._journal_lock.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'inflight': len(self._inflight),
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'flushed': self.flushed,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'dead_lettered': self.dead_lettered,
+                'dead_letters': list(self.dead_letters),
+            }